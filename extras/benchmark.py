@@ -0,0 +1,406 @@
+"""
+Benchmarks for the StreamStudio pipelines, using videotestsrc inputs so
+that no device or media file is needed:
+
+    $ python extras/benchmark.py compositor
+
+some benchmark needs a media file as further argument
+
+    $ python extras/benchmark.py seek /path/to/video.mp4
+
+The CPU usage is the one of the whole process (user + system time) divided
+by the wall-clock time of the measure, so 100% is a full core. The inputs
+run in the same process, the compositor benchmark subtracts their usage
+measured without the output.
+"""
+import os
+import sys
+import time
+import random
+
+from gi.repository import Gst, GObject
+
+from streamstudio.pipeline import BasePipeline, PadPipeline, TestStreamStudioSource, StreamStudioOutput, StreamStudioCompositorOutput, StreamStudioSwitcherOutput
+from streamstudio.controller import SourceController
+from streamstudio.conf import get_configuration
+from streamstudio.worker import WorkerSource
+
+
+def run_main_loop(seconds):
+    loop = GObject.MainLoop()
+    GObject.timeout_add(int(seconds * 1000), loop.quit)
+    loop.run()
+
+def measure(pad, seconds):
+    """Return (frames/s, cpu %) measured counting the buffers passing
+    through the given pad for the given time"""
+    counter = [0]
+    def __cb_count(pad, info, user_data):
+        counter[0] += 1
+        return Gst.PadProbeReturn.OK
+
+    probe_id = pad.add_probe(Gst.PadProbeType.BUFFER, __cb_count, None)
+
+    start_times = os.times()
+    start = time.time()
+
+    run_main_loop(seconds)
+
+    elapsed = time.time() - start
+    end_times = os.times()
+
+    pad.remove_probe(probe_id)
+
+    cpu = (end_times[0] + end_times[1]) - (start_times[0] + start_times[1])
+
+    return counter[0] / elapsed, 100.0 * cpu / elapsed
+
+def measure_cpu(seconds):
+    """Return the cpu % of the process during the given time"""
+    start_times = os.times()
+    start = time.time()
+
+    run_main_loop(seconds)
+
+    elapsed = time.time() - start
+    end_times = os.times()
+
+    cpu = (end_times[0] + end_times[1]) - (start_times[0] + start_times[1])
+
+    return 100.0 * cpu / elapsed
+
+def _test_input(channel, width, height):
+    return BasePipeline('videotestsrc is-live=true ! video/x-raw,width=(int)%d,height=(int)%d,framerate=(fraction)30/1 ! intervideosink channel=%s' % (
+        width, height, channel,
+    ))
+
+def _measure_inputs_cpu(seconds, count, width, height):
+    """Return the cpu % of count inputs running without the output"""
+    inputs = [_test_input('bench-baseline-%d' % idx, width, height) for idx in range(count)]
+    for ip in inputs:
+        ip.play()
+
+    run_main_loop(1)
+    cpu = measure_cpu(seconds)
+
+    for ip in inputs:
+        ip.kill()
+
+    return cpu
+
+def bench_compositor(seconds=5, counts=(1, 2, 4, 8), sizes=((640, 480), (1280, 720))):
+    """Frames/s and CPU usage of the compositor output adding inputs, the
+    usage of the inputs alone is subtracted"""
+    print '%-10s %-6s %-8s %-8s %-8s' % ('input', 'count', 'fps', 'cpu %', 'cpu %/added input')
+
+    for width, height in sizes:
+        baseline = dict([(count, _measure_inputs_cpu(seconds, count, width, height)) for count in counts])
+
+        output = StreamStudioCompositorOutput(layout='quad', sinks=['fake'])
+        output.play()
+
+        inputs = []
+        previous_count, previous_cpu = 0, 0.0
+        for count in counts:
+            while len(inputs) < count:
+                channel = 'bench-%d' % len(inputs)
+                ip = _test_input(channel, width, height)
+                ip.play()
+                output.add_channel(channel)
+                inputs.append(ip)
+
+            # let it settle
+            run_main_loop(1)
+
+            fps, cpu = measure(output.player.get_by_name('mix').get_static_pad('src'), seconds)
+            cpu -= baseline[count]
+
+            # the cost of each input added from the previous measure
+            print '%-10s %-6d %-8.1f %-8.1f %-8.1f' % (
+                '%dx%d' % (width, height), count, fps, cpu, (cpu - previous_cpu) / (count - previous_count),
+            )
+            previous_count, previous_cpu = count, cpu
+
+        for ip in inputs:
+            ip.kill()
+        output.kill()
+
+class _ChannelSource(object):
+    """Stand-in for StreamStudioSource with an already running bridge"""
+    def __init__(self, channel):
+        self.channel = channel
+
+    def get_bridge_channel(self):
+        return self.channel
+
+def bench_switch(switches=20, width=640, height=480):
+    """Latency of the input-selector switch between two inputs, compared
+    with the output frame interval"""
+    output = StreamStudioSwitcherOutput(sinks=['fake'])
+    output.play()
+
+    inputs = []
+    for idx in range(2):
+        channel = 'bench-%d' % idx
+        ip = _test_input(channel, width, height)
+        ip.play()
+        output.add_channel(channel)
+        inputs.append(_ChannelSource(channel))
+
+    run_main_loop(1)
+
+    for idx in range(switches):
+        output.swap_source(inputs[idx % 2])
+        run_main_loop(0.5)
+
+    latencies = [x * 1000 for x in output.get_switch_latencies()]
+    frame_interval = 1000.0 / get_configuration().get_fps()
+
+    print 'switches: %d/%d' % (len(latencies), switches,)
+    print 'latency (ms): min %.1f mean %.1f max %.1f (frame interval %.1f)' % (
+        min(latencies), sum(latencies) / len(latencies), max(latencies), frame_interval,
+    )
+
+    output.kill()
+
+def _linear_stream_lookup(streams, element):
+    """The lookup done before the index, for comparison"""
+    count = 0
+    for stream_elements in streams:
+        count += 1
+        if element in stream_elements:
+            return count
+
+def bench_stream_index(lookups=10000, counts=(1, 16, 64), elements_per_stream=10):
+    """Time to find the stream of an element (like for each 'level' message)
+    with the linear scan and with the index"""
+    print '%-8s %-14s %-14s' % ('streams', 'scan (us)', 'index (us)')
+
+    for count in counts:
+        # the location is not read since the pipeline is never started
+        p = PadPipeline('/dev/null')
+
+        streams = []
+        for stream_id in range(1, count + 1):
+            elements = [Gst.ElementFactory.make('identity', None) for idx in range(elements_per_stream)]
+            streams.append(elements)
+            p._index_stream_elements('audio', stream_id, elements)
+
+        # the worst case for the scan: the last element of the last stream
+        element = streams[-1][-1]
+
+        start = time.time()
+        for idx in range(lookups):
+            _linear_stream_lookup(streams, element)
+        scan = (time.time() - start) / lookups
+
+        start = time.time()
+        for idx in range(lookups):
+            p._get_stream_id_from_element(element)
+        index = (time.time() - start) / lookups
+
+        print '%-8d %-14.2f %-14.2f' % (count, scan * 1e6, index * 1e6)
+
+def bench_seek(location, seeks=20):
+    """Latency of the keyframe ('scrub') and of the accurate seeks to random
+    positions of a paused file"""
+    p = BasePipeline('filesrc location="%s" ! decodebin ! videoconvert ! fakesink sync=false' % location)
+    p.pause()
+
+    # let it preroll
+    run_main_loop(1)
+
+    duration = p.get_duration()
+    if duration <= 0:
+        print >>sys.stderr, 'the duration of %s is unknown, can\'t seek' % location
+        p.kill()
+        sys.exit(1)
+
+    for mode in ('scrub', 'accurate'):
+        for idx in range(seeks):
+            p.seek(random.randint(0, duration), mode)
+            run_main_loop(0.5)
+
+    print '%-10s %-6s %-8s %-8s %-8s' % ('mode', 'count', 'min ms', 'mean ms', 'max ms')
+    for mode, stats in sorted(p.get_seek_stats().items()):
+        print '%-10s %-6d %-8.1f %-8.1f %-8.1f' % (
+            mode, stats['count'], stats['min'] * 1000, stats['mean'] * 1000, stats['max'] * 1000,
+        )
+
+    p.kill()
+
+def bench_idle_sources(seconds=5, counts=(1, 4, 8, 16)):
+    """CPU usage of N loaded sources all idle (valve closed) and all with
+    the output branch open, only the on-air sources should convert frames"""
+    conf = get_configuration()
+    # no monitors, only the output branches
+    conf.set_value('headless', True)
+
+    print '%-8s %-10s %-10s' % ('sources', 'idle cpu %', 'open cpu %')
+
+    for count in counts:
+        sources = [TestStreamStudioSource('smpte') for idx in range(count)]
+        for source in sources:
+            source.play()
+
+        run_main_loop(1)
+
+        pad = sources[0].enable_video_src().get_static_pad('sink')
+        sources[0].disable_video_src()
+        fps, idle_cpu = measure(pad, seconds)
+
+        for source in sources:
+            source.enable_video_src()
+
+        fps, open_cpu = measure(pad, seconds)
+
+        print '%-8d %-10.1f %-10.1f' % (count, idle_cpu, open_cpu)
+
+        for source in sources:
+            source.kill()
+
+def _process_cpu(pid):
+    """Return the seconds of CPU (user + system) used by the process"""
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+
+    # utime and stime are the 14th and 15th fields
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def bench_workers(seconds=5, count=8):
+    """Frames/s received and CPU usage with the sources in the main process
+    and each one in its own worker process"""
+    conf = get_configuration()
+    conf.set_value('headless', True)
+
+    print '%-12s %-10s %-10s %-12s' % ('sources', 'total fps', 'main cpu %', 'workers cpu %')
+
+    for name, klass, location in (
+        ('in-process', TestStreamStudioSource, 'smpte'),
+        ('workers', WorkerSource, 'test:smpte'),
+    ):
+        sources = [klass(location) for idx in range(count)]
+        for source in sources:
+            source.play()
+
+        # the workers need more time to start
+        run_main_loop(3)
+
+        counter = [0]
+        def __cb_count(pad, info, user_data):
+            counter[0] += 1
+            return Gst.PadProbeReturn.OK
+
+        for source in sources:
+            source.enable_video_src().get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, __cb_count, None)
+
+        pids = [source.get_pid() for source in sources if hasattr(source, 'get_pid')]
+
+        start_times = os.times()
+        start_workers = sum([_process_cpu(pid) for pid in pids])
+        start = time.time()
+
+        run_main_loop(seconds)
+
+        elapsed = time.time() - start
+        end_times = os.times()
+        end_workers = sum([_process_cpu(pid) for pid in pids])
+
+        main_cpu = (end_times[0] + end_times[1]) - (start_times[0] + start_times[1])
+
+        print '%-12s %-10.1f %-10.1f %-12.1f' % (
+            name, counter[0] / elapsed, 100.0 * main_cpu / elapsed, 100.0 * (end_workers - start_workers) / elapsed,
+        )
+
+        for source in sources:
+            source.kill()
+
+def bench_latency(seconds=5, profiles=('default', 'low')):
+    """End-to-end latency of a live videotestsrc (standing in for a camera)
+    transmitted to the output, with each latency profile"""
+    conf = get_configuration()
+    conf.set_value('headless', True)
+
+    print '%-10s %-14s %-10s %-10s %-10s' % ('profile', 'pipeline ms', 'min ms', 'mean ms', 'max ms')
+
+    for profile in profiles:
+        conf.set_value('latency-profile', profile)
+
+        output = StreamStudioOutput(sinks=['fake'])
+        output.play()
+        controller = SourceController(output)
+
+        source = TestStreamStudioSource('ball')
+        source.play()
+
+        run_main_loop(1)
+
+        controller.swap_source(source)
+        controller.switch_to_carosello(False)
+
+        run_main_loop(seconds)
+
+        stats = controller.get_end_to_end_latencies()[source]
+        live, min_latency, max_latency = source.get_latency()
+        print '%-10s %-14.1f %-10.1f %-10.1f %-10.1f' % (
+            profile, min_latency / float(Gst.MSECOND), stats['min'] * 1000, stats['mean'] * 1000, stats['max'] * 1000,
+        )
+
+        controller.stop()
+        source.kill()
+        output.kill()
+
+def bench_audio_mix(seconds=5, counts=(2, 8, 32)):
+    """CPU usage of the audio program mixing live audiotestsrc inputs"""
+    conf = get_configuration()
+    conf.set_value('headless', True)
+    conf.set_value('audio-program', True)
+
+    output = StreamStudioOutput(sinks=['fake'])
+    output.play()
+
+    print '%-6s %-10s %-8s %-8s' % ('inputs', 'buffers/s', 'cpu %', 'cpu %/added input')
+
+    inputs = []
+    previous_count, previous_cpu = 0, 0.0
+    for count in counts:
+        while len(inputs) < count:
+            channel = 'bench-audio-%d' % len(inputs)
+            ip = BasePipeline('audiotestsrc is-live=true freq=%d ! interaudiosink channel=%s' % (220 + 10 * len(inputs), channel,))
+            ip.play()
+            output.add_audio_channel(channel)
+            inputs.append(ip)
+
+        run_main_loop(1)
+
+        rate, cpu = measure(output.player.get_by_name('program').get_static_pad('src'), seconds)
+
+        print '%-6d %-10.1f %-8.1f %-8.1f' % (
+            count, rate, cpu, (cpu - previous_cpu) / (count - previous_count),
+        )
+        previous_count, previous_cpu = count, cpu
+
+    for ip in inputs:
+        ip.kill()
+    output.kill()
+
+BENCHMARKS = {
+    'compositor': bench_compositor,
+    'switch': bench_switch,
+    'stream-index': bench_stream_index,
+    'seek': bench_seek,
+    'idle-sources': bench_idle_sources,
+    'workers': bench_workers,
+    'latency': bench_latency,
+    'audio-mix': bench_audio_mix,
+}
+
+if __name__ == '__main__':
+    GObject.threads_init()
+    Gst.init(None)
+
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print >>sys.stderr, 'usage: %s <%s>' % (sys.argv[0], '|'.join(sorted(BENCHMARKS.keys())),)
+        sys.exit(1)
+
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
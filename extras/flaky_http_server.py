@@ -0,0 +1,108 @@
+"""
+Local HTTP server standing in for a remote stream with network problems,
+to try the recovery of the sources:
+
+    $ python extras/flaky_http_server.py video.ogg --port 8000 --up 10 --down 5
+    $ streamstudio-headless http://127.0.0.1:8000/
+
+the file is served slowly (like a live stream) for --up seconds, then the
+connection is reset and for --down seconds the new connections are reset
+without answer, then it starts again. The reset (not a clean close, that
+the client would take for the end of the stream) is reported as an error.
+"""
+import sys
+import time
+import socket
+import struct
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+
+class FlakyHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    # bytes written at each chunk and seconds between the chunks
+    CHUNK_SIZE = 16 * 1024
+    CHUNK_INTERVAL = 0.05
+
+    def __init__(self, address, path, up, down):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _FlakyHandler)
+
+        self.path = path
+        self.up = up
+        self.down = down
+
+        self._start = time.time()
+        # the connections to close with a reset
+        self._aborted = set()
+
+    def is_down(self):
+        """The server is down for the last 'down' seconds of each period"""
+        return (time.time() - self._start) % (self.up + self.down) >= self.up
+
+    def abort(self, request):
+        """Close the connection with a reset when the handler returns"""
+        # with a zero linger the close sends a RST instead of a FIN
+        request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self._aborted.add(request)
+
+    def shutdown_request(self, request):
+        # the shutdown would send the FIN before the reset
+        if request in self._aborted:
+            self._aborted.discard(request)
+            self.close_request(request)
+            return
+
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+class _FlakyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        if server.is_down():
+            server.abort(self.connection)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.end_headers()
+
+        with open(server.path, 'rb') as f:
+            while not server.is_down():
+                chunk = f.read(server.CHUNK_SIZE)
+                if not chunk:
+                    f.seek(0)
+                    continue
+
+                self.wfile.write(chunk)
+                time.sleep(server.CHUNK_INTERVAL)
+
+        # like a network going down in the middle of the stream
+        self.wfile.flush()
+        server.abort(self.connection)
+
+    def log_message(self, format, *args):
+        sys.stderr.write('%s\n' % (format % args))
+
+def start_in_thread(path, port=0, up=10, down=5):
+    """Start the server in a daemon thread, return it (the port used is
+    server.server_address[1])"""
+    server = FlakyHTTPServer(('127.0.0.1', port), path, up, down)
+
+    thread = threading.Thread(target=server.serve_forever, name='flaky-http')
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTTP server dropping the connections periodically')
+    parser.add_argument('path', help='file to serve')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--up', type=float, default=10, help='seconds serving')
+    parser.add_argument('--down', type=float, default=5, help='seconds refusing')
+
+    args = parser.parse_args()
+
+    FlakyHTTPServer(('127.0.0.1', args.port), args.path, args.up, args.down).serve_forever()
@@ -14,6 +14,9 @@ setup(name='streamstudio',
       entry_points = {
           'gui_scripts': [
             'streamstudio = streamstudio:start',
-          ]
+          ],
+          'console_scripts': [
+            'streamstudio-headless = streamstudio.headless:main',
+          ],
       },
       zip_safe=False)
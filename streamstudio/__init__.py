@@ -1,7 +1,17 @@
-from gi.repository import GObject, Gdk, Gst
-from .streamstudio import StreamStudio
+import sys
+from .conf import get_configuration
 
 def start():
+    # imported here so that the headless mode doesn't need Gtk
+    from gi.repository import GObject, Gdk, Gst
+    from .streamstudio import StreamStudio
+    from . import diagnostics, profiling
+
+    get_configuration().load(sys.argv[1:])
+
+    diagnostics.setup_tracers()
+    profiling.setup_tracers()
+
     GObject.threads_init()
     Gst.init(None)
     Gdk.threads_init()
@@ -1,15 +1,242 @@
+"""
+Configuration of StreamStudio.
+
+The values are taken, from the lowest to the highest priority, from the
+defaults below, a configuration file (INI with a [streamstudio] section
+or JSON), the environment (SS_<OPTION> variables, like SS_OUTPUT_WIDTH)
+and the command line (--output-width 1280).
+
+The configuration is shared, use get_configuration() to obtain it
+
+ >>> conf = get_configuration()
+ >>> conf.load(sys.argv[1:])
+ >>> conf.get_output_width()
+
+Since each option is a GObject property, changing it while running emits
+the 'notify' signal so that the pipelines can renegotiate their caps
+
+ >>> conf.connect('notify::output-width', callback)
+ >>> conf.set_value('output-width', 1280)
+"""
+import os
+import json
+import argparse
+import ConfigParser
 from gi.repository import GObject
 
 
+# name, type, default, description
+OPTIONS = (
+    ('output-width', int, 640, 'width of the output video'),
+    ('output-height', int, 480, 'height of the output video'),
+    ('fps', int, 10, 'framerate of the output video'),
+    ('output-format', str, 'I420', 'raw format used from the sources to the output'),
+    ('appsink-max-buffers', int, 2, 'buffers queued into the appsink of a source'),
+    ('appsink-drop', bool, True, 'drop old buffers when the appsink is full'),
+    ('queue-max-buffers', int, 200, 'max buffers in the queues of a source (0 unlimited)'),
+    ('queue-max-time', int, 1000, 'max milliseconds in the queues of a source (0 unlimited)'),
+    ('preview-width', int, 320, 'width of the monitors of the sources'),
+    ('preview-height', int, 200, 'height of the monitors of the sources'),
+    ('preview-fps', int, 10, 'framerate of the monitors of the sources'),
+    ('preview-mode', str, 'thumbnail', 'monitors of the sources: off, thumbnail (scaled to preview-width/height) or full'),
+    ('preview-hidden-fps', int, 1, 'framerate of the monitors not on screen'),
+    ('preview-crowd', int, 4, 'monitors on screen above which their framerate is reduced'),
+    ('latency-profile', str, 'default', 'queues of the sources: default, low (few leaky buffers) or auto (low for the live ones)'),
+    ('threads', int, 0, 'threads used by each scaling/conversion element (0 automatic)'),
+    ('audio-tap-max-buffers', int, 32, 'audio buffers queued for each audio tap before dropping'),
+    ('level-interval', int, 100, 'milliseconds between the audio level measurements'),
+    ('meter-refresh-rate', int, 10, 'updates per second of the audio level meters'),
+    ('position-poll-interval', int, 100, 'milliseconds between the updates of the seek bars'),
+    ('restart-delay', int, 500, 'milliseconds before restarting a failed source, doubled at each failure'),
+    ('restart-max-delay', int, 30000, 'max milliseconds before restarting a failed source'),
+    ('audio-program', bool, False, 'mix the audio of the transmitted sources into the output'),
+    ('source-workers', bool, False, 'run each source in its own process (headless mode only)'),
+    ('diagnostics-interval', int, 0, 'seconds between the samples of the resources used (0 disabled)'),
+    ('diagnostics-log', str, '', 'rolling log where the diagnostics samples are written as JSON lines'),
+    ('diagnostics-port', int, 0, 'serve the last diagnostics sample on http://127.0.0.1:<port>/ (0 disabled)'),
+    ('diagnostics-leaks', bool, False, 'count the GStreamer buffers, events... alive with the leaks tracer'),
+    ('profile', bool, False, 'enable the GStreamer tracers and report the time and CPU used by each element'),
+    ('profile-dir', str, '', 'where the tracers log, the profile report and the dot graphs are written (default in the temp dir)'),
+    ('profile-interval', int, 60, 'seconds between the profile reports and the dot graphs'),
+    ('headless', bool, False, 'no display: sources without monitors and output to fakesink'),
+    ('output-sinks', str, '', 'sinks of the output separated by \';\' (like \'display;matroska-x264:location=show.mkv\')'),
+)
+
+INI_SECTION = 'streamstudio'
+ENV_PREFIX = 'SS_'
+DEFAULT_PATH = os.path.expanduser('~/.streamstudio/streamstudio.ini')
+
+_GTYPES = {
+    int: GObject.TYPE_INT,
+    bool: GObject.TYPE_BOOLEAN,
+    str: GObject.TYPE_STRING,
+}
+
+def _build_gproperties(options):
+    properties = {}
+    for name, tipe, default, description in options:
+        if tipe is int:
+            spec = (_GTYPES[tipe], name, description, 0, GObject.G_MAXINT, default, GObject.PARAM_READWRITE)
+        else:
+            spec = (_GTYPES[tipe], name, description, default, GObject.PARAM_READWRITE)
+
+        properties[name] = spec
+
+    return properties
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+
+    if str(value).lower() in ('1', 'true', 'yes', 'on',):
+        return True
+    elif str(value).lower() in ('0', 'false', 'no', 'off',):
+        return False
+
+    raise ValueError('\'%s\' is not a boolean value' % value)
+
+
 class Configuration(GObject.GObject):
+    __gproperties__ = _build_gproperties(OPTIONS)
+
     def __init__(self):
         GObject.GObject.__init__(self)
 
+        self._types = dict([(name, tipe) for name, tipe, default, description in OPTIONS])
+        self._values = dict([(name, default) for name, tipe, default, description in OPTIONS])
+
+    def do_get_property(self, pspec):
+        return self._values[pspec.name]
+
+    def do_set_property(self, pspec, value):
+        self._values[pspec.name] = value
+
+    def _normalize_name(self, name):
+        name = name.lower().replace('_', '-')
+        if name not in self._types:
+            raise AttributeError('unknown configuration option \'%s\'' % name)
+
+        return name
+
+    def get(self, name):
+        return self.get_property(self._normalize_name(name))
+
+    def set_value(self, name, value):
+        """Set the option converting the value (probably a string)
+        to the right type"""
+        name = self._normalize_name(name)
+        tipe = self._types[name]
+
+        value = _to_bool(value) if tipe is bool else tipe(value)
+
+        if value != self._values[name]:
+            self.set_property(name, value)
+
+    def load_file(self, path):
+        """Load the options from a JSON file (if the extension is '.json')
+        or from the section [streamstudio] of a INI file"""
+        if path.endswith('.json'):
+            with open(path) as f:
+                values = json.load(f)
+        else:
+            parser = ConfigParser.SafeConfigParser()
+            parser.read(path)
+            values = dict(parser.items(INI_SECTION)) if parser.has_section(INI_SECTION) else {}
+
+        for name, value in values.items():
+            self.set_value(name, value)
+
+    def load_environ(self, environ=os.environ):
+        for name in self._types:
+            key = ENV_PREFIX + name.upper().replace('-', '_')
+            if key in environ:
+                self.set_value(name, environ[key])
+
+    def get_argument_parser(self):
+        """Return an ArgumentParser with an option for each configuration value"""
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument('--config', help='configuration file (INI or JSON)')
+
+        for name, tipe, default, description in OPTIONS:
+            parser.add_argument('--%s' % name, dest=name, default=None, help=description)
+
+        return parser
+
+    def load_args(self, args):
+        """Set the options passed from the command line, return the list of
+        the arguments not recognized"""
+        options, remaining = self.get_argument_parser().parse_known_args(args)
+
+        for name in self._types:
+            value = getattr(options, name)
+            if value is not None:
+                self.set_value(name, value)
+
+        return remaining
+
+    def to_environ(self):
+        """Return the SS_* environment variables with the actual values, that
+        load_environ() of another process reads back"""
+        return dict([
+            (ENV_PREFIX + name.upper().replace('-', '_'), str(value)) for name, value in self._values.items()
+        ])
+
+    def load(self, args=None, environ=os.environ):
+        """Load the configuration from file, environment and command line.
+
+        The file is the one passed with --config or with the SS_CONFIG
+        environment variable, otherwise ~/.streamstudio/streamstudio.ini
+        if exists.
+
+        Return the command line arguments not used.
+        """
+        args = args or []
+        options, remaining = self.get_argument_parser().parse_known_args(args)
+
+        path = options.config or environ.get(ENV_PREFIX + 'CONFIG')
+        if path is None and os.path.exists(DEFAULT_PATH):
+            path = DEFAULT_PATH
+
+        if path is not None:
+            self.load_file(path)
+
+        self.load_environ(environ)
+
+        return self.load_args(args)
+
     def get_output_width(self):
-        return 640
+        return self.get_property('output-width')
 
     def get_output_height(self):
-        return 480
+        return self.get_property('output-height')
 
     def get_fps(self):
-        return 10
+        return self.get_property('fps')
+
+    def get_output_format(self):
+        """Raw video format used to pass frames from the sources to the output:
+        sources already producing it are not converted"""
+        return self.get_property('output-format')
+
+    def get_output_caps_string(self):
+        return 'video/x-raw,format=(string)%s,width=(int)%d,height=(int)%d,framerate=(fraction)%d/1' % (
+            self.get_output_format(), self.get_output_width(), self.get_output_height(), self.get_fps(),
+        )
+
+    def get_preview_caps_string(self):
+        """The framerate is not fixed since it's limited by the 'max-rate'
+        of the videorate, changing it doesn't need a renegotiation"""
+        return 'video/x-raw,width=(int)%d,height=(int)%d' % (
+            self.get_property('preview-width'), self.get_property('preview-height'),
+        )
+
+_configuration = None
+def get_configuration():
+    """Return the configuration shared by the whole application, initially
+    loaded from the environment"""
+    global _configuration
+    if _configuration is None:
+        _configuration = Configuration()
+        _configuration.load_environ()
+
+    return _configuration
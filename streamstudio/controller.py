@@ -0,0 +1,416 @@
+"""
+Controller that links the video of the selected source to the output pipeline.
+
+Appsink will internally use a queue to collect buffers from the streaming thread.
+If the application is not pulling samples fast enough, this queue will consume a
+lot of memory over time. The "max-buffers" property can be used to limit the queue
+size. The "drop" property controls whether the streaming thread blocks or if older
+buffers are dropped when the maximum queue size is reached. Note that blocking the
+streaming thread can negatively affect real-time performance and should be avoided.
+"""
+from gi.repository import GObject, Gst
+# lock use inspired from this <https://github.com/kivy/kivy/blob/31ba89c6c7661dcc6fa6916b46be8a0381874e5c/kivy/core/video/video_gstreamer.py>
+from threading import Lock, Event, Thread
+import collections
+from .sslog import logger
+from .conf import get_configuration
+from .testcard import TestCardStore
+
+conf = get_configuration()
+
+class SourceController(GObject.GObject):
+    """Link together the trasmitting appsink with the output's appsrc.
+
+    To initialize it you must pass an instance of StreamStudioOutput pipeline
+    as argument in its constructor.
+
+     >>> op = StreamStudioOutput()
+     >>> sc = SourceController(sc)
+
+    This controller allows two states of trasmission: a state called 'carosello'
+    that is a test state, showing an alternating white/black screen and the real
+    trasmitting state where the output came from the appsink.
+
+    To switch between these two states you can use the switch_to_carosello() method
+
+     >>> sc.switch_to_carosello(True)
+
+    Instead of the white/black screen a fixed test card (see TestCardStore)
+    can be shown
+
+     >>> sc.set_test_card('smpte')
+
+    In order to enable/change the trasmitting StreamStudioSource you have to use
+    the swap_source() method, passing the pipeline's appsink you want to transmit.
+
+     >>> ip = StreamStudioSource('whatever.mp4')
+     >>> ip.play()
+     >>> sc.swap_source(ip.enable_video_src())
+
+    If the transmitting source emits 'error' the output doesn't stall: the
+    last frame received is repeated (or the 'smpte' test card, if no frame
+    arrived) until another source is swapped in.
+    """
+    # card shown when the source fails before sending any frame
+    FALLBACK_CARD = 'smpte'
+    # how many end-to-end latencies are remembered for each source
+    LATENCY_HISTORY = 100
+
+    def __init__(self, output_pipeline):
+        GObject.GObject.__init__(self)
+
+        self._output = output_pipeline
+        self._actual_input = None
+        self._actual_pipeline = None
+
+        self._src_handler_id = None
+        self._error_handler_id = None
+
+        # set when the transmitting source failed, with the last buffer it sent
+        self._fallback = False
+        self._last_buffer = None
+
+        self.timestamp = 0
+
+        self._is_carosello = True
+        self.isWhite = True
+
+        self._test_card = None
+        self._test_cards = TestCardStore()
+        self._test_cards.prerender(['white', 'black', self.FALLBACK_CARD], conf.get_output_width(), conf.get_output_height(), conf.get_output_format())
+
+        # the last sample pulled from the appsink and not yet pushed
+        # (only the newest one is kept, older ones are dropped)
+        self._data = None
+        self._lock = Lock()
+        # the frames are pushed from the appsrc's, the appsink's and the
+        # carosello's threads: held while timestamping and pushing, so that
+        # the timestamps reach the output in order
+        self._push_lock = Lock()
+
+        # set between the 'need-data' and 'enough-data' signals of the appsrc
+        self._need_data = Event()
+        self._stop_event = Event()
+
+        # for each source the delays between the capture of the frames and
+        # their push into the output (see get_end_to_end_latencies())
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=self.LATENCY_HISTORY))
+
+        # counters used to check that the frames are forwarded without copies
+        self._bytes_copied = 0
+        self._bytes_forwarded = 0
+
+        overlay = self._output.player.get_by_name('overlay')
+        if overlay is not None:
+            self._count_copies(overlay)
+
+        self._output.get_video_src().connect('need-data', self._on_need_data)
+        self._output.get_video_src().connect('enough-data', self._on_enough_data)
+
+        # the frames of the 'carosello' state are not coming from any appsink
+        # so we need a thread generating them at the output framerate
+        self._carosello_thread = Thread(target=self._carosello_loop, name='carosello')
+        self._carosello_thread.daemon = True
+        self._carosello_thread.start()
+
+    def _carosello_loop(self):
+        """Push the test frames while in 'carosello' state, switching
+        color every second."""
+        count = 0
+
+        # the framerate is read each time since the configuration can change
+        while not self._stop_event.wait(1.0 / conf.get_fps()):
+            count += 1
+            if count % conf.get_fps() == 0:
+                self.isWhite = not self.isWhite
+
+            if not self._need_data.is_set():
+                continue
+
+            if self._fallback and not self._is_carosello:
+                self._push_buffer(self._get_fallback_buffer())
+                continue
+
+            if not self._is_carosello:
+                continue
+
+            card = self._test_card
+            if card is None:
+                card = 'white' if self.isWhite else 'black'
+
+            self._push_buffer(self._dump(conf.get_output_width(), conf.get_output_height(), card))
+
+    def _get_fallback_buffer(self):
+        """Return the last frame of the failed source, to timestamp again"""
+        if self._last_buffer is None:
+            return self._dump(conf.get_output_width(), conf.get_output_height(), self.FALLBACK_CARD)
+
+        bffer = self._forward_buffer(self._last_buffer)
+        bffer.duration = Gst.util_uint64_scale_int(1, Gst.SECOND, conf.get_fps())
+
+        return bffer
+
+    def _on_source_error(self, pipeline, message):
+        logger.warning('transmitting source %s failed, repeating its last frame' % pipeline)
+        self._fallback = True
+
+    def is_fallback(self):
+        """Tell if the output is showing the frame of a failed source"""
+        return self._fallback
+
+    def stop(self):
+        """Stop generating frames for the output"""
+        self._stop_event.set()
+        self._need_data.clear()
+
+    def set_test_card(self, name):
+        """Choose the card shown in 'carosello' state, with None the
+        output alternates white and black frames."""
+        if name is not None and name not in self._test_cards.get_cards():
+            raise AttributeError('unknown test card \'%s\'' % name)
+
+        self._test_card = name
+
+    def get_test_cards(self):
+        return self._test_cards
+
+    def _dump(self, width, height, card):
+        """Return a buffer with the frame of the given test card"""
+        # http://gstreamer.freedesktop.org/data/doc/gstreamer/head/manual/html/section-data-spoof.html#section-spoof-appsrc
+        bffer = self._test_cards.get_frame(card, width, height, conf.get_output_format(),
+            self.timestamp, Gst.util_uint64_scale_int(1, Gst.SECOND, conf.get_fps()))
+
+        return bffer
+
+    def _set_timestamp(self, bffer):
+        """Place the buffer after the last one pushed into the output; with
+        the audio program not before the running time of the output, so that
+        the video stays in sync with the audio mixed live. Called with the
+        push lock held."""
+        running_time = self._output.get_running_time() if self._output.has_audio_program() else None
+        if running_time is not None:
+            self.timestamp = max(self.timestamp, running_time)
+
+        bffer.pts = self.timestamp
+        self.timestamp += bffer.duration
+
+    def _on_need_data(self, appsrc, *args):
+        """Called from the appsrc's streaming thread when its queue is
+        running empty: if a frame is already waiting push it now, the following
+        ones will be pushed directly from the appsink's streaming thread."""
+        self._need_data.set()
+
+        if not self._is_carosello:
+            self._push_data()
+
+    def _on_enough_data(self, appsrc):
+        self._need_data.clear()
+
+    def _on_new_sample(self, appsink):
+        """Called from the streaming thread of the source pipeline"""
+        sample = appsink.emit('pull-sample')
+
+        if self._is_carosello:
+            return Gst.FlowReturn.OK
+
+        with self._lock:
+            self._data = sample
+
+        if self._need_data.is_set():
+            self._push_data()
+
+        return Gst.FlowReturn.OK
+
+    def _forward_buffer(self, upstream):
+        """Return a buffer sharing the GstMemory blocks of the upstream one,
+        so that only the metadata (timestamps, flags) is duplicated and can be
+        rewritten without touching the pixels.
+
+        Memory marked as NO_SHARE is copied by GStreamer anyway, its size is
+        accounted in the counter returned by get_bytes_copied(), like the
+        frames copied later by the overlay of the output.
+        """
+        flags = Gst.BufferCopyFlags.METADATA | Gst.BufferCopyFlags.MEMORY
+        bffer = upstream.copy_region(flags, 0, upstream.get_size())
+
+        for idx in range(upstream.n_memory()):
+            memory = upstream.peek_memory(idx)
+            if memory.mini_object.flags & Gst.MemoryFlags.NO_SHARE:
+                self._bytes_copied += memory.size
+
+        self._bytes_forwarded += upstream.get_size()
+
+        return bffer
+
+    def _count_copies(self, element):
+        """Count the bytes of the frames whose memory is replaced passing through
+        the element: writing in place (like the timeoverlay does) a memory
+        still referenced elsewhere copies it"""
+        memories = {}
+
+        # only the addresses are kept, a reference would force the copy
+        def __get_memories(bffer):
+            return [hash(bffer.peek_memory(idx)) for idx in range(bffer.n_memory())]
+
+        def __cb_sink(pad, info, user_data):
+            memories['in'] = __get_memories(info.get_buffer())
+            return Gst.PadProbeReturn.OK
+
+        # the element works in place, so from the same thread
+        def __cb_src(pad, info, user_data):
+            bffer = info.get_buffer()
+            if memories.pop('in', None) not in (None, __get_memories(bffer)):
+                self._bytes_copied += bffer.get_size()
+
+            return Gst.PadProbeReturn.OK
+
+        element.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, __cb_sink, None)
+        element.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, __cb_src, None)
+
+    def _measure_latency(self, upstream):
+        """The timestamp of a buffer is the running time of the source pipeline
+        when it was captured (for the live sources), so the running time now
+        minus it is how long it took to arrive here. The sources without the
+        capture time (like WorkerSource) are not measured."""
+        pipeline = self._actual_pipeline
+        if pipeline is None or not pipeline.CAPTURE_TIMESTAMPS:
+            return
+
+        clock = pipeline.player.get_clock()
+        if clock is None or upstream.pts == Gst.CLOCK_TIME_NONE:
+            return
+
+        running_time = clock.get_time() - pipeline.player.get_base_time()
+        self._latencies[pipeline].append((running_time - upstream.pts) / float(Gst.SECOND))
+
+    def get_end_to_end_latencies(self):
+        """Return a dict with as key the source and as value a dict with min,
+        mean and max seconds from the capture of the last frames to the output
+        (meaningful only for the live sources, the ones in a worker process
+        are missing)"""
+        stats = {}
+        for pipeline, latencies in self._latencies.items():
+            latencies = list(latencies)
+            if not latencies:
+                continue
+
+            stats[pipeline] = {
+                'count': len(latencies),
+                'min': min(latencies),
+                'mean': sum(latencies) / len(latencies),
+                'max': max(latencies),
+            }
+
+        return stats
+
+    def get_bytes_copied(self):
+        """Return how many bytes of frame data were really copied since the
+        controller creation, here and by the overlay of the output: it writes
+        the frames in place, so each frame whose memory is still referenced
+        upstream (like the last one kept for the fallback) is copied."""
+        return self._bytes_copied
+
+    def get_bytes_forwarded(self):
+        """Return how many bytes of frame data were sent to the output"""
+        return self._bytes_forwarded
+
+    def _copy_from_data(self):
+        with self._lock:
+            if not self._data:
+                return None
+
+            sample = self._data
+
+            self._data = None
+
+        self._last_buffer = sample.get_buffer()
+        self._measure_latency(self._last_buffer)
+
+        return self._forward_buffer(self._last_buffer)
+
+    def _push_buffer(self, bffer):
+        """Timestamp the buffer and push it into the output"""
+        with self._push_lock:
+            # NOTE: without the timestamp the stream after the first
+            # switch doesn't re-switch and the stream appears lagging
+            try:
+                self._set_timestamp(bffer)
+            except ValueError as e:
+                logger.error('invalid timestamp %d for %s' % (self.timestamp, bffer,))
+                return
+
+            result = self._output.get_video_src().emit('push-buffer', bffer)
+
+        if result != Gst.FlowReturn.OK:
+            # probably the output is shutting down, wait for the next 'need-data'
+            logger.debug('error pushing buffer: %s' % result)
+            self._need_data.clear()
+
+    def _push_data(self):
+        bff = self._copy_from_data()
+
+        if bff is None:
+            return
+
+        self._push_buffer(bff)
+
+    def _stop_actual_video_source(self):
+        if self._src_handler_id is not None:
+            self._actual_input.disconnect(self._src_handler_id)
+            self._actual_input.set_property('emit-signals', False)
+
+            self._src_handler_id = None
+
+    def _remove_actual_video_source(self):
+        self._actual_input = None
+
+    def _set_actual_video_input(self, appsink):
+        self._actual_input = appsink
+    def _start_actual_video_input(self):
+        self._src_handler_id = self._actual_input.connect('new-sample', self._on_new_sample)
+        self._actual_input.set_property('emit-signals', True)
+    def swap_source(self, pipeline):
+        """Change the trasmitting appsink"""
+        logger.debug('swap source to pipeline %s' % pipeline)
+
+        if self._actual_input is not None:
+            self._actual_pipeline.disconnect(self._error_handler_id)
+            self._actual_pipeline.disable_video_src()
+            self._stop_actual_video_source()
+
+        self._fallback = False
+        self._last_buffer = None
+
+        self._actual_pipeline = pipeline
+        self._error_handler_id = self._actual_pipeline.connect('error', self._on_source_error)
+        self._actual_input = self._actual_pipeline.enable_video_src()
+
+        self._start_actual_video_input()
+
+    def remove_source(self, pipeline):
+        """Forget the source, that is going to be killed: if it's the one
+        transmitting the output goes back to carosello"""
+        if pipeline is self._actual_pipeline:
+            self._is_carosello = True
+
+            self._actual_pipeline.disconnect(self._error_handler_id)
+            self._actual_pipeline.disable_video_src()
+            self._stop_actual_video_source()
+            self._remove_actual_video_source()
+
+            with self._lock:
+                self._data = None
+
+            self._actual_pipeline = None
+            self._error_handler_id = None
+            self._fallback = False
+            self._last_buffer = None
+
+        self._latencies.pop(pipeline, None)
+
+    def switch_to_carosello(self, enable):
+        """Change from carosello to trasmitting state"""
+        self._is_carosello = enable
+
+    def is_carosello(self):
+        return self._is_carosello
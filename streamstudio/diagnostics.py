@@ -0,0 +1,256 @@
+"""
+Periodic samples of the resources used, to find where the memory goes
+during long sessions (like extras/stacktracer.py does for the stacks).
+
+Each 'diagnostics-interval' seconds a thread samples
+
+ - the resident memory and the threads of the process
+ - the GStreamer buffers, events, caps... alive, counted by the leaks
+   tracer (only with 'diagnostics-leaks', see setup_tracers())
+ - for each pipeline (also the killed ones still referenced) its state,
+   the fill of its queues and the handlers connected to it
+ - the Python objects by type, with the types grown the most since the
+   previous sample, and the counts of the garbage collector
+ - the values returned by the probes passed to start_diagnostics(), called
+   from the thread of the diagnostics
+
+and writes them as a JSON line into the rolling log 'diagnostics-log' and/or
+serves the last one on http://127.0.0.1:<diagnostics-port>/
+
+ >>> setup_tracers()# before Gst.init()
+ >>> start_diagnostics({'sources': lambda: len(studio.get_sources())})
+ >>> ...
+ >>> stop_diagnostics()
+"""
+import os
+import gc
+import json
+import time
+import socket
+import logging
+import threading
+import collections
+import logging.handlers
+import BaseHTTPServer
+from gi.repository import Gst
+from .sslog import logger
+from .conf import get_configuration
+from .pipeline import get_pipelines
+
+conf = get_configuration()
+
+# the GStreamer types counted by the leaks tracer
+LEAKS_FILTERS = ('GstBuffer', 'GstBufferList', 'GstEvent', 'GstQuery', 'GstMessage', 'GstCaps', 'GstSample',)
+
+def add_gst_tracer(spec):
+    """Enable the tracer (like 'leaks' or 'latency(flags=element)') adding it
+    to GST_TRACERS, it must be called before Gst.init()"""
+    tracers = [t for t in os.environ.get('GST_TRACERS', '').split(';') if t]
+    if spec not in tracers:
+        tracers.append(spec)
+
+    os.environ['GST_TRACERS'] = ';'.join(tracers)
+
+def setup_tracers():
+    """Enable the tracers needed by the configuration, before Gst.init()"""
+    if conf.get_property('diagnostics-leaks'):
+        add_gst_tracer('leaks(filters="%s")' % ','.join(LEAKS_FILTERS))
+
+def get_process_status():
+    """Return the resident memory (kB) and the number of threads of this process"""
+    with open('/proc/self/status') as f:
+        status = dict(line.split(':', 1) for line in f)
+
+    return int(status['VmRSS'].split()[0]), int(status['Threads'])
+
+def _get_leaks_tracer():
+    # the active tracers are available from GStreamer 1.18
+    if not hasattr(Gst, 'tracing_get_active_tracers'):
+        return None
+
+    for tracer in Gst.tracing_get_active_tracers():
+        if tracer.__gtype__.name == 'GstLeaksTracer':
+            return tracer
+
+    return None
+
+def get_gst_object_counts():
+    """Return a dict with the number of GStreamer objects alive for each
+    type, None if the leaks tracer is not active"""
+    tracer = _get_leaks_tracer()
+    if tracer is None:
+        return None
+
+    structure = tracer.emit('get-live-objects')
+    objects = structure.get_value('live-objects-list')
+
+    counts = collections.Counter()
+    for idx in range(len(objects)):
+        counts[type(objects[idx].get_value('object')).__name__] += 1
+
+    return dict(counts)
+
+def get_python_object_counts():
+    """Return a dict with the number of objects tracked by the garbage
+    collector for each type"""
+    return dict(collections.Counter(type(o).__name__ for o in gc.get_objects()))
+
+def get_pipeline_stats():
+    """Return a dict with as key the class and the name of each pipeline and
+    as value its state, the levels of its queues and its handlers"""
+    stats = {}
+    for pipeline in get_pipelines():
+        result, state, pending = pipeline.player.get_state(0)
+
+        stats['%s %s' % (pipeline.__class__.__name__, pipeline.player.get_name(),)] = {
+            'state': state.value_nick,
+            'queues': pipeline.get_queue_levels(),
+            'handlers': pipeline.get_handler_counts(),
+        }
+
+    return stats
+
+
+class Diagnostics(threading.Thread):
+    """Sample periodically the resources used, see the module's documentation"""
+    # how many types are reported, the most numerous and the grown the most
+    TOP_TYPES = 20
+    # size and number of the files of the rolling log
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+    LOG_BACKUPS = 5
+
+    def __init__(self, interval, path=None, port=0, probes=None):
+        threading.Thread.__init__(self, name='diagnostics')
+        self.daemon = True
+
+        self.interval = interval
+        self.probes = probes or {}
+        self.stop_requested = threading.Event()
+
+        self._last = None
+        self._python_counts = {}
+
+        self._log = None
+        if path:
+            self._log = logging.getLogger('streamstudio.diagnostics')
+            self._log.propagate = False
+
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=self.LOG_MAX_BYTES, backupCount=self.LOG_BACKUPS)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._log.addHandler(handler)
+            self._log.setLevel(logging.INFO)
+
+        self._server = None
+        if port:
+            try:
+                self._server = _DiagnosticsHTTPServer(('127.0.0.1', port), self)
+            except socket.error as e:
+                logger.warning('diagnostics not served on port %d: %s', port, e)
+
+        if self._server is not None:
+            thread = threading.Thread(target=self._server.serve_forever, name='diagnostics-http')
+            thread.daemon = True
+            thread.start()
+
+    def sample(self):
+        """Return a dict with the values sampled now"""
+        rss, threads = get_process_status()
+
+        python_counts = get_python_object_counts()
+        growth = dict([(name, count - self._python_counts.get(name, 0)) for name, count in python_counts.items()])
+        self._python_counts = python_counts
+
+        def __top(counts):
+            return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True)[:self.TOP_TYPES])
+
+        return {
+            'time': time.time(),
+            'rss': rss,
+            'threads': threads,
+            'gst-objects': get_gst_object_counts(),
+            'pipelines': get_pipeline_stats(),
+            'python-objects': __top(python_counts),
+            'python-growth': __top(growth),
+            'gc-counts': gc.get_count(),
+            'gc-garbage': len(gc.garbage),
+            'probes': dict([(name, probe()) for name, probe in self.probes.items()]),
+        }
+
+    def get_last(self):
+        """Return the last sample, None before the first one"""
+        return self._last
+
+    def run(self):
+        while not self.stop_requested.wait(self.interval):
+            # a sample failing must not stop the next ones
+            try:
+                self._last = self.sample()
+
+                if self._log is not None:
+                    self._log.info(json.dumps(self._last))
+            except Exception as e:
+                logger.exception(e)
+                continue
+
+            logger.debug('diagnostics: rss %d kB, %d threads, %d pipelines',
+                self._last['rss'], self._last['threads'], len(self._last['pipelines']))
+
+    def stop(self):
+        self.stop_requested.set()
+        self.join()
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+class _DiagnosticsHTTPServer(BaseHTTPServer.HTTPServer):
+    def __init__(self, address, diagnostics):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _DiagnosticsHandler)
+
+        self.diagnostics = diagnostics
+
+class _DiagnosticsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(self.server.diagnostics.get_last())
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+_diagnostics = None
+def start_diagnostics(probes=None):
+    """Start the sampling if enabled by the configuration ('diagnostics-interval'
+    not zero), the probes are a dict with as value functions returning
+    something to report. Return the Diagnostics instance or None."""
+    global _diagnostics
+    interval = conf.get_property('diagnostics-interval')
+    if _diagnostics is not None or not interval:
+        return _diagnostics
+
+    _diagnostics = Diagnostics(
+        interval,
+        path=conf.get_property('diagnostics-log'),
+        port=conf.get_property('diagnostics-port'),
+        probes=probes,
+    )
+    _diagnostics.start()
+
+    logger.info('diagnostics every %d s (log \'%s\', port %d)',
+        interval, conf.get_property('diagnostics-log'), conf.get_property('diagnostics-port'))
+
+    return _diagnostics
+
+def stop_diagnostics():
+    global _diagnostics
+    if _diagnostics is None:
+        return
+
+    _diagnostics.stop()
+    _diagnostics = None
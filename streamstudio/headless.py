@@ -0,0 +1,288 @@
+"""
+Run StreamStudio without GUI: no Gtk/Gdk is imported, the sources have no
+monitors and the output goes to a fakesink.
+
+    $ streamstudio-headless test:smpte /path/to/video.mp4
+
+The sources are indicated as
+
+ - test:<pattern>  a live videotestsrc with the given pattern
+ - /dev/videoN     a v4l2 device
+ - http(s)://...   a remote resource
+ - everything else is a local file
+
+The first source is transmitted as soon as its video stream is available.
+"""
+import sys
+import signal
+from gi.repository import GObject, Gst
+from .sslog import logger
+from .conf import get_configuration
+from . import pipeline
+from .controller import SourceController
+from .warmpool import WarmPool
+from .worker import WorkerSource
+from .supervisor import SourceSupervisor
+from . import diagnostics
+from . import profiling
+
+
+def get_source_class(location):
+    """Return the StreamStudioSource subclass able to read from the location
+    and the location to pass to its constructor"""
+    if location.startswith('test:'):
+        return pipeline.TestStreamStudioSource, location[len('test:'):]
+    elif location.startswith('/dev/video'):
+        return pipeline.V4L2StreamStudioSource, location
+    elif location.startswith('http://') or location.startswith('https://'):
+        return pipeline.RemoteStreamStudioSource, location
+
+    return pipeline.StreamStudioSource, location
+
+class HeadlessStudio(GObject.GObject):
+    """Manage sources and output without any GUI.
+
+     >>> studio = HeadlessStudio()
+     >>> source = studio.add_source('test:ball')
+     >>> studio.switch_to(source)
+     >>> studio.run()
+
+    The sources can be removed while running with remove_source(), their
+    pipelines are stopped and freed without touching the output.
+    """
+    # seconds between the logs about the output sinks
+    STATS_INTERVAL = 10
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+
+        self._main_loop = GObject.MainLoop()
+
+        self._output_pipeline = pipeline.StreamStudioOutput()
+        self._switch_controller = SourceController(self._output_pipeline)
+
+        self._sources = []
+        self._warm_pool = WarmPool()
+
+        # the failed sources are recreated, the one on air is swapped back
+        # as soon as its replacement has the video
+        self._on_air = None
+        # the source to transmit as soon as it has the video (see switch_to_when_ready())
+        self._next_on_air = None
+        # the source whose audio is mixed into the output (see the 'audio-program' option)
+        self._audio_on_air = None
+        self._supervisor = SourceSupervisor()
+        self._supervisor.connect('source-restarted', self._on_source_restarted)
+        self._supervisor.connect('source-recovered', self._on_source_recovered)
+
+    def get_sources(self):
+        return list(self._sources)
+
+    def add_source(self, location):
+        if get_configuration().get_property('source-workers'):
+            factory = lambda: WorkerSource(location)
+        else:
+            klass, klass_location = get_source_class(location)
+            factory = lambda: klass(klass_location)
+
+        source = self._supervisor.supervise(factory)
+        source.connect('stream-added', self._on_stream_added)
+
+        self._sources.append(source)
+
+        self._warm_pool.add(source)
+
+        return source
+
+    def remove_source(self, source):
+        """Stop and forget the source; if it's on air the output goes to
+        the carosello"""
+        if source is self._audio_on_air:
+            self._output_pipeline.remove_audio_source(source)
+            self._audio_on_air = None
+
+        if source is self._next_on_air:
+            self._next_on_air = None
+
+        if source is self._on_air:
+            self._on_air = None
+            self._switch_controller.switch_to_carosello(True)
+
+        self._switch_controller.remove_source(source)
+        self._supervisor.unsupervise(source)
+        self._warm_pool.remove(source)
+        self._sources.remove(source)
+
+        source.kill()
+
+    def _on_source_restarted(self, supervisor, old, new):
+        self._sources[self._sources.index(old)] = new
+
+        self._warm_pool.remove(old)
+        self._warm_pool.add(new)
+        new.connect('stream-added', self._on_stream_added)
+
+        # meanwhile the controller repeats the last frame of the old one
+        if self._on_air is old:
+            self._on_air = new
+        if self._next_on_air is old:
+            self._next_on_air = new
+
+        # the audio of the new one is mixed as soon as it appears (see _on_stream_added())
+        if self._audio_on_air is old:
+            self._output_pipeline.remove_audio_channel(old.get_audio_bridge_channel())
+            self._audio_on_air = None
+
+    def _on_source_recovered(self, supervisor, source, duration):
+        if source is self._on_air:
+            logger.info('transmitting %s again after %.1f s', source, duration)
+            self.switch_to(source)
+
+    def switch_to(self, source):
+        """Transmit the video of the given source, it must be already
+        available (see the 'stream-added' signal)"""
+        self._on_air = source
+
+        self._warm_pool.cue(source)
+        self._switch_controller.swap_source(source)
+        self._switch_controller.switch_to_carosello(False)
+
+        self._switch_audio(source)
+
+    def _on_stream_added(self, source, stream_type, stream_id):
+        """Called from the streaming thread, the audio can appear after
+        the video has been transmitted"""
+        if stream_type == 'video' and stream_id == 0:
+            GObject.idle_add(self._switch_to_next, source)
+        elif stream_type == 'audio' and stream_id == 0:
+            GObject.idle_add(self._switch_audio, source)
+
+    def switch_to_when_ready(self, source):
+        """Transmit the source as soon as its video stream is available,
+        also if meanwhile it's restarted"""
+        self._next_on_air = source
+
+        if self._warm_pool.is_ready(source):
+            self._switch_to_next(source)
+
+    def _switch_to_next(self, source):
+        if source is self._next_on_air:
+            self._next_on_air = None
+
+            logger.info('transmitting %s' % source)
+            self.switch_to(source)
+
+        return False
+
+    def _switch_audio(self, source):
+        """The audio follows the video: mix into the output the first audio
+        stream of the source transmitted, in place of the previous one"""
+        if not get_configuration().get_property('audio-program'):
+            return False
+
+        if source is not self._on_air or source is self._audio_on_air:
+            return False
+
+        if self._audio_on_air is not None:
+            self._output_pipeline.remove_audio_source(self._audio_on_air)
+            self._audio_on_air = None
+
+        # the sources in the workers keep their audio
+        if hasattr(source, 'get_audio_stream_ids') and source.get_audio_stream_ids():
+            self._output_pipeline.add_audio_source(source)
+            self._audio_on_air = source
+
+        return False
+
+    def switch_to_carosello(self):
+        self._switch_controller.switch_to_carosello(True)
+
+    def quit(self):
+        diagnostics.stop_diagnostics()
+        profiling.stop_profiling()
+
+        self._switch_controller.stop()
+
+        for source in self._sources:
+            source.kill()
+
+        self._output_pipeline.kill()
+        self._main_loop.quit()
+
+    def _log_sink_stats(self):
+        for source, stats in self._switch_controller.get_end_to_end_latencies().items():
+            latency = source.get_latency()
+            logger.info('%s: end-to-end latency %.0f ms (max %.0f ms), pipeline latency %s',
+                source, stats['mean'] * 1000, stats['max'] * 1000,
+                '%.0f ms' % (latency[1] / float(Gst.MSECOND)) if latency is not None else 'unknown')
+
+        for source, stats in self._supervisor.get_outage_stats().items():
+            if stats['outages']:
+                logger.info('%s: %d outages for %.1f s (longest %.1f s)',
+                    source, stats['outages'], stats['total'], stats['longest'])
+
+        for source, stats in self._warm_pool.get_stats().items():
+            if stats['first-frame'] is not None:
+                logger.info('%s: ready in %.0f ms, first frame %.0f ms after the cue',
+                    source, stats['warm-up'] * 1000, stats['first-frame'] * 1000)
+
+        for stats in self._output_pipeline.get_sink_stats():
+            logger.info('%(sink)s: %(fps).1f fps, queue %(queue-buffers)d buffers (%(queue-fill).0f%% full)' % dict(
+                stats, **{'queue-fill': stats['queue-fill'] * 100}
+            ))
+
+        return True
+
+    def start(self):
+        """Start the output, the main loop must be run by the caller"""
+        self._output_pipeline.play()
+
+        GObject.timeout_add_seconds(self.STATS_INTERVAL, self._log_sink_stats)
+
+    def run(self):
+        self.start()
+
+        def __on_signal(signum, frame):
+            logger.info('received signal %d, exiting' % signum)
+            self.quit()
+
+        signal.signal(signal.SIGINT, __on_signal)
+        signal.signal(signal.SIGTERM, __on_signal)
+
+        # python signal handlers run only when the interpreter gets control
+        GObject.timeout_add(500, lambda: True)
+
+        self._main_loop.run()
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    conf = get_configuration()
+    conf.set_value('headless', True)
+    locations = conf.load(argv)
+
+    if not locations:
+        print >>sys.stderr, 'usage: streamstudio-headless [options] <source> [<source> ...]'
+        sys.exit(1)
+
+    diagnostics.setup_tracers()
+    profiling.setup_tracers()
+
+    GObject.threads_init()
+    Gst.init(None)
+
+    studio = HeadlessStudio()
+    diagnostics.start_diagnostics({
+        'sources': lambda: len(studio.get_sources()),
+    })
+    profiling.start_profiling()
+
+    for idx, location in enumerate(locations):
+        source = studio.add_source(location)
+        if idx == 0:
+            studio.switch_to_when_ready(source)
+
+    studio.run()
+
+if __name__ == '__main__':
+    main()
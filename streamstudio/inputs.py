@@ -4,9 +4,117 @@ from .sslog import logger
 from gi.repository import Gtk, GObject, Gdk, Gst, GstVideo, GdkX11
 from .pipeline import BasePipeline, StreamStudioSource, StreamStudioOutput
 from .gui import GuiMixin
+from .metering import get_level_meter
+from .poller import get_position_poller
+from .preview import get_preview_governor
 
 
 
+def _is_widget_visible(widget):
+    """Tell if the widget is on screen, that is mapped and in a window
+    not iconified"""
+    if not widget.get_mapped():
+        return False
+
+    window = widget.get_toplevel().get_window()
+
+    return window is not None and not (window.get_state() & Gdk.WindowState.ICONIFIED)
+
+class _MonitorLevels(object):
+    """Update the level bars of all the monitors with a single handler of
+    the level meter, taking the Gdk lock once for each emission"""
+    def __init__(self):
+        # pipeline -> monitor
+        self._monitors = {}
+        self._handler_id = None
+
+    def add(self, monitor):
+        self._monitors[monitor.pipeline] = monitor
+
+        if self._handler_id is None:
+            self._handler_id = get_level_meter().connect('levels-updated', self._on_levels_updated)
+
+    def remove(self, monitor):
+        self._monitors.pop(monitor.pipeline, None)
+
+        if not self._monitors and self._handler_id is not None:
+            get_level_meter().disconnect(self._handler_id)
+            self._handler_id = None
+
+    def _on_levels_updated(self, meter, updated):
+        Gdk.threads_enter()
+        try:
+            for pipeline, streams in updated.items():
+                monitor = self._monitors.get(pipeline)
+                if monitor is None:
+                    continue
+
+                try:
+                    monitor.set_levels(streams)
+                except Exception as e:
+                    logger.error(e)
+        finally:
+            Gdk.threads_leave()
+
+_monitor_levels = None
+def _get_monitor_levels():
+    global _monitor_levels
+    if _monitor_levels is None:
+        _monitor_levels = _MonitorLevels()
+
+    return _monitor_levels
+
+class SeekBarMixin(object):
+    """Connect the seek bar (self.seeker) to self.pipeline: while the bar is
+    dragged the pipeline is paused and seeked to the nearest keyframe at each
+    change of value, when released it's seeked to the exact position.
+
+    The classes using it define _on_position() and _is_visible() for the
+    position poller.
+    """
+    def _connect_seeker(self):
+        self._dragging = False
+
+        self.seeker.connect('button-press-event', self._on_press)
+        self.seeker.connect('button-release-event', self._on_release)
+        self.seeker.connect('value-changed', self._on_seeker_value_changed)
+
+        self._start_seek_polling()
+
+    def _start_seek_polling(self):
+        logger.debug('attaching position cb')
+        self.position_cb_id = get_position_poller().register(self.pipeline, self._on_position, self._is_visible)
+
+    def _stop_seek_polling(self):
+        get_position_poller().unregister(self.position_cb_id)
+
+    def _get_seeker_position(self):
+        return int(self.seeker.get_value()*self.pipeline.get_duration()/100)
+
+    def _on_press(self, *args):
+        logger.debug('seek: clicked')
+        self._dragging = True
+        self.pipeline.pause()
+
+        self._stop_seek_polling()
+
+    def _on_seeker_value_changed(self, seeker):
+        # the value is changed also by the poller
+        if not self._dragging:
+            return
+
+        self.pipeline.seek(self._get_seeker_position(), 'scrub')
+
+    def _on_release(self, *args):
+        new_position = self._get_seeker_position()
+        logger.debug('seek: release at %d' % new_position)
+        self._dragging = False
+
+        self.pipeline.seek(new_position, 'accurate')
+        self.pipeline.play()
+
+        self._start_seek_polling()
+
 class VideoInput(GObject.GObject, GuiMixin):
     '''This class create a viewers with its own toolbar and its own gtk.Window
     for a gstreamer video pipeline who could be imported in other windows 
@@ -115,7 +223,7 @@ class VideoInput(GObject.GObject, GuiMixin):
 
         self._cb_handler_id = self._cb_activated.connect('toggled', self._on_activated)
 
-class VideoSeekableInput(VideoInput):
+class VideoSeekableInput(VideoInput, SeekBarMixin):
     """Manage the GUI of a seekable input"""
     main_class = 'window1'
     def __init__(self):
@@ -124,44 +232,16 @@ class VideoSeekableInput(VideoInput):
         # here is the instance of GtkAdjustement and not GtkScale
         self.seeker = self._get_ui_element_by_name('vi_seek')
 
-    def _start_seek_polling(self):
-        def query_position():
-            position = self.pipeline.get_position()
-            duration = self.pipeline.get_duration()
-
-            if duration > 0:
-                self.seeker.set_value(position*100/float(duration))
+    def _on_position(self, pipeline, position, duration):
+        self.seeker.set_value(position*100/float(duration))
 
-            return True
-
-        logger.debug('attaching position cb')
-        self.position_cb_id = GObject.timeout_add(100, query_position)
+    def _is_visible(self):
+        return _is_widget_visible(self._main_container)
 
     def attach_to_pipeline(self, pipeline):
         super(VideoSeekableInput, self).attach_to_pipeline(pipeline)
 
-        def _on_press(*args):
-            logger.debug('seek: clicked')
-            self.pipeline.player.set_state(Gst.State.PAUSED)
-
-            GObject.source_remove(self.position_cb_id)
-
-        def _on_release(*args):
-            new_position = self.seeker.get_value()*self.pipeline.get_duration()/100
-            logger.debug('seek: release at %f' % new_position)
-            self.pipeline.player.set_state(Gst.State.PLAYING)
-            self.pipeline.player.seek_simple(
-                Gst.Format.TIME,
-                Gst.SeekFlags.FLUSH,
-                new_position)
-
-            self._start_seek_polling()
-
-        # attach the onclick
-        self.seeker.connect('button-press-event', _on_press)
-        self.seeker.connect('button-release-event', _on_release)
-
-        self._start_seek_polling()
+        self._connect_seeker()
 
 class AudioInput(GObject.GObject, GuiMixin):
     main_class = 'mainWindow'
@@ -217,7 +297,7 @@ class AudioInput(GObject.GObject, GuiMixin):
         self._get_ui_element_by_name('vi_main_container').reparent(container)
 
 
-class StreamStudioMonitorInput(GObject.GObject, GuiMixin):
+class StreamStudioMonitorInput(GObject.GObject, GuiMixin, SeekBarMixin):
     """Class that take a pipeline and create on need the monitor elements
     needed to show the related stream.
 
@@ -269,15 +349,21 @@ class StreamStudioMonitorInput(GObject.GObject, GuiMixin):
         self.pipeline.connect('stream-added', self._on_stream_added)
         self.pipeline.connect('set-sink', self._on_set_sink)
         self.pipeline.connect('no-more-streams', self._on_no_more_streams)
-        self.pipeline.connect('level-change', self._on_level_change)
+        _get_monitor_levels().add(self)
 
-        # attach the onclick
-        self.seeker.connect('button-press-event', self._on_press)
-        self.seeker.connect('button-release-event', self._on_release)
+        self._connect_seeker()
 
-        self._start_seek_polling()
+        # the preview rate follows the visibility of the monitor
+        self._preview_handle = get_preview_governor().register(self.pipeline, self._is_visible)
 
         self._get_main_class().connect('delete-event', self._on_quit)
+        # the window is destroyed by reparent_in(), the container lives on
+        self.get_main_container().connect('destroy', self._on_destroy)
+
+    def _on_destroy(self, container):
+        get_preview_governor().unregister(self._preview_handle)
+        _get_monitor_levels().remove(self)
+        self._stop_seek_polling()
 
     def _on_quit(self, window, event):
         Gtk.main_quit()
@@ -290,50 +376,23 @@ class StreamStudioMonitorInput(GObject.GObject, GuiMixin):
     def _on_no_more_streams(self, pipeline):
         self.emit('initializated')
 
-    def _on_level_change(self, pipeline, stream_id, level_value):
+    def set_levels(self, streams):
+        """Update the level bars of the streams updated, showing the loudest
+        channel of each one; called with the Gdk lock held"""
+        for stream_id, levels in streams.items():
+            self._audio_streams[stream_id].set_gui_level(max(levels['rms']))
+
+    def _on_position(self, pipeline, position, duration):
         Gdk.threads_enter()
         try:
-            self._audio_streams[stream_id].set_gui_level(level_value)
+            self.seeker.set_value(position*100/float(duration))
         except Exception as e:
             logger.error(e)
         finally:
             Gdk.threads_leave()
 
-    def _start_seek_polling(self):
-        def query_position():
-            position = self.pipeline.get_position()
-            duration = self.pipeline.get_duration()
-
-            if duration > 0:
-                Gdk.threads_enter()
-                try:
-                    self.seeker.set_value(position*100/float(duration))
-                except Exception as e:
-                    logger.error(e)
-                finally:
-                    Gdk.threads_leave()
-
-            return True
-
-        logger.debug('attaching position cb')
-        self.position_cb_id = GObject.timeout_add(100, query_position)
-
-    def _on_press(self, *args):
-        logger.debug('seek: clicked')
-        self.pipeline.player.set_state(Gst.State.PAUSED)
-
-        GObject.source_remove(self.position_cb_id)
-
-    def _on_release(self, *args):
-        new_position = self.seeker.get_value()*self.pipeline.get_duration()/100
-        logger.debug('seek: release at %f' % new_position)
-        self.pipeline.player.set_state(Gst.State.PLAYING)
-        self.pipeline.player.seek_simple(
-            Gst.Format.TIME,
-            Gst.SeekFlags.FLUSH,
-            new_position)
-
-        self._start_seek_polling()
+    def _is_visible(self):
+        return _is_widget_visible(self._monitor_container)
 
     def _on_stream_added(self, pipeline, stream_type, count):
         """Use this to configure the GUI for each stream."""
@@ -0,0 +1,101 @@
+"""
+Aggregation of the audio levels of all the sources.
+
+The 'level' elements of the sources post a message for each interval
+(see the 'level-interval' option), these are collected from the streaming
+threads into a shared snapshot and, at the rate given by the 'meter-refresh-rate'
+option, the streams changed in the meantime are notified with a single
+emission of the 'levels-updated' signal from the main loop.
+
+ >>> meter = get_level_meter()
+ >>> meter.connect('levels-updated', callback)
+"""
+from threading import Lock
+from gi.repository import GObject
+from .conf import get_configuration
+
+conf = get_configuration()
+
+
+class LevelMeter(GObject.GObject):
+    """Keep the last rms, peak and decay values (in dB, one for each channel)
+    for each audio stream of each source.
+
+    The signal 'levels-updated' has as argument a dict with as key the
+    source and as value a dict {stream_id: levels} with only the streams
+    updated since the previous emission; levels is a dict with keys 'rms',
+    'peak' and 'decay'.
+    """
+    __gsignals__ = {
+        'levels-updated': (
+            GObject.SIGNAL_RUN_LAST,
+            GObject.TYPE_NONE,
+            (GObject.TYPE_PYOBJECT,)
+        ),
+    }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+
+        self._snapshot = {}
+        # (source, stream_id) updated since the last emission
+        self._changed = set()
+        self._lock = Lock()
+
+        self._timeout_id = None
+        self._start()
+
+        conf.connect('notify::meter-refresh-rate', self._on_refresh_rate_changed)
+
+    def _start(self):
+        self._timeout_id = GObject.timeout_add(1000 / max(1, conf.get_property('meter-refresh-rate')), self._flush)
+
+    def _on_refresh_rate_changed(self, configuration, pspec):
+        GObject.source_remove(self._timeout_id)
+        self._start()
+
+    def update(self, source, stream_id, rms, peak, decay):
+        """Store the levels of a stream, can be called from any thread"""
+        with self._lock:
+            self._snapshot.setdefault(source, {})[stream_id] = {
+                'rms': rms,
+                'peak': peak,
+                'decay': decay,
+            }
+            self._changed.add((source, stream_id,))
+
+    def remove_source(self, source):
+        with self._lock:
+            self._snapshot.pop(source, None)
+            self._changed = set([key for key in self._changed if key[0] != source])
+
+    def get_snapshot(self):
+        """Return a copy of the levels of all the streams"""
+        with self._lock:
+            return dict([(source, dict(streams)) for source, streams in self._snapshot.items()])
+
+    def _flush(self):
+        with self._lock:
+            updated = {}
+            for source, stream_id in self._changed:
+                updated.setdefault(source, {})[stream_id] = self._snapshot[source][stream_id]
+
+            self._changed.clear()
+
+        if updated:
+            self.emit('levels-updated', updated)
+
+            for source, streams in updated.items():
+                for stream_id, levels in streams.items():
+                    source.emit('level-change', stream_id, levels['rms'][0])
+
+        return True
+
+_level_meter = None
+def get_level_meter():
+    """Return the meter shared by all the sources"""
+    global _level_meter
+    if _level_meter is None:
+        _level_meter = LevelMeter()
+
+    return _level_meter
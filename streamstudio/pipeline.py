@@ -3,10 +3,18 @@
 Main classes to manage gstreamer pipelines construction.
 """
 import os
+import re
+import time
+import logging
+import weakref
+import itertools
+import threading
+import collections
 from .sslog import logger
-from .utils import flatten
+from .utils import flatten, get_thread_cpu_time
 from gi.repository import Gst, GObject
-from .conf import Configuration
+from .conf import get_configuration
+from .metering import get_level_meter
 
 print 'GObject v%s' % GObject._version
 print 'PyGObject v%s' % (
@@ -20,7 +28,16 @@ import platform; print 'python', platform.python_version()
 print Gst.version_string()
 
 
-conf = Configuration()
+conf = get_configuration()
+
+# all the pipelines alive, also the killed ones still referenced (see get_pipelines())
+_pipelines = weakref.WeakSet()
+_pipelines_lock = threading.Lock()
+
+def get_pipelines():
+    """Return a list with all the instances of BasePipeline not yet freed"""
+    with _pipelines_lock:
+        return list(_pipelines)
 
 class BasePipeline(GObject.GObject):
     """Base class to manage GStreamer pipelines.
@@ -37,6 +54,22 @@ class BasePipeline(GObject.GObject):
     to signal errors happening and the last is emitted when the pipeline is tell us
     that a window will opened to handle some video stream; intercepting it we can
     use an our window.
+
+    The pipelines not live can be seeked with seek(): the 'scrub' mode jumps to the
+    nearest keyframe (fast, used while dragging a seek bar) instead the 'accurate' one
+    decodes up to the exact position; the seeks requested while the previous one
+    is not completed are coalesced, only the last one is performed
+
+     >>> bp.seek(position, 'scrub')
+     >>> bp.seek(position, 'accurate')
+     >>> bp.set_rate(4.0)
+
+    The 'seek-done' signal is emitted with the mode and the latency (in seconds)
+    of each seek completed.
+
+    The handlers connected to the pipeline and the fill of its queues are
+    returned by get_handler_counts() and get_queue_levels() (see also the
+    diagnostics module).
     """
     __gsignals__ = {
         'error': (
@@ -49,25 +82,203 @@ class BasePipeline(GObject.GObject):
             GObject.SIGNAL_RUN_LAST,
             GObject.TYPE_NONE,
             (GObject.TYPE_OBJECT,)
-        )
+        ),
+        'seek-done': (
+            GObject.SIGNAL_RUN_LAST,
+            GObject.TYPE_NONE,
+            (GObject.TYPE_STRING, GObject.TYPE_FLOAT,)
+        ),
     }
 
+    SEEK_FLAGS = {
+        'scrub': Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT | Gst.SeekFlags.SNAP_NEAREST,
+        'accurate': Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+    }
+    # TRICKMODE is named SKIP before GStreamer 1.6
+    TRICKMODE_FLAG = getattr(Gst.SeekFlags, 'TRICKMODE', Gst.SeekFlags.SKIP)
+    # how many seek latencies are remembered for each mode
+    SEEK_HISTORY = 100
+    # seconds after which a seek not completed is considered lost
+    SEEK_TIMEOUT = 5
+    # the timestamps of the frames are the running time of their capture,
+    # see SourceController.get_end_to_end_latencies()
+    CAPTURE_TIMESTAMPS = True
+
     def __init__(self, pipeline_string):
         import sys
         Gst.init_check(sys.argv)
         GObject.GObject.__init__(self)
 
+        # handler id -> (signal name, callback) of the handlers connected to this object
+        self._handlers = {}
+
         self.pipeline_string = pipeline_string
 
+        # cached since they rarely change
+        self._duration = None
+        self._is_live = None
+
+        # (mode, position, rate, start time, seqnum) of the seek not yet
+        # completed and (mode, position, rate) of the last seek requested
+        # in the meantime
+        self._seek_in_flight = None
+        self._seek_pending = None
+        self._rate = 1.0
+        self._seek_latencies = collections.defaultdict(lambda: collections.deque(maxlen=self.SEEK_HISTORY))
+
+        # (object, handler id) of the signals connected to the elements, the
+        # closures keep this object alive until disconnected (see kill())
+        self._signal_handlers = []
+        self._bus_watched = False
+
         self._setup_pipeline()
 
+        self._conf_handler_id = conf.connect('notify', self._on_configuration_changed)
+
+        with _pipelines_lock:
+            _pipelines.add(self)
+
+    def _remember_handler(self, handler_id, name, callback):
+        self._handlers[handler_id] = (name, callback,)
+
+        return handler_id
+
+    def connect(self, name, callback, *args):
+        """Connect as usual, remembering the handler (see get_handler_counts())"""
+        return self._remember_handler(super(BasePipeline, self).connect(name, callback, *args), name, callback)
+
+    def connect_after(self, name, callback, *args):
+        return self._remember_handler(super(BasePipeline, self).connect_after(name, callback, *args), name, callback)
+
+    def connect_object(self, name, callback, obj, *args):
+        return self._remember_handler(super(BasePipeline, self).connect_object(name, callback, obj, *args), name, callback)
+
+    def connect_object_after(self, name, callback, obj, *args):
+        return self._remember_handler(super(BasePipeline, self).connect_object_after(name, callback, obj, *args), name, callback)
+
+    def disconnect(self, handler_id):
+        super(BasePipeline, self).disconnect(handler_id)
+        self._handlers.pop(handler_id, None)
+
+    handler_disconnect = disconnect
+
+    def disconnect_by_func(self, callback):
+        super(BasePipeline, self).disconnect_by_func(callback)
+        for handler_id, (name, handler_callback) in self._handlers.items():
+            if handler_callback == callback:
+                del self._handlers[handler_id]
+
+    def get_handler_counts(self):
+        """Return a dict with the number of handlers connected to each signal
+        of the pipeline and, as 'elements', the handlers connected by it to
+        its elements (disconnected by kill())"""
+        counts = collections.Counter([name for name, callback in self._handlers.values()])
+        counts['elements'] = len(self._signal_handlers)
+
+        return dict(counts)
+
+    def get_queue_levels(self):
+        """Return a dict with as key the name of each queue of the pipeline
+        and as value a dict with the buffers and milliseconds queued and the
+        fill (the highest between the buffers and the time over their limits)"""
+        levels = {}
+        for el in self.player.iterate_recurse():
+            factory = el.get_factory()
+            if factory is None or factory.get_name() != 'queue':
+                continue
+
+            max_buffers = el.get_property('max-size-buffers')
+            max_time = el.get_property('max-size-time')
+            buffers = el.get_property('current-level-buffers')
+            queued_time = el.get_property('current-level-time')
+
+            levels[el.get_name()] = {
+                'buffers': buffers,
+                'time': queued_time / float(Gst.MSECOND),
+                'fill': max(
+                    float(buffers) / max_buffers if max_buffers else 0.0,
+                    float(queued_time) / max_time if max_time else 0.0,
+                ),
+            }
+
+        return levels
+
     def _setup_bus(self):
         bus = self.player.get_bus()
         bus.enable_sync_message_emission()
         bus.add_signal_watch()
+        self._bus_watched = True
+
+        self._connect_signal(bus, 'sync-message::element', self.__cb_on_sync())
+
+        # for each message type the handler and the number of messages received
+        self._message_handlers = {}
+        self._message_counters = collections.Counter()
+
+        for message_type, handler in self._get_message_handlers().items():
+            self._register_message_handler(message_type, handler)
+
+    def _remove_bus_watch(self):
+        """Stop dispatching the messages of the bus, from now on they stay
+        queued and can be popped"""
+        if not self._bus_watched:
+            return
+
+        bus = self.player.get_bus()
+        bus.remove_signal_watch()
+        bus.disable_sync_message_emission()
+
+        self._bus_watched = False
 
-        bus.connect('sync-message::element', self.__cb_on_sync())
-        bus.connect('message', self.__cb_factory())
+    def _get_message_handlers(self):
+        """Return a dict with the handler to call for each type of message.
+
+        Only the types present here are dispatched to python, the others
+        don't leave the GStreamer's bus watch. The messages useful only for
+        debugging are subscribed only if the log level is DEBUG.
+        """
+        handlers = {
+            Gst.MessageType.ASYNC_DONE: self._on_message_async_done,
+            Gst.MessageType.DURATION_CHANGED: self._on_message_duration_changed,
+            Gst.MessageType.EOS: self._on_message_eos,
+            Gst.MessageType.ERROR: self._on_message_error,
+            Gst.MessageType.WARNING: self._on_message_warning,
+            Gst.MessageType.ELEMENT: self._on_message_element,
+        }
+
+        if logger.isEnabledFor(logging.DEBUG):
+            handlers.update({
+                Gst.MessageType.QOS: self._on_message_qos,
+                Gst.MessageType.STREAM_STATUS: self._on_message_stream_status,
+                Gst.MessageType.STATE_CHANGED: self._on_message_state_changed,
+            })
+
+        return handlers
+
+    def _register_message_handler(self, message_type, handler):
+        """Call the handler with the message for each message of the given
+        type posted on the bus (only one handler for type)"""
+        if message_type not in self._message_handlers:
+            self._connect_signal(self.player.get_bus(), 'message::%s' % Gst.message_type_get_name(message_type), self.__cb_dispatch)
+
+        self._message_handlers[message_type] = handler
+
+    def _connect_signal(self, obj, name, callback, *args):
+        """Connect the callback to a signal of an element (or of the bus) of the
+        pipeline, it will be disconnected by kill()"""
+        handler_id = obj.connect(name, callback, *args)
+        self._signal_handlers.append((obj, handler_id,))
+
+        return handler_id
+
+    def __cb_dispatch(self, bus, message):
+        self._message_counters[message.type] += 1
+        self._message_handlers[message.type](message)
+
+    def get_message_counters(self):
+        """Return a dict with the number of messages received for each type
+        (only the types with an handler are counted)"""
+        return dict([(Gst.message_type_get_name(t), count) for t, count in self._message_counters.items()])
 
     def _setup_pipeline(self):
         """Launch the pipeline and connect bus to the right signals"""
@@ -76,13 +287,77 @@ class BasePipeline(GObject.GObject):
 
         self._setup_bus()
 
+    def _on_configuration_changed(self, configuration, pspec):
+        """Called when an option of the configuration is changed, subclasses
+        can override it in order to renegotiate their caps"""
+        pass
+
+    def _on_output_configuration_changed(self, pspec, elements):
+        """Set the output caps to the given elements (capsfilter or appsrc)
+        if the changed option is one of the output ones"""
+        if pspec.name not in ('output-width', 'output-height', 'fps', 'output-format',):
+            return False
+
+        caps = Gst.Caps.from_string(conf.get_output_caps_string())
+        for el in elements:
+            el.set_property('caps', caps)
+
+        return True
+
+    def _on_message_async_done(self, message):
+        """A flushing seek is completed when the pipeline prerolls again, the
+        ASYNC_DONE message has the seqnum of the seek event"""
+        if self._seek_in_flight is None:
+            return
+
+        mode, position, rate, start, seqnum = self._seek_in_flight
+        if message.get_seqnum() != seqnum:
+            return
+
+        self._seek_in_flight = None
+
+        latency = time.time() - start
+        self._seek_latencies[mode].append(latency)
+        logger.debug('%s seek to %d completed in %.1f ms', mode, position, latency * 1000)
+
+        self.emit('seek-done', mode, latency)
+
+        if self._seek_pending is not None:
+            pending, self._seek_pending = self._seek_pending, None
+            self._do_seek(*pending)
+
+    def _on_message_duration_changed(self, message):
+        self._duration = None
+
+    def _on_message_eos(self, message):
+        logger.info('EOS for %s', message.src)
+        self._set_state(Gst.State.NULL)
+
+    def _on_message_warning(self, message):
+        logger.warning('WARNING for %s: %s', message.src, message.parse_warning())
+
+    def _on_message_qos(self, message):
+        logger.debug('qos for %s: %s', message.src, message.parse_qos())
+
+    def _on_message_stream_status(self, message):
+        logger.debug('STREAM_STATUS for %s: %s', message.src, message.parse_stream_status())
+
+    def _on_message_state_changed(self, message):
+        old_state, new_state, pending = message.parse_state_changed()
+        logger.debug('STATE_CHANGED: %s %s -> %s (pending %s)',
+            message.src, old_state.value_nick, new_state.value_nick, pending.value_nick,
+        )
+
     def _on_message_error(self, message):
-        # TODO: remove element if is a source
-        #and retry to restart the pipeline
+        # HeadlessStudio restarts its sources on the signal 'error' (see
+        # SourceSupervisor), the GUI doesn't
         err, debug = message.parse_error()
         logger.error("fatal from '%s'" % message.src.get_name())
         logger.error("%s:%s" % (err, debug))
 
+        # the seek in progress will not complete
+        self._reset_seeks()
+
         self.emit("error", err)
 
     def _on_message_element(self, message):
@@ -105,61 +380,434 @@ class BasePipeline(GObject.GObject):
         If to the constructor was passed the 'xsink_cb' then it will be called.
         """
         def on_sync_message(bus, message):
-            t = message.type
-            if message.get_structure() is None:
-                return
+            if message.has_name('prepare-window-handle'):
+                self._on_message_prepare_window_handle(message)
+            else:
+                self._on_sync_message_element(message)
 
-            message_name = message.get_structure().get_name()
+        return on_sync_message
 
+    def _on_sync_message_element(self, message):
+        """Called from the streaming thread for each element message, in order
+        to handle it without passing from the main loop"""
+        pass
 
-            if message_name == "prepare-window-handle":
-                self._on_message_prepare_window_handle(message)
+    def _set_state(self, state):
+        # without the PAUSED state no seek completes
+        if state <= Gst.State.READY:
+            self._reset_seeks()
 
-        return on_sync_message
+        result = self.player.set_state(state)
 
-    def __cb_factory(self):
-        def _cb(bus, message):
-            t = message.type
-            src = message.src
-
-            if t == Gst.MessageType.EOS:
-                logger.info('EOS for %s' % (src,))
-                self.player.set_state(Gst.State.NULL)
-            elif t == Gst.MessageType.WARNING:
-                logger.debug('WARNING for %s: %s' % (src, message.parse_warning(),))
-            elif t == Gst.MessageType.QOS:
-                logger.debug('qos for %s: %s' % (src, message.parse_qos(),))
-            elif t == Gst.MessageType.STREAM_STATUS:
-                logger.debug('STREAM_STATUS for %s: %s' % (src, message.parse_stream_status(),))
-            elif t == Gst.MessageType.STATE_CHANGED:
-                old_state, new_state, pending = message.parse_state_changed()
-                logger.debug('STATE_CHANGED: %s %s -> %s (pending %s)' %
-                    (src, old_state.value_nick, new_state.value_nick, pending.value_nick,)
-                )
-            elif t == Gst.MessageType.ELEMENT:
-                self._on_message_element(message)
-            elif t == Gst.MessageType.ERROR:
-                self._on_message_error(message)
-        return _cb
+        # only live sources don't preroll
+        if result == Gst.StateChangeReturn.NO_PREROLL:
+            self._is_live = True
+
+        return result
 
     def pause(self):
         """Set the internal gstreamer pipeline to STATE_PAUSED"""
-        self.player.set_state(Gst.State.PAUSED)
+        self._set_state(Gst.State.PAUSED)
 
     def play(self):
         """Set the internal gstreamer pipeline to STATE_PLAYING"""
-        self.player.set_state(Gst.State.PLAYING)
+        self._set_state(Gst.State.PLAYING)
+
+    def is_live(self):
+        """Tell if the pipeline has a live source (so it has no position to seek).
+        Until the pipeline answers to the latency query it's considered not live."""
+        if self._is_live is None:
+            latency = self.get_latency()
+            if latency is not None:
+                self._is_live = latency[0]
+
+        return bool(self._is_live)
+
+    def get_running_time(self):
+        """Return the running time of the pipeline (nanoseconds), None
+        if it has no clock yet"""
+        clock = self.player.get_clock()
+        if clock is None:
+            return None
+
+        return clock.get_time() - self.player.get_base_time()
+
+    def get_latency(self):
+        """Return the tuple (live, min latency, max latency), in nanoseconds, answered
+        to the latency query or None if the pipeline can't answer yet"""
+        query = Gst.Query.new_latency()
+        if not self.player.query(query):
+            return None
+
+        return query.parse_latency()
 
     def kill(self):
+        """Stop the pipeline, its streaming threads are joined, and disconnect
+        all the handlers, so that the elements are freed with this object"""
         self.player.set_state(Gst.State.PAUSED)
-        self.player.set_state(Gst.State.NULL)
+        self._set_state(Gst.State.NULL)
+
+        if self._conf_handler_id is not None:
+            conf.disconnect(self._conf_handler_id)
+            self._conf_handler_id = None
+
+        # the handlers of the bus are connected by _setup_bus()
+        self._remove_bus_watch()
+
+        for obj, handler_id in self._signal_handlers:
+            obj.disconnect(handler_id)
+
+        self._signal_handlers = []
+
+    def _attach_tee_branch(self, tee, elements):
+        """Add the elements to the pipeline, link them in the given order and
+        attach the first one to a new request pad of the tee.
+
+        Return the tee's pad, needed to detach the branch later.
+        """
+        previous = None
+        for el in elements:
+            self.player.add(el)
+            if previous is not None:
+                previous.link(el)
+            previous = el
+
+        # sync from the end so that downstream is ready when data arrives
+        for el in reversed(elements):
+            el.sync_state_with_parent()
+
+        tee_pad = tee.get_request_pad('src_%u')
+        tee_pad.link(elements[0].get_static_pad('sink'))
+
+        return tee_pad
+
+    def _detach_tee_branch(self, tee, tee_pad, elements):
+        """Unlink a branch created with _attach_tee_branch() when no data is
+        flowing through the tee's pad and then remove its elements."""
+        self._unplug(tee_pad, elements, owner=tee)
+
+    def _unplug(self, pad, elements, callback=None, owner=None):
+        """Unlink the src pad from its peer when no data is flowing through
+        it (IDLE probe), release it from the owner if it's a request pad, then
+        remove the elements from the main loop and call callback() if given.
+
+        If the pad is not linked the elements are removed immediately."""
+        def __release(pad):
+            peer = pad.get_peer()
+            if peer is not None:
+                pad.unlink(peer)
+
+            if owner is not None:
+                owner.release_request_pad(pad)
+
+        def __remove_elements():
+            self._remove_elements(elements)
+            if callback is not None:
+                callback()
+
+            return False
+
+        def __cb_idle(pad, info, user_data):
+            __release(pad)
+
+            # the state change must not happen from the streaming thread
+            GObject.idle_add(__remove_elements)
+
+            return Gst.PadProbeReturn.REMOVE
+
+        if pad.get_peer() is None:
+            __release(pad)
+            __remove_elements()
+            return
+
+        # if the pad is already idle the callback is called from here
+        pad.add_probe(Gst.PadProbeType.IDLE, __cb_idle, None)
+
+    def _remove_elements(self, elements):
+        """Stop, unlink and remove the elements from the pipeline; the
+        request pads of the tees among them are released"""
+        logger.debug('remove %s' % elements)
+
+        for el in elements:
+            el.set_state(Gst.State.NULL)
+
+        for el in elements:
+            for pad in list(el.pads):
+                peer = pad.get_peer()
+                if peer is None:
+                    continue
+
+                if pad.get_direction() == Gst.PadDirection.SRC:
+                    pad.unlink(peer)
+                else:
+                    peer.unlink(pad)
+
+            if el.__gtype__.name == 'GstTee':
+                for pad in list(el.srcpads):
+                    el.release_request_pad(pad)
+
+            if el.get_parent() is not None:
+                self.player.remove(el)
+
+    def _insert_after(self, element, elements):
+        """Insert the given elements between element and its downstream peer,
+        blocking the data flow while relinking."""
+        def __cb_blocked(pad, info, user_data):
+            peer = pad.get_peer()
+            pad.unlink(peer)
+
+            for el in elements:
+                self.player.add(el)
+
+            chain = [element] + elements
+            for upstream, downstream in zip(chain, chain[1:]):
+                upstream.link(downstream)
+
+            elements[-1].get_static_pad('src').link(peer)
+
+            for el in reversed(elements):
+                el.sync_state_with_parent()
+
+            return Gst.PadProbeReturn.REMOVE
+
+        element.get_static_pad('src').add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, __cb_blocked, None)
+
+    def _link_inter_video_src(self, channel, sink_pad):
+        """Add to the pipeline an intervideosrc reading from the given channel
+        and link it to the given (request) pad. Return the elements added."""
+        src = Gst.ElementFactory.make('intervideosrc', None)
+        src.set_property('channel', channel)
+        queue = Gst.ElementFactory.make('queue', None)
+
+        self.player.add(src)
+        self.player.add(queue)
+        src.link(queue)
+
+        queue.get_static_pad('src').link(sink_pad)
+
+        queue.sync_state_with_parent()
+        src.sync_state_with_parent()
+
+        return [src, queue]
+
+    def _link_inter_audio_src(self, channel, sink_pad):
+        """Add an interaudiosrc reading from the given channel, converted
+        to AUDIO_PROGRAM_CAPS, and link it to the given (request) pad.
+        Return the elements added."""
+        capsfilter = Gst.ElementFactory.make('capsfilter', None)
+        capsfilter.set_property('caps', Gst.Caps.from_string(AUDIO_PROGRAM_CAPS))
+
+        src = Gst.ElementFactory.make('interaudiosrc', None)
+        src.set_property('channel', channel)
+
+        elements = [
+            src,
+            Gst.ElementFactory.make('audioconvert', None),
+            Gst.ElementFactory.make('audioresample', None),
+            capsfilter,
+            Gst.ElementFactory.make('queue', None),
+        ]
+
+        for el in elements:
+            self.player.add(el)
+
+        for upstream, downstream in zip(elements, elements[1:]):
+            upstream.link(downstream)
+
+        elements[-1].get_static_pad('src').link(sink_pad)
+
+        for el in reversed(elements):
+            el.sync_state_with_parent()
+
+        return elements
+
+    def _unlink_inter_src(self, elements, owner, sink_pad):
+        """Remove the elements created by _link_inter_video_src() or
+        _link_inter_audio_src() and release the request pad from its owner,
+        waiting that no buffer is being pushed into it"""
+        def __release():
+            owner.release_request_pad(sink_pad)
+
+        self._unplug(elements[-1].get_static_pad('src'), elements, __release)
 
     def get_position(self):
         return self.player.query_position(Gst.Format.TIME)[1]
 
     def get_duration(self):
-        return self.player.query_duration(Gst.Format.TIME)[1]
+        """Return the duration, queried only the first time and after
+        a DURATION_CHANGED message"""
+        if self._duration is None:
+            result, duration = self.player.query_duration(Gst.Format.TIME)
+            if not result:
+                return -1
+
+            self._duration = duration
+
+        return self._duration
+
+    def seek(self, position, mode='accurate'):
+        """Seek to the position (in nanoseconds) using one of the SEEK_FLAGS modes.
+
+        If a seek is already in progress this one is performed when it
+        completes, replacing the ones requested in the meantime. Return False
+        if the pipeline is live.
+        """
+        if mode not in self.SEEK_FLAGS:
+            raise ValueError('unknown seek mode \'%s\'' % mode)
+
+        if self.is_live():
+            return False
 
+        if self._seek_in_flight is not None and time.time() - self._seek_in_flight[3] > self.SEEK_TIMEOUT:
+            logger.warning('%s seek to %d of %s not completed, ignoring it', self._seek_in_flight[0], self._seek_in_flight[1], self)
+            self._reset_seeks()
+
+        if self._seek_in_flight is not None:
+            self._seek_pending = (mode, position, self._rate,)
+            return True
+
+        return self._do_seek(mode, position, self._rate)
+
+    def set_rate(self, rate):
+        """Play at the given rate from the current position: with a rate
+        different from 1.0 only the keyframes are decoded, if the demuxer
+        supports the trick modes; negative values play backward"""
+        if rate == 0:
+            raise ValueError('the rate can\'t be zero')
+
+        self._rate = rate
+
+        return self.seek(self.get_position(), 'accurate' if rate == 1.0 else 'scrub')
+
+    def get_rate(self):
+        return self._rate
+
+    def _do_seek(self, mode, position, rate):
+        flags = self.SEEK_FLAGS[mode]
+        if rate != 1.0:
+            flags |= self.TRICKMODE_FLAG
+
+        # playing backward the segment ends at the position
+        if rate > 0:
+            start_type, start, stop_type, stop = Gst.SeekType.SET, position, Gst.SeekType.NONE, -1
+        else:
+            start_type, start, stop_type, stop = Gst.SeekType.SET, 0, Gst.SeekType.SET, position
+
+        event = Gst.Event.new_seek(rate, Gst.Format.TIME, flags, start_type, start, stop_type, stop)
+        self._seek_in_flight = (mode, position, rate, time.time(), event.get_seqnum(),)
+
+        if not self.player.send_event(event):
+            logger.warning('%s seek to %d failed for %s', mode, position, self)
+            self._seek_in_flight = None
+            return False
+
+        return True
+
+    def _reset_seeks(self):
+        """Forget the seek in progress and the pending one"""
+        self._seek_in_flight = None
+        self._seek_pending = None
+
+    def get_seek_stats(self):
+        """Return a dict with, for each seek mode used, a dict with the number
+        of the last seeks remembered and their min/mean/max latency in seconds"""
+        stats = {}
+        for mode, latencies in self._seek_latencies.items():
+            if not latencies:
+                continue
+
+            stats[mode] = {
+                'count': len(latencies),
+                'min': min(latencies),
+                'mean': sum(latencies) / len(latencies),
+                'max': max(latencies),
+            }
+
+        return stats
+
+
+# descriptions of the sinks usable by the output pipelines; the values
+# between %(...)s are taken from the options of the sink specification
+OUTPUT_SINKS = {
+    'display': 'xvimagesink sync=false',
+    'fake': 'fakesink sync=false',
+    'matroska-x264': 'videoconvert ! x264enc tune=zerolatency speed-preset=%(preset)s ! h264parse ! matroskamux name=%(mux)s ! filesink location=%(location)s',
+    'mp4-x264': 'videoconvert ! x264enc tune=zerolatency speed-preset=%(preset)s ! h264parse ! mp4mux name=%(mux)s ! filesink location=%(location)s',
+    'matroska-vp8': 'videoconvert ! vp8enc deadline=1 ! matroskamux name=%(mux)s ! filesink location=%(location)s',
+    'ogg-theora': 'videoconvert ! theoraenc ! oggmux name=%(mux)s ! filesink location=%(location)s',
+    'tcp': 'videoconvert ! x264enc tune=zerolatency speed-preset=%(preset)s ! h264parse ! mpegtsmux name=%(mux)s ! tcpserversink host=%(host)s port=%(port)s sync=false',
+    'udp': 'videoconvert ! x264enc tune=zerolatency speed-preset=%(preset)s ! h264parse ! mpegtsmux name=%(mux)s ! udpsink host=%(host)s port=%(port)s sync=false',
+    'rtp': 'videoconvert ! x264enc tune=zerolatency speed-preset=%(preset)s ! rtph264pay config-interval=1 pt=96 ! udpsink host=%(host)s port=%(port)s sync=false',
+    'shm': 'shmsink socket-path=%(location)s wait-for-connection=false sync=false',
+}
+
+# audio encoders of the sinks having a muxer, where the audio program goes
+# together with the video (see the 'audio-program' option)
+OUTPUT_AUDIO_ENCODERS = {
+    'matroska-x264': 'vorbisenc',
+    'mp4-x264': 'avenc_aac',
+    'matroska-vp8': 'vorbisenc',
+    'ogg-theora': 'vorbisenc',
+    'tcp': 'avenc_aac',
+    'udp': 'avenc_aac',
+}
+
+OUTPUT_SINKS_DEFAULTS = {
+    'preset': 'ultrafast',
+    'host': '127.0.0.1',
+    'port': '5000',
+}
+
+# the options set by the output pipeline itself
+_OUTPUT_SINKS_INTERNAL = ('mux',)
+
+def parse_output_sink(spec):
+    """Parse a sink specification like 'rtp:host=10.0.0.1,port=5004' and
+    return the kind of sink and a dict with its options, the options without
+    default (like the 'location' of the files) are required"""
+    kind, _, args = spec.partition(':')
+    if kind not in OUTPUT_SINKS:
+        raise AttributeError('unknown output sink \'%s\'' % kind)
+
+    options = dict(OUTPUT_SINKS_DEFAULTS)
+    for arg in filter(None, args.split(',')):
+        key, _, value = arg.partition('=')
+        options[key.strip()] = value.strip()
+
+    for key in re.findall(r'%\((\w+)\)s', OUTPUT_SINKS[kind]):
+        if key not in options and key not in _OUTPUT_SINKS_INTERNAL:
+            raise AttributeError('output sink \'%s\' needs the option \'%s\'' % (kind, key,))
+
+    if 'location' in options:
+        options['location'] = _quote_spaces(options['location'])
+
+    return kind, options
+
+def get_output_sinks():
+    """Return the sink specifications from the configuration, by default
+    the display (or nothing in headless mode)"""
+    specs = [spec.strip() for spec in conf.get_property('output-sinks').split(';') if spec.strip()]
+    if not specs:
+        specs = ['fake' if conf.get_property('headless') else 'display']
+
+    return specs
+
+# format of the audio mixed into the outputs
+AUDIO_PROGRAM_CAPS = 'audio/x-raw,format=(string)S16LE,layout=(string)interleaved,rate=(int)48000,channels=(int)2'
+
+# settings of the sources changing the defaults from the configuration:
+# 'low' keeps few leaky buffers in the queues and doesn't sync the monitors
+LATENCY_PROFILES = {
+    'default': {},
+    'low': {
+        'queue-max-buffers': 2,
+        'queue-max-time': 0,
+        'queue-leaky': 2,# downstream
+        'appsink-max-buffers': 1,
+        'appsink-drop': True,
+        'sync': False,
+    },
+}
 
 def _quote_spaces(location):
     return location.replace(' ', '\ ').replace('(', '\(').replace(')', '\)')
@@ -177,6 +825,9 @@ class PadPipeline(BasePipeline):
     the default elements added to the pipeline are not enough for their purposes.
 
     When no more streams are present the signal 'no-more-streams' is emitted.
+
+    A stream can be removed while the pipeline runs with remove_stream(), then
+    the signal 'stream-removed' is emitted (from the main loop).
     """
     __gsignals__ = {
         'stream-added': (
@@ -184,6 +835,11 @@ class PadPipeline(BasePipeline):
             GObject.TYPE_NONE,
             (GObject.TYPE_STRING, GObject.TYPE_INT,)
         ),
+        'stream-removed': (
+            GObject.SIGNAL_RUN_LAST,
+            GObject.TYPE_NONE,
+            (GObject.TYPE_STRING, GObject.TYPE_INT,)
+        ),
         'no-more-streams': (
             GObject.SIGNAL_RUN_LAST,
             GObject.TYPE_NONE,
@@ -206,6 +862,10 @@ class PadPipeline(BasePipeline):
 
         self._video_source_counter = 0
         self._video_elements = []
+        self._video_pad_caps = None
+
+        # element -> (stream type, stream id) of all the elements of the streams
+        self._element_index = {}
 
     def _build_pipeline_string(self):
             return 'filesrc location=%s ! decodebin name=demux' % (
@@ -221,8 +881,8 @@ class PadPipeline(BasePipeline):
         self.audio_queue = self.player.get_by_name('audio_queue')
         self.audiosink = self.player.get_by_name('audiosink')
 
-        self.decode.connect("pad-added", self._on_dynamic_pad)
-        self.decode.connect("no-more-pads", self._on_no_more_pads)
+        self._connect_signal(self.decode, "pad-added", self._on_dynamic_pad)
+        self._connect_signal(self.decode, "no-more-pads", self._on_no_more_pads)
 
         #self.player.set_state(Gst.State.PAUSED)
 
@@ -249,6 +909,19 @@ class PadPipeline(BasePipeline):
 
         self.emit('prepare-video-stream-sink', imagesink, stream_id)
 
+    def _make_closed_valve(self):
+        """Return a valve dropping the buffers but not the sticky events
+        (caps, segment...), so that the branch after it is negotiated while
+        closed. The 'drop-mode' is available from GStreamer 1.20, before the
+        branch is negotiated by the first frame let through."""
+        valve = Gst.ElementFactory.make('valve', None)
+        valve.set_property('drop', True)
+        if valve.find_property('drop-mode') is not None:
+            # GST_VALVE_DROP_MODE_FORWARD_STICKY_EVENTS
+            valve.set_property('drop-mode', 1)
+
+        return valve
+
     def _get_video_branch(self):
         """Return a list of element to link in the given order. The last one
         is to link with the pad.
@@ -322,6 +995,9 @@ class PadPipeline(BasePipeline):
     def _on_video_dynamic_pad(self, dbin, pad):
         logger.debug('video pad detected')
 
+        # the caps are made available to _get_video_branch()
+        self._video_pad_caps = pad.get_current_caps() or pad.query_caps(None)
+
         elements = self._get_video_branch()
         sink = self._build_branches(elements)
 
@@ -333,6 +1009,7 @@ class PadPipeline(BasePipeline):
 
         self._video_source_counter += 1
         self._video_elements.append(list(flatten(elements)))
+        self._index_stream_elements('video', self._video_source_counter, self._video_elements[-1])
 
         self.emit('stream-added', 'video', self._video_source_counter - 1)
 
@@ -349,25 +1026,84 @@ class PadPipeline(BasePipeline):
 
         self._audio_source_counter += 1
         self._audio_elements.append(list(flatten(elements)))
+        self._index_stream_elements('audio', self._audio_source_counter, self._audio_elements[-1])
 
         self.emit('stream-added', 'audio', self._audio_source_counter - 1)
 
+    def _index_stream_elements(self, stream_type, stream_id, elements):
+        """Remember that the elements belong to the given stream"""
+        for el in elements:
+            if isinstance(el, Gst.Element):
+                self._element_index[el] = (stream_type, stream_id,)
+
+    def _unindex_stream_elements(self, stream_type, stream_id):
+        """Forget the elements of a stream that is going to be removed"""
+        for el, key in self._element_index.items():
+            if key == (stream_type, stream_id,):
+                del self._element_index[el]
+
+    def remove_stream(self, stream_type, stream_id):
+        """Unplug the branches of a stream (the stream id is the one of the
+        'stream-added' signal) while the pipeline is running.
+
+        The decoder's pad is unlinked when no buffer is passing through it,
+        then its buffers are discarded; the elements of the branches are
+        stopped and removed from the main loop.
+        """
+        streams = {'video': self._video_elements, 'audio': self._audio_elements}.get(stream_type)
+        if streams is None or not 0 <= stream_id < len(streams) or streams[stream_id] is None:
+            raise AttributeError('no %s stream with id %d' % (stream_type, stream_id,))
+
+        elements = streams[stream_id]
+        streams[stream_id] = None
+
+        elements = elements + self._forget_stream(stream_type, stream_id)
+        sink_pad = elements[0].get_static_pad('sink')
+
+        def __remove_elements():
+            self._remove_elements(elements)
+            self._unindex_stream_elements(stream_type, stream_id + 1)
+
+            self.emit('stream-removed', stream_type, stream_id)
+
+            return False
+
+        def __cb_drop(pad, info, user_data):
+            return Gst.PadProbeReturn.DROP
+
+        def __cb_idle(pad, info, user_data):
+            pad.unlink(sink_pad)
+            # an unlinked pad would make the decoder fail as not-linked
+            pad.add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST, __cb_drop, None)
+
+            GObject.idle_add(__remove_elements)
+
+            return Gst.PadProbeReturn.REMOVE
+
+        decoder_pad = sink_pad.get_peer()
+        if decoder_pad is None:
+            __remove_elements()
+        else:
+            decoder_pad.add_probe(Gst.PadProbeType.IDLE, __cb_idle, None)
+
+    def _forget_stream(self, stream_type, stream_id):
+        """Called when a stream is removed, subclasses drop here what they
+        keep about it; return the elements attached later to its branches,
+        that must be removed with them"""
+        return []
+
     def _get_stream_id_from_element(self, element):
-        """Tell us at what stream the element passed as argument belongs"""
-        count = 0
-        for stream_elements in self._video_elements:
-            count += 1
-            if element in stream_elements:
-                return ('video', count,)
-
-        count = 0
-        for stream_elements in self._audio_elements:
-            count += 1
-            if element in stream_elements:
-                return ('audio', count,)
-
-        print self._audio_elements
-        print self._video_elements
+        """Tell us at what stream the element passed as argument belongs,
+        the id returned is 1-based.
+
+        If the element is not one of ours (like the actual sink inside
+        an autovideosink) its parents are tried.
+        """
+        while element is not None:
+            try:
+                return self._element_index[element]
+            except KeyError:
+                element = element.get_parent()
 
         return (None, None,)
 
@@ -379,7 +1115,7 @@ class StreamStudioSource(PadPipeline):
     resource associated with a appsink element
     """
     __gsignals__ = {
-        'level-change': (# when the audio level change
+        'level-change': (# when the audio level change (at the rate of the meter)
             GObject.SIGNAL_RUN_LAST,
             GObject.TYPE_NONE,
             (GObject.TYPE_INT, GObject.TYPE_FLOAT,)
@@ -395,27 +1131,81 @@ class StreamStudioSource(PadPipeline):
             (GObject.TYPE_OBJECT,)
         ),
     }
-    WIDTH = 320
-    HEIGHT = 200
-    FRAMERATE = 10
+    CONVERSIONS = ('videoscale', 'videorate', 'videoconvert',)
+    PREVIEW_MODES = ('off', 'thumbnail', 'full',)
+    # the sources capturing in real time, that use the 'low' latency
+    # profile when the 'latency-profile' option is 'auto'
+    LIVE = False
 
     def __init__(self, *args):
         super(StreamStudioSource, self).__init__(*args)
 
         self._volumes = {}
+        # tees after the volume of each audio stream and the branches
+        # attached to them by enable_audio_bridge()
+        self._audio_program_tees = {}
+        self._audio_bridges = {}
+
+        # tees at the start of each audio stream, where the taps are attached,
+        # and for each tap (handle) the stream id, the branch and the counters
+        self._audio_tees = {}
+        self._audio_taps = {}
+        self._audio_tap_handles = itertools.count()
+
+        # elements that must follow the configuration, indexed by video stream id
+        self._video_tees = {}
+        self._video_caps = {}
+        self._output_valves = {}
+        self._output_capsfilters = {}
+        self._preview_capsfilters = {}
+        self._preview_videorates = {}
+
+        # frames shown and seconds spent in the preview branch of each video stream
+        self._preview_counters = {}
+        self._preview_rate = conf.get_property('preview-fps')
+
+        # the tee, valve and appsink of the last video stream, used by
+        # block() and enable_video_bridge()
+        self._video_tee = None
+        self._video_valve = None
+        self._video_app_sink = None
+        self._output_app_sinks = {}
 
         self._video_tee_probe_id = None
 
-    def _on_message_element(self, message):
-        super(StreamStudioSource, self)._on_message_element(message)
+        # (tee's pad, elements) of the branch created by enable_video_bridge()
+        self._video_bridge = None
 
-        if message.get_structure().get_name() == 'level':
+        self._elided_conversions = {}
+
+    def _get_message_handlers(self):
+        """The element messages (the levels) are handled synchronously"""
+        handlers = super(StreamStudioSource, self)._get_message_handlers()
+        del handlers[Gst.MessageType.ELEMENT]
+
+        return handlers
+
+    def _on_sync_message_element(self, message):
+        """Store the levels of all the channels into the shared meter, that
+        notifies them at its own rate"""
+        if message.has_name('level'):
             tipe, count = self._get_stream_id_from_element(message.src)
-            rms = message.get_structure().get_value('rms')[0]
-            peak = message.get_structure().get_value('peak')[0]
-            decay = message.get_structure().get_value('decay')[0]
+            # a stream being removed is not indexed anymore
+            if count is None:
+                return
+
+            structure = message.get_structure()
+
+            get_level_meter().update(self, count - 1,
+                list(structure.get_value('rms')),
+                list(structure.get_value('peak')),
+                list(structure.get_value('decay')),
+            )
 
-            self.emit('level-change', count - 1, rms)
+    def kill(self):
+        super(StreamStudioSource, self).kill()
+
+        get_level_meter().remove_source(self)
 
     def set_volume_for_stream(self, stream_id, value):
         self._volumes[stream_id].set_property('volume', value)
@@ -426,97 +1216,580 @@ class StreamStudioSource(PadPipeline):
         """
         volume = Gst.ElementFactory.make('volume', None)
         self._volumes[self._audio_source_counter] = volume
+
+        # the audio for the program is taken after the volume, so it's the gain
+        program_tee = Gst.ElementFactory.make('tee', None)
+        self._audio_program_tees[self._audio_source_counter] = program_tee
+
+        # the taps get the audio before the volume (see add_audio_tap())
+        tee = Gst.ElementFactory.make('tee', None)
+        self._audio_tees[self._audio_source_counter] = tee
+
+        level = Gst.ElementFactory.make('level', None)
+        level.set_property('interval', conf.get_property('level-interval') * Gst.MSECOND)
+
+        if conf.get_property('headless'):
+            # the level element needs a sink also without audio output
+            audiosink = Gst.ElementFactory.make('fakesink', None)
+            audiosink.set_property('sync', True)
+        else:
+            audiosink = Gst.ElementFactory.make('autoaudiosink', None)
+
         return [
-            Gst.ElementFactory.make('tee', None), [
+            tee, [
                 [
-                    Gst.ElementFactory.make('queue', None),
+                    self._make_queue(),
                     volume,
-                    Gst.ElementFactory.make('level', None),
-                    Gst.ElementFactory.make('autoaudiosink', None),
+                    level,
+                    program_tee, [
+                        [self._make_queue(), audiosink,],
+                    ],
                 ],
-                [Gst.ElementFactory.make('queue', None), Gst.ElementFactory.make('appsink', None),],
             ]
         ]
 
+    def get_audio_stream_ids(self):
+        return sorted(self._volumes.keys())
+
+    def add_audio_tap(self, callback, stream_id=0):
+        """Call callback(sample) from the streaming thread for each audio sample
+        of the stream (before its volume). Return the handle to use with
+        remove_audio_tap().
+
+        The branch feeding the tap exists only while subscribed; if the callback
+        is slower than the audio, the oldest samples are dropped, so a tap
+        never holds more than 'audio-tap-max-buffers' buffers.
+        """
+        max_buffers = conf.get_property('audio-tap-max-buffers')
+
+        queue = Gst.ElementFactory.make('queue', None)
+        queue.set_property('leaky', 2)# downstream
+        queue.set_property('max-size-buffers', max_buffers)
+        queue.set_property('max-size-bytes', 0)
+        queue.set_property('max-size-time', 0)
+
+        appsink = Gst.ElementFactory.make('appsink', None)
+        appsink.set_property('max-buffers', 1)
+        appsink.set_property('drop', True)
+        appsink.set_property('sync', False)
+        appsink.set_property('emit-signals', True)
+
+        handle = next(self._audio_tap_handles)
+        counters = {'buffers': 0, 'bytes': 0, 'dropped': 0, 'max-buffer-size': 0}
+
+        def __cb_new_sample(appsink, counters):
+            sample = appsink.emit('pull-sample')
+
+            size = sample.get_buffer().get_size()
+            counters['buffers'] += 1
+            counters['bytes'] += size
+            counters['max-buffer-size'] = max(counters['max-buffer-size'], size)
+
+            callback(sample)
+
+            return Gst.FlowReturn.OK
+
+        def __cb_overrun(queue, counters):
+            counters['dropped'] += 1
+
+        appsink.connect('new-sample', __cb_new_sample, counters)
+        queue.connect('overrun', __cb_overrun, counters)
+
+        elements = [queue, appsink]
+        tee_pad = self._attach_tee_branch(self._audio_tees[stream_id], elements)
+
+        self._audio_taps[handle] = (stream_id, tee_pad, elements, counters,)
+
+        return handle
+
+    def remove_audio_tap(self, handle):
+        stream_id, tee_pad, elements, counters = self._audio_taps.pop(handle)
+
+        self._detach_tee_branch(self._audio_tees[stream_id], tee_pad, elements)
+
+    def get_audio_tap_stats(self):
+        """Return a dict with as key the handle of each tap and as value a dict
+        with the buffers and bytes delivered, the overruns of its queue and
+        the memory held now and at most (estimated from the largest buffer)"""
+        stats = {}
+        for handle, (stream_id, tee_pad, elements, counters) in self._audio_taps.items():
+            queue, appsink = elements
+            # the queue plus the buffer waiting into the appsink
+            max_buffers = queue.get_property('max-size-buffers') + 1
+
+            stats[handle] = {
+                'stream-id': stream_id,
+                'buffers': counters['buffers'],
+                'bytes': counters['bytes'],
+                'overruns': counters['dropped'],
+                'queued-bytes': queue.get_property('current-level-bytes'),
+                'max-bytes': max_buffers * counters['max-buffer-size'],
+            }
+
+        return stats
+
+    def get_audio_bridge_channel(self, stream_id=0):
+        """Return the name of the channel used to share the audio of the stream
+        with other pipelines via the inter* elements"""
+        return 'streamstudio-audio-%x-%d' % (id(self), stream_id,)
+
+    def enable_audio_bridge(self, stream_id=0):
+        """Make the audio of the stream, after its volume, available to other
+        pipelines: an interaudiosrc with the channel returned by
+        get_audio_bridge_channel() will receive it."""
+        if stream_id in self._audio_bridges:
+            return self.get_audio_bridge_channel(stream_id)
+
+        queue = self._make_queue()
+        queue.set_property('leaky', 2)# downstream
+
+        sink = Gst.ElementFactory.make('interaudiosink', None)
+        sink.set_property('channel', self.get_audio_bridge_channel(stream_id))
+
+        elements = [queue, Gst.ElementFactory.make('audioconvert', None), sink]
+        tee = self._audio_program_tees[stream_id]
+        self._audio_bridges[stream_id] = (self._attach_tee_branch(tee, elements), elements)
+
+        return self.get_audio_bridge_channel(stream_id)
+
+    def disable_audio_bridge(self, stream_id=0):
+        if stream_id not in self._audio_bridges:
+            return
+
+        tee_pad, elements = self._audio_bridges.pop(stream_id)
+        self._detach_tee_branch(self._audio_program_tees[stream_id], tee_pad, elements)
+
+    def _on_message_eos(self, message):
+        """A live stream doesn't end: its end is a failure (like a server
+        closing the connection) and is notified with 'error', so that the
+        source can be restarted (see SourceSupervisor)"""
+        super(StreamStudioSource, self)._on_message_eos(message)
+
+        if self.LIVE:
+            self.emit('error', 'end of stream of a live source')
+
+    def _get_latency_profile(self):
+        """Return the settings of the latency profile chosen in the configuration"""
+        name = conf.get_property('latency-profile')
+        if name == 'auto':
+            name = 'low' if self.LIVE else 'default'
+
+        if name not in LATENCY_PROFILES:
+            logger.warning('unknown latency profile \'%s\', using \'default\'', name)
+            name = 'default'
+
+        return LATENCY_PROFILES[name]
+
+    def _get_tunable(self, name):
+        """Return the value from the latency profile, if present, otherwise
+        from the configuration"""
+        return self._get_latency_profile().get(name, conf.get_property(name))
+
+    def _make_queue(self):
+        """Return a queue sized following the configuration and the latency profile"""
+        queue = Gst.ElementFactory.make('queue', None)
+        queue.set_property('max-size-buffers', self._get_tunable('queue-max-buffers'))
+        queue.set_property('max-size-time', self._get_tunable('queue-max-time') * Gst.MSECOND)
+
+        leaky = self._get_latency_profile().get('queue-leaky')
+        if leaky is not None:
+            queue.set_property('leaky', leaky)
+
+        return queue
+
+    def _make_converter(self, name):
+        """Return a videoscale/videoconvert/videorate element using the
+        configured number of threads (where supported)"""
+        element = Gst.ElementFactory.make(name, None)
+        if element.find_property('n-threads') is not None:
+            element.set_property('n-threads', conf.get_property('threads'))
+
+        return element
+
     def _get_video_branch(self):
         """Return a list of element to link in the given order. The first one
         is the tee to link with the pad that can be used later for other.
         """
+        stream_id = self._video_source_counter
+
         self._video_tee = Gst.ElementFactory.make('tee', None)
-        filtr = Gst.Caps.from_string('video/x-raw,width=(int)%d,height=(int)%d,framerate=(fraction)%d/1' % 
-            (self.WIDTH, self.HEIGHT, self.FRAMERATE)
-        )
-        filtr_sink = Gst.Caps.from_string('video/x-raw,width=(int)%d,height=(int)%d,framerate=(fraction)%d/1,format=(string)RGB16' %
-            (conf.get_output_width(), conf.get_output_height(), conf.get_fps())
-        )
 
-        xvimagesink = Gst.ElementFactory.make('xvimagesink', None)
+        output_capsfilter = Gst.ElementFactory.make('capsfilter', None)
+        output_capsfilter.set_property('caps', Gst.Caps.from_string(conf.get_output_caps_string()))
+
+        output_queue = self._make_queue()
 
         self._video_app_sink = Gst.ElementFactory.make('appsink', None)
-        self._video_app_sink.set_property('max-buffers', 2)
-        self._video_app_sink.set_property('drop', True)
+        self._video_app_sink.set_property('max-buffers', self._get_tunable('appsink-max-buffers'))
+        self._video_app_sink.set_property('drop', self._get_tunable('appsink-drop'))
+        # a reference kept to the last sample would make the overlay of the
+        # output copy the frame (see SourceController.get_bytes_copied())
+        self._video_app_sink.set_property('enable-last-sample', False)
+
+        # the output branch is closed until the video is requested with
+        # enable_video_src(), so the idle sources don't convert frames
+        self._video_valve = self._make_closed_valve()
+
+        self._video_tees[stream_id] = self._video_tee
+        self._video_caps[stream_id] = self._video_pad_caps
+        self._output_capsfilters[stream_id] = output_capsfilter
+        self._output_valves[stream_id] = self._video_valve
+        self._output_app_sinks[stream_id] = self._video_app_sink
+
+        branches = [
+            [output_queue, self._video_valve] +
+            self._get_output_conversion(stream_id) + [
+                output_capsfilter,
+                self._video_app_sink,
+            ],
+        ]
 
-        self._video_valve = Gst.ElementFactory.make('valve', None)
+        # without display there is no reason to scale the video for the monitor
+        if not conf.get_property('headless') and self._get_preview_mode() != 'off':
+            branches.insert(0, self._get_preview_branch(stream_id))
 
-        return [
-            self._video_tee, [
-                [
-                    Gst.ElementFactory.make('queue', None),
-                    Gst.ElementFactory.make('videoscale', None),
-                    Gst.ElementFactory.make('videorate', None),
-                    filtr,
-                    xvimagesink,
-                ],
-                [
-                    Gst.ElementFactory.make('queue', None),
-                    Gst.ElementFactory.make('videoscale', None),
-                    Gst.ElementFactory.make('videorate', None),
-                    Gst.ElementFactory.make('videoconvert', None),
-                    filtr_sink,
-                    self._video_valve,
-                    self._video_app_sink,
-                ],
-            ]
-        ]
+        return [self._video_tee, branches]
 
-    def _remove_elements(self, elements):
-        """Utility method that detach elements from the pipeline"""
-        # TODO: set the elements to NULL
-        logger.debug('remove %s' % elements)
+    def _get_preview_mode(self):
+        mode = conf.get_property('preview-mode')
+        if mode not in self.PREVIEW_MODES:
+            logger.warning('unknown preview mode \'%s\', using \'thumbnail\'', mode)
+            mode = 'thumbnail'
 
-        for el in elements:
-            el.set_state(Gst.State.NULL)
-            self.player.remove(el)
+        return mode
+
+    def _get_preview_branch(self, stream_id):
+        """Return the elements showing the video stream into the monitor.
+
+        The frames exceeding the preview rate are dropped before scaling them;
+        the 'thumbnail' mode scales with the nearest neighbour, the 'full' one
+        leaves the scaling to the video sink.
+        """
+        queue = self._make_queue()
+
+        videorate = self._make_converter('videorate')
+        videorate.set_property('max-rate', self._preview_rate)
+        self._preview_videorates[stream_id] = videorate
+
+        sink = Gst.ElementFactory.make('xvimagesink', None)
+        sink.set_property('sync', self._get_latency_profile().get('sync', True))
+
+        elements = [queue, videorate]
+
+        if self._get_preview_mode() == 'thumbnail':
+            videoscale = self._make_converter('videoscale')
+            videoscale.set_property('method', 0)# nearest-neighbour
+
+            preview_capsfilter = Gst.ElementFactory.make('capsfilter', None)
+            preview_capsfilter.set_property('caps', Gst.Caps.from_string(conf.get_preview_caps_string()))
+
+            self._preview_capsfilters[stream_id] = preview_capsfilter
+
+            elements += [videoscale, preview_capsfilter]
+
+        self._count_preview_time(stream_id, queue, sink)
+
+        return elements + [sink]
+
+    def _count_preview_time(self, stream_id, queue, sink):
+        """Measure the preview of the stream: the branch after the queue runs
+        in its own thread, so the CPU used by that thread between the frames
+        leaving the queue is the CPU of the preview; the wall time between the
+        queue and the sink is its 'busy' time (the frames dropped by the
+        videorate are not counted)"""
+        counters = {'frames': 0, 'busy': 0.0, 'cpu': 0.0, 'since': time.time(), 'start': None, 'thread-cpu': None}
+        self._preview_counters[stream_id] = counters
+
+        def __cb_start(pad, info, counters):
+            counters['start'] = time.time()
+
+            cpu = get_thread_cpu_time()
+            if cpu is not None and counters['thread-cpu'] is not None:
+                counters['cpu'] += cpu - counters['thread-cpu']
+            counters['thread-cpu'] = cpu
+
+            return Gst.PadProbeReturn.OK
+
+        def __cb_end(pad, info, counters):
+            if counters['start'] is not None:
+                counters['busy'] += time.time() - counters['start']
+                counters['frames'] += 1
+
+            return Gst.PadProbeReturn.OK
+
+        queue.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, __cb_start, counters)
+        sink.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, __cb_end, counters)
+
+    def get_preview_stats(self):
+        """Return a dict with as key the video stream id and as value a dict with
+        the frames/s shown, the fraction of a CPU used by the thread of its
+        preview ('cpu', None if the system doesn't measure it) and the fraction
+        of the wall time the frames spent into the preview ('busy', it includes
+        the waits) since the last call"""
+        now = time.time()
+
+        stats = {}
+        for stream_id, counters in self._preview_counters.items():
+            elapsed = now - counters['since']
+
+            stats[stream_id] = {
+                'fps': counters['frames'] / elapsed if elapsed > 0 else 0.0,
+                'cpu': counters['cpu'] / elapsed if elapsed > 0 and counters['thread-cpu'] is not None else None,
+                'busy': counters['busy'] / elapsed if elapsed > 0 else 0.0,
+                'rate': self._preview_rate,
+            }
+
+            counters['frames'] = 0
+            counters['busy'] = 0.0
+            counters['cpu'] = 0.0
+            counters['since'] = now
+
+        return stats
+
+    def set_preview_rate(self, rate):
+        """Limit the framerate of the monitors, without renegotiating"""
+        rate = max(1, rate)
+        if rate == self._preview_rate:
+            return
+
+        self._preview_rate = rate
+        for videorate in self._preview_videorates.values():
+            videorate.set_property('max-rate', rate)
+
+    def get_preview_rate(self):
+        return self._preview_rate
+
+    def _get_needed_conversions(self, caps):
+        """Return the names of the elements needed to bring a video with the given
+        caps to the output format, size and framerate"""
+        if caps is None or not caps.is_fixed():
+            return list(self.CONVERSIONS)
+
+        structure = caps.get_structure(0)
+        result, num, den = structure.get_fraction('framerate')
+
+        needed = {
+            'videoconvert': structure.get_value('format') != conf.get_output_format(),
+            'videoscale': (structure.get_value('width'), structure.get_value('height')) != (
+                conf.get_output_width(), conf.get_output_height(),
+            ),
+            'videorate': not result or (num, den) != (conf.get_fps(), 1),
+        }
+
+        return [name for name in self.CONVERSIONS if needed[name]]
+
+    def _log_elided_conversions(self, stream_id):
+        elided = self._elided_conversions[stream_id]
+        logger.info('video stream %d of %s: %s' % (
+            stream_id, self,
+            'no conversion elided' if not elided else 'elided %s' % ', '.join(elided),
+        ))
+
+    def _get_output_conversion(self, stream_id):
+        """Return the elements needed to bring the decoded video to the output
+        format, size and framerate, omitting the ones that are not necessary
+        for the caps of the stream.
+
+        What is omitted is remembered and can be read with get_elided_conversions().
+        """
+        needed = self._get_needed_conversions(self._video_caps[stream_id])
+
+        self._elided_conversions[stream_id] = [name for name in self.CONVERSIONS if name not in needed]
+        self._log_elided_conversions(stream_id)
+
+        return [self._make_converter(name) for name in needed]
+
+    def _on_configuration_changed(self, configuration, pspec):
+        """Renegotiate the caps of the preview and output branches; the conversions
+        elided because not needed with the old configuration are added back
+        if now are necessary"""
+        if pspec.name in ('preview-width', 'preview-height',):
+            for capsfilter in self._preview_capsfilters.values():
+                capsfilter.set_property('caps', Gst.Caps.from_string(conf.get_preview_caps_string()))
+        elif pspec.name == 'preview-fps':
+            self.set_preview_rate(conf.get_property('preview-fps'))
+        elif pspec.name in ('output-width', 'output-height', 'fps', 'output-format',):
+            for stream_id in self._output_capsfilters:
+                needed = self._get_needed_conversions(self._video_caps[stream_id])
+                missing = [name for name in self._elided_conversions[stream_id] if name in needed]
+
+                if missing:
+                    self._insert_after(self._output_valves[stream_id], [self._make_converter(name) for name in missing])
+                    self._elided_conversions[stream_id] = [name for name in self._elided_conversions[stream_id] if name not in missing]
+                    self._log_elided_conversions(stream_id)
+
+            self._on_output_configuration_changed(pspec, self._output_capsfilters.values())
+
+    def get_elided_conversions(self):
+        """Return a dict with as key the video stream id and as value the list
+        of the conversion elements not used since the stream already has
+        the output format"""
+        return self._elided_conversions
+
+    def get_bridge_channel(self):
+        """Return the name of the channel used to share the video with
+        other pipelines via the inter* elements"""
+        return 'streamstudio-%x' % id(self)
+
+    def enable_video_bridge(self):
+        """Make the decoded video available to other pipelines: an intervideosrc
+        with the channel returned by get_bridge_channel() will receive it.
+        """
+        if self._video_bridge is not None:
+            return self.get_bridge_channel()
+
+        self._check_video_stream()
+
+        queue = self._make_queue()
+        queue.set_property('leaky', 2)# downstream
+        queue.set_property('max-size-buffers', 2)
+
+        sink = Gst.ElementFactory.make('intervideosink', None)
+        sink.set_property('channel', self.get_bridge_channel())
+
+        elements = [queue, sink]
+        self._video_bridge = (self._attach_tee_branch(self._video_tee, elements), elements)
+
+        return self.get_bridge_channel()
+
+    def disable_video_bridge(self):
+        if self._video_bridge is None:
+            return
+
+        tee_pad, elements = self._video_bridge
+        self._detach_tee_branch(self._video_tee, tee_pad, elements)
+
+        self._video_bridge = None
+
+    def _forget_stream(self, stream_type, stream_id):
+        """Drop the elements of the stream kept to follow the configuration,
+        return the bridges and taps attached to its tees"""
+        attached = []
+
+        if stream_type == 'video':
+            tee = self._video_tees.pop(stream_id)
+            for d in (self._video_caps, self._output_valves, self._output_app_sinks, self._output_capsfilters,
+                    self._preview_capsfilters, self._preview_videorates, self._preview_counters, self._elided_conversions,):
+                d.pop(stream_id, None)
+
+            if tee is self._video_tee:
+                # the blocking probe goes away with the tee
+                self._video_tee_probe_id = None
+                self._use_last_video_stream()
+
+            if self._video_bridge is not None and self._video_bridge[0].get_parent_element() is tee:
+                attached += self._video_bridge[1]
+                self._video_bridge = None
+        else:
+            for d in (self._volumes, self._audio_program_tees, self._audio_tees,):
+                d.pop(stream_id, None)
+
+            if stream_id in self._audio_bridges:
+                attached += self._audio_bridges.pop(stream_id)[1]
+
+            for handle, (tap_stream_id, tee_pad, elements, counters) in self._audio_taps.items():
+                if tap_stream_id == stream_id:
+                    attached += elements
+                    del self._audio_taps[handle]
+
+        return attached
+
+    def _use_last_video_stream(self):
+        """Point the video tee, valve and appsink to the last video stream
+        remaining, to None if there is none"""
+        if not self._video_tees:
+            self._video_tee = self._video_valve = self._video_app_sink = None
+            return
+
+        stream_id = max(self._video_tees.keys())
+        self._video_tee = self._video_tees[stream_id]
+        self._video_valve = self._output_valves[stream_id]
+        self._video_app_sink = self._output_app_sinks[stream_id]
+
+    def _check_video_stream(self):
+        if self._video_tee is None:
+            raise AttributeError('%s has no video stream' % self)
 
     def block(self):
+        """Block the data entering the last video stream, the signal 'block'
+        is emitted (from the streaming thread) when the flow is stopped"""
         def __cb_pad_probe(pad, info, user_data):
             self.emit('block')
 
             return Gst.PadProbeReturn.OK
 
-        self._video_tee_probe_id = self._video_tee_src_pad.add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, __cb_pad_probe, None)
+        self._check_video_stream()
+
+        if self._video_tee_probe_id is not None:
+            return
+
+        self._video_tee_probe_id = self._video_tee.get_static_pad('sink').add_probe(
+            Gst.PadProbeType.BLOCK_DOWNSTREAM, __cb_pad_probe, None)
 
     def unblock(self):
-        self._video_tee_src_pad.remove_probe(self._video_tee_probe_id)
+        if self._video_tee_probe_id is None:
+            return
+
+        self._video_tee.get_static_pad('sink').remove_probe(self._video_tee_probe_id)
+        self._video_tee_probe_id = None
 
-    def enable_video_src(self):
-        """Calling this method we are attacching an appsink to the pipeline so that
-        an external application can pull data from it
+    def enable_video_src(self, stream_id=0):
+        """Open the output branch of the video stream and return its appsink
+        so that an external application can pull data from it
         """
+        self.open_video_valve(stream_id)
+
+        return self._output_app_sinks[stream_id]
+
+    def disable_video_src(self, stream_id=0):
+        """Close the output branch opened with enable_video_src(): the frames
+        are dropped before being converted to the output format"""
+        logger.debug('disable video src %d for %s' % (stream_id, self,))
+
+        self.close_video_valve(stream_id)
 
-        return self._video_app_sink
+    def open_video_valve(self, stream_id=0):
+        """Let the decoded frames of the video stream reach the appsink"""
+        if stream_id not in self._output_valves:
+            raise AttributeError('%s has no video stream %d' % (self, stream_id,))
 
-    def disable_video_src(self):
-        """Calling this method detach the branch created with enable_video_src()"""
-        logger.debug('disable video src for %s' % self)
+        self._output_valves[stream_id].set_property('drop', False)
+
+    def close_video_valve(self, stream_id=0):
+        """Drop the decoded frames of the video stream before the appsink,
+        with GStreamer 1.20 or later the branch stays negotiated so that
+        reopening it the frames flow immediately"""
+        # the stream could be already removed
+        if stream_id not in self._output_valves:
+            return
+
+        self._output_valves[stream_id].set_property('drop', True)
 
 class V4L2StreamStudioSource(StreamStudioSource):
+    LIVE = True
+
     def _build_pipeline_string(self):
         return 'v4l2src device=%s ! decodebin name=demux' % self._location
 
 class RemoteStreamStudioSource(StreamStudioSource):
+    """Source reading from an URL, with the 'low' latency profile it's
+    considered a live stream (like a network camera)"""
+    LIVE = True
+
+    def _build_pipeline_string(self):
+        is_live = self._get_latency_profile() is LATENCY_PROFILES['low']
+
+        return 'souphttpsrc location=%s is-live=%s do-timestamp=%s ! decodebin name=demux' % (
+            self._location, str(is_live).lower(), str(is_live).lower(),
+        )
+
+class TestStreamStudioSource(StreamStudioSource):
+    """Live source with a videotestsrc, the location is the pattern to use
+    (like 'smpte' or 'ball')"""
+    LIVE = True
+
     def _build_pipeline_string(self):
-        return 'souphttpsrc location=%s ! decodebin name=demux' % self._location
+        return 'videotestsrc is-live=true pattern=%s ! decodebin name=demux' % self._location
 
 class ImageStreamStudioSource(StreamStudioSource):
     def _get_video_branch(self):
@@ -527,77 +1800,567 @@ class ImageStreamStudioSource(StreamStudioSource):
 
         return elements
 
-class StreamStudioOutput(BasePipeline):
+class OutputSinksMixin(object):
+    """Add to an output pipeline the sinks chosen with the 'output-sinks'
+    option (or passed as argument), as branches of a tee.
+
+    Each branch starts with a queue, so the encoders run in their own thread,
+    and a full queue drops old frames instead of blocking the other sinks.
+
+    The stats about the branches (frames/s entering the encoder and fill of
+    the queue) are returned by get_sink_stats().
+
+    With the 'audio-program' option the output has also an audiomixer, the
+    program bus, where the audio of the sources arrives via the interaudio*
+    elements (see StreamStudioSource.enable_audio_bridge()), so that no
+    sample passes through python; a silent live input keeps it running
+    also without sources
+
+     >>> op.add_audio_source(ip)
+     >>> op.remove_audio_source(ip)
+    """
+    # when a queue is filled above this fraction its sink is the bottleneck
+    BOTTLENECK_FILL = 0.8
+
+    def _get_output_tail(self, sinks):
+        """Return the part of pipeline description to append to the video
+        to be transmitted"""
+        self._sink_specs = sinks or get_output_sinks()
+
+        branches = []
+        for idx, spec in enumerate(self._sink_specs):
+            kind, options = parse_output_sink(spec)
+            options['mux'] = 'output_mux%d' % idx
+            branches.append('outputs. ! queue name=output_queue%d leaky=downstream max-size-buffers=0 max-size-bytes=0 max-size-time=%d ! %s' % (
+                idx, 2 * Gst.SECOND, OUTPUT_SINKS[kind] % options,
+            ))
+
+        if conf.get_property('audio-program'):
+            branches.append(self._get_audio_program_tail())
+
+        return 'videoconvert ! timeoverlay name=overlay ! tee name=outputs %s' % ' '.join(branches)
+
+    def _get_audio_program_tail(self):
+        """The program is listened and encoded into the muxers of the sinks
+        recording or streaming (see OUTPUT_AUDIO_ENCODERS)"""
+        sink = 'fakesink sync=true' if conf.get_property('headless') else 'autoaudiosink'
+
+        branches = ['audio_outputs. ! queue ! %s' % sink]
+        for idx, spec in enumerate(self._sink_specs):
+            kind, options = parse_output_sink(spec)
+            if kind in OUTPUT_AUDIO_ENCODERS:
+                branches.append('audio_outputs. ! queue max-size-time=%d ! audioconvert ! %s ! output_mux%d.' % (
+                    2 * Gst.SECOND, OUTPUT_AUDIO_ENCODERS[kind], idx,
+                ))
+
+        return 'audiotestsrc wave=silence is-live=true ! %s ! audiomixer name=program ! audioconvert ! tee name=audio_outputs %s' % (
+            AUDIO_PROGRAM_CAPS, ' '.join(branches),
+        )
+
+    def has_audio_program(self):
+        return self._program_mixer is not None
+
+    def _setup_output_sinks(self):
+        self._sink_counters = []
+
+        # None if the audio program is disabled
+        self._program_mixer = self.player.get_by_name('program')
+        self._audio_inputs = []
+
+        for idx, spec in enumerate(self._sink_specs):
+            queue = self.player.get_by_name('output_queue%d' % idx)
+            counters = {'frames': 0, 'overruns': 0, 'since': time.time()}
+
+            def __cb_count(pad, info, counters):
+                counters['frames'] += 1
+                return Gst.PadProbeReturn.OK
+
+            def __cb_overrun(queue, counters):
+                counters['overruns'] += 1
+
+            queue.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, __cb_count, counters)
+            queue.connect('overrun', __cb_overrun, counters)
+
+            self._sink_counters.append((spec, queue, counters))
+
+    def get_sink_stats(self):
+        """Return a list of dicts, one for each sink, with the frames/s processed
+        by it since the last call and the fill of its queue"""
+        now = time.time()
+
+        stats = []
+        for spec, queue, counters in self._sink_counters:
+            elapsed = now - counters['since']
+            fill = float(queue.get_property('current-level-time')) / queue.get_property('max-size-time')
+
+            stats.append({
+                'sink': spec,
+                'fps': counters['frames'] / elapsed if elapsed > 0 else 0.0,
+                'queue-buffers': queue.get_property('current-level-buffers'),
+                'queue-time': queue.get_property('current-level-time'),
+                'queue-fill': fill,
+                'overruns': counters['overruns'],
+                'bottleneck': fill > self.BOTTLENECK_FILL,
+            })
+
+            counters['frames'] = 0
+            counters['since'] = now
+
+            if fill > self.BOTTLENECK_FILL:
+                logger.warning('output sink \'%s\' can\'t keep up (queue %d%% full)' % (spec, fill * 100,))
+
+        return stats
+
+    def add_audio_channel(self, channel):
+        """Mix into the program the audio from the interaudiosink with the given channel"""
+        if self._program_mixer is None:
+            raise AttributeError('the audio program is disabled (see the \'audio-program\' option)')
+
+        pad = self._program_mixer.get_request_pad('sink_%u')
+        elements = self._link_inter_audio_src(channel, pad)
+
+        self._audio_inputs.append((channel, pad, elements,))
+
+    def remove_audio_channel(self, channel):
+        idx = _find_channel(self._audio_inputs, channel)
+        channel, pad, elements = self._audio_inputs.pop(idx)
+
+        self._unlink_inter_src(elements, self._program_mixer, pad)
+
+    def get_audio_channels(self):
+        return [channel for channel, pad, elements in self._audio_inputs]
+
+    def add_audio_source(self, source, stream_id=0):
+        self.add_audio_channel(source.enable_audio_bridge(stream_id))
+
+    def remove_audio_source(self, source, stream_id=0):
+        self.remove_audio_channel(source.get_audio_bridge_channel(stream_id))
+        source.disable_audio_bridge(stream_id)
+
+    def kill(self):
+        """Send the EOS before stopping, so that the muxers can finalize the files"""
+        # otherwise the EOS could be taken by the watch, from the main loop
+        self._remove_bus_watch()
+
+        self.player.send_event(Gst.Event.new_eos())
+        self.player.get_bus().timed_pop_filtered(2 * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+
+        super(OutputSinksMixin, self).kill()
+
+class StreamStudioOutput(OutputSinksMixin, BasePipeline):
     """Pipeline used to finally produce the streaming needed."""
 
-    def __init__(self):
+    def __init__(self, sinks=None):
+        # with the audio program the frames are timestamped with the running
+        # time (see SourceController._set_timestamp()) to be in sync with it
         super(StreamStudioOutput, self).__init__(
-            'appsrc name=source caps=video/x-raw,format=(string)RGB16,width=(int)%d,height=(int)%d,framerate=(fraction)%d/1 ! videoconvert ! timeoverlay ! xvimagesink sync=false' %
-                (conf.get_output_width(), conf.get_output_height(), conf.get_fps())
+            'appsrc name=source caps=%s %s ! %s' % (
+                conf.get_output_caps_string(),
+                'format=time is-live=true' if conf.get_property('audio-program') else '',
+                self._get_output_tail(sinks),
+            )
         )
 
+        self._setup_output_sinks()
+
         self._app_src = self.player.get_by_name('source')
 
         assert self._app_src
 
+    def _on_configuration_changed(self, configuration, pspec):
+        self._on_output_configuration_changed(pspec, [self._app_src])
+
     def get_video_src(self):
         return self._app_src
 
+def compute_layout(layout, count, width, height):
+    """Return a list of (xpos, ypos, width, height) tuples, one for each of the
+    count inputs, placing them into an output of the given size.
+
+    The layout can be
+
+     - 'pip': the first input at full size, the others as small pictures
+       from the bottom-right corner, in rows of three going up
+     - 'quad': a grid with the same number of rows and columns (2x2 for four inputs)
+     - 'side-by-side': all the inputs in a row, preserving the aspect ratio
+    """
+    if count == 0:
+        return []
+
+    if layout == 'pip':
+        rects = [(0, 0, width, height)]
+        w, h = width / 4, height / 4
+        margin = width / 32
+        per_row = max(1, (width - margin) / (w + margin))
+        for idx in range(count - 1):
+            row, column = idx / per_row, idx % per_row
+            rects.append((width - (column + 1)*(w + margin), max(0, height - (row + 1)*(h + margin)), w, h))
+
+        return rects
+    elif layout == 'quad':
+        side = 1
+        while side * side < count:
+            side += 1
+
+        w, h = width / side, height / side
+
+        return [((idx % side) * w, (idx / side) * h, w, h) for idx in range(count)]
+    elif layout == 'side-by-side':
+        w, h = width / count, height / count
+
+        return [(idx * w, (height - h) / 2, w, h) for idx in range(count)]
+
+    raise AttributeError('unknown layout \'%s\'' % layout)
+
+def _find_channel(inputs, channel):
+    """Return the index of the input with the given channel in a list
+    of (channel, pad, elements) tuples"""
+    for idx, (name, pad, elements) in enumerate(inputs):
+        if name == channel:
+            return idx
+
+    raise AttributeError('no input with channel \'%s\'' % channel)
+
+class StreamStudioCompositorOutput(OutputSinksMixin, BasePipeline):
+    """Output pipeline that mixes together more sources.
+
+    The video of each source arrives via an intervideosrc element (see
+    StreamStudioSource.enable_video_bridge()) directly to a compositor
+    element, so that frames don't pass through python. The position of the
+    inputs is decided by the layout (see compute_layout()).
+
+     >>> op = StreamStudioCompositorOutput(layout='quad')
+     >>> op.add_source(ip1)
+     >>> op.add_source(ip2)
+     >>> op.set_layout('pip')
+    """
+    LAYOUTS = ('pip', 'quad', 'side-by-side',)
+
+    def __init__(self, layout='quad', sinks=None):
+        self._layout = layout
+        self._inputs = []
+
+        # the black background keeps the output running also without inputs
+        super(StreamStudioCompositorOutput, self).__init__(
+            'videotestsrc pattern=black is-live=true ! capsfilter name=background caps=%s ! compositor name=mix background=black ! %s' %
+                (conf.get_output_caps_string(), self._get_output_tail(sinks),)
+        )
+
+        self._setup_output_sinks()
+
+        self._mixer = self.player.get_by_name('mix')
+
+        assert self._mixer
+
+    def _on_configuration_changed(self, configuration, pspec):
+        if self._on_output_configuration_changed(pspec, [self.player.get_by_name('background')]):
+            self._apply_layout()
+
+    def add_channel(self, channel):
+        """Add a new input reading from the intervideosink with the given channel"""
+        pad = self._mixer.get_request_pad('sink_%u')
+        elements = self._link_inter_video_src(channel, pad)
+
+        self._inputs.append((channel, pad, elements,))
+        self._apply_layout()
+
+    def remove_channel(self, channel):
+        idx = _find_channel(self._inputs, channel)
+        channel, pad, elements = self._inputs.pop(idx)
+
+        self._unlink_inter_src(elements, self._mixer, pad)
+
+        self._apply_layout()
+
+    def add_source(self, source):
+        self.add_channel(source.enable_video_bridge())
+
+    def remove_source(self, source):
+        self.remove_channel(source.get_bridge_channel())
+        source.disable_video_bridge()
+
+    def set_layout(self, layout):
+        if layout not in self.LAYOUTS:
+            raise AttributeError('unknown layout \'%s\'' % layout)
+
+        self._layout = layout
+        self._apply_layout()
+
+    def get_layout(self):
+        return self._layout
+
+    def _apply_layout(self):
+        rects = compute_layout(self._layout, len(self._inputs), conf.get_output_width(), conf.get_output_height())
+
+        for zorder, ((channel, pad, elements), (x, y, w, h)) in enumerate(zip(self._inputs, rects)):
+            pad.set_property('xpos', x)
+            pad.set_property('ypos', y)
+            pad.set_property('width', w)
+            pad.set_property('height', h)
+            # the background has zorder 0
+            pad.set_property('zorder', zorder + 1)
+
+class StreamStudioSwitcherOutput(OutputSinksMixin, BasePipeline):
+    """Output pipeline that switches between sources using an input-selector.
+
+    All the sources are linked into this pipeline via intervideosrc elements
+    (see StreamStudioSource.enable_video_bridge()) so that the switch happens
+    at frame boundary without frames passing through python. It has the same
+    interface of SourceController, so it can be used in its place.
+
+     >>> op = StreamStudioSwitcherOutput()
+     >>> op.add_source(ip)
+     >>> op.swap_source(ip)
+     >>> op.get_switch_latency()
+
+    The 'carosello' input is a test pattern always available.
+
+    Each time the switch is completed, that is the first frame of the new source
+    is out of the selector, the signal 'switch-done' is emitted with the time in
+    seconds since the request.
+    """
+    __gsignals__ = {
+        'switch-done': (
+            GObject.SIGNAL_RUN_LAST,
+            GObject.TYPE_NONE,
+            (GObject.TYPE_FLOAT,)
+        ),
+    }
+    # how many switch latencies are remembered
+    LATENCY_HISTORY = 100
+
+    def __init__(self, sinks=None):
+        self._inputs = []
+        self._actual_channel = None
+        self._latencies = collections.deque(maxlen=self.LATENCY_HISTORY)
+        # the probes measuring the switch in progress: the sink pad and the
+        # ids of the probes still installed on it and on the src pad
+        self._switch_probes = None
+
+        super(StreamStudioSwitcherOutput, self).__init__(
+            'videotestsrc pattern=smpte is-live=true ! capsfilter name=carosello caps=%s ! selector.sink_0 '
+            'input-selector name=selector ! videoconvert ! videoscale ! videorate ! capsfilter name=output caps=%s ! %s' % (
+                conf.get_output_caps_string(), conf.get_output_caps_string(), self._get_output_tail(sinks),
+            )
+        )
+
+        self._setup_output_sinks()
+
+        self._selector = self.player.get_by_name('selector')
+
+        assert self._selector
+
+        self._carosello_pad = self._selector.get_static_pad('sink_0')
+
+    def _on_configuration_changed(self, configuration, pspec):
+        self._on_output_configuration_changed(pspec, [
+            self.player.get_by_name('carosello'),
+            self.player.get_by_name('output'),
+        ])
+
+    def add_channel(self, channel):
+        pad = self._selector.get_request_pad('sink_%u')
+        elements = self._link_inter_video_src(channel, pad)
+
+        self._inputs.append((channel, pad, elements,))
+
+    def remove_channel(self, channel):
+        idx = _find_channel(self._inputs, channel)
+        channel, pad, elements = self._inputs.pop(idx)
+
+        if channel == self._actual_channel:
+            self.switch_to_carosello(True)
+
+        self._unlink_inter_src(elements, self._selector, pad)
+
+    def add_source(self, source):
+        self.add_channel(source.enable_video_bridge())
+
+    def remove_source(self, source):
+        self.remove_channel(source.get_bridge_channel())
+        source.disable_video_bridge()
+
+    def _select_pad(self, pad):
+        """Make the pad active, measuring the time needed for the first
+        frame coming from it to exit from the selector"""
+        if self._selector.get_property('active-pad') == pad:
+            return
+
+        # a switch still in progress is not measured anymore
+        self._remove_switch_probes()
+
+        start = time.time()
+        state = {'thread': None, 'pad': pad, 'sink': None, 'src': None}
+
+        # the buffers arriving before the pad is active are dropped by the
+        # selector, the first one arriving after is pushed downstream from
+        # the streaming thread of the pad, that is remembered
+        def __cb_on_sink(pad, info, user_data):
+            if self._selector.get_property('active-pad') != pad:
+                return Gst.PadProbeReturn.OK
+
+            state['thread'] = threading.current_thread().ident
+            state['sink'] = None
+            return Gst.PadProbeReturn.REMOVE
+
+        # the other inputs push from their own threads
+        def __cb_on_src(pad, info, user_data):
+            if state['thread'] != threading.current_thread().ident:
+                return Gst.PadProbeReturn.OK
+
+            latency = time.time() - start
+            self._latencies.append(latency)
+            logger.debug('switch completed in %.1f ms' % (latency * 1000,))
+
+            GObject.idle_add(self.emit, 'switch-done', latency)
+
+            state['src'] = None
+            return Gst.PadProbeReturn.REMOVE
+
+        state['sink'] = pad.add_probe(Gst.PadProbeType.BUFFER, __cb_on_sink, None)
+        state['src'] = self._selector.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, __cb_on_src, None)
+        self._switch_probes = state
+
+        self._selector.set_property('active-pad', pad)
+
+    def _remove_switch_probes(self):
+        if self._switch_probes is None:
+            return
+
+        # the probes already removed by their callbacks have no id
+        state, self._switch_probes = self._switch_probes, None
+        if state['sink'] is not None:
+            state['pad'].remove_probe(state['sink'])
+        if state['src'] is not None:
+            self._selector.get_static_pad('src').remove_probe(state['src'])
+
+    def swap_source(self, source):
+        """Transmit the given source (it must be added before)"""
+        channel = source.get_bridge_channel()
+        channel, pad, elements = self._inputs[_find_channel(self._inputs, channel)]
+
+        self._actual_channel = channel
+        self._select_pad(pad)
+
+    def switch_to_carosello(self, enable):
+        if enable:
+            self._select_pad(self._carosello_pad)
+        elif self._actual_channel is not None:
+            self._select_pad(self._inputs[_find_channel(self._inputs, self._actual_channel)][1])
+
+    def is_carosello(self):
+        return self._selector.get_property('active-pad') == self._carosello_pad
+
+    def get_switch_latency(self):
+        """Return the time in seconds of the last completed switch"""
+        return self._latencies[-1] if self._latencies else None
+
+    def get_switch_latencies(self):
+        return list(self._latencies)
+
 import cmd
 
 class PipelineShell(cmd.Cmd):
+    """Interactive shell driving a HeadlessStudio: the sources are added,
+    removed and transmitted while the output keeps running
+
+        streamstudio> add test:ball
+        streamstudio> switch 0
+        streamstudio> remove 0
+    """
     def __init__(self):
+        # imported here to not create a circular import
+        from .headless import HeadlessStudio
+
         cmd.Cmd.__init__(self)
         self.prompt = "\033[1;31mstreamstudio> \033[0m"
-        self.p = Pipeline()
+
         GObject.threads_init()
-        #l = GObject.MainLoop()
-        #l.run()
+        Gst.init(None)
+
+        self._studio = HeadlessStudio()
+        self._studio.start()
+
+        # the commands are read from this thread, the pipelines live in the main loop's one
+        self._main_loop = GObject.MainLoop()
+        self._loop_thread = threading.Thread(target=self._main_loop.run, name='main-loop')
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+
+    def _call(self, func, *args):
+        """Run func(*args) from the main loop and return its result, the
+        exception raised is raised here too"""
+        done = threading.Event()
+        result = {}
+
+        def __call():
+            try:
+                result['value'] = func(*args)
+            except Exception as e:
+                result['error'] = e
+            finally:
+                done.set()
+
+            return False
+
+        GObject.idle_add(__call)
+        done.wait()
+
+        if 'error' in result:
+            raise result['error']
+
+        return result['value']
+
+    def _get_source(self, line):
+        try:
+            return self._studio.get_sources()[int(line)]
+        except (ValueError, IndexError):
+            raise AttributeError('no source \'%s\', use the index shown by \'list\'' % line)
 
     def do_EOF(self, line):
+        self._call(self._studio.quit)
+        self._main_loop.quit()
+
         return True
 
     def emptyline(self):
         return ''
 
     def do_add(self, line):
-        """Add a source"""
+        """Add a source: test:<pattern>, /dev/videoN, an URL or a file"""
         if line == "":
             return
 
         try:
-            self.p.add_source_device(line)
+            source = self._call(self._studio.add_source, line)
         except AttributeError as e:
             print e.message
-
-    def do_add_file(self, line):
-        if line == '':
             return
 
-        try:
-            self.p.add_source_file(line)
-        except AttributeError as e:
-            print e.message
+        print '%d: %s' % (self._studio.get_sources().index(source), source,)
 
-    def do_remove(self, line):
-        """Remove a source, pass a device path as argument"""
-        if line == "":
-            return
+    def do_list(self, line):
+        """List the sources with their index"""
+        for idx, source in enumerate(self._studio.get_sources()):
+            print '%d: %s' % (idx, source,)
 
+    def do_remove(self, line):
+        """Remove a source, pass its index as argument"""
         try:
-            self.p.remove_source(line)
+            self._call(self._studio.remove_source, self._get_source(line))
         except AttributeError as e:
             print e.message
 
-    def do_play(self, line):
-        self.p.play()
-
     def do_switch(self, line):
+        """Transmit a source, pass its index as argument"""
         try:
-            self.p.switch_to(line)
+            self._call(self._studio.switch_to, self._get_source(line))
         except AttributeError as e:
             print e.message
 
+    def do_carosello(self, line):
+        self._call(self._studio.switch_to_carosello)
+
 
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,103 @@
+"""
+Single timeout polling the position of all the seekable pipelines.
+
+Instead of each monitor querying its pipeline every 100 ms, the monitors
+register to the shared poller that in one tick queries all the pipelines
+that are not live and whose monitor is visible, then calls the callbacks.
+The duration is cached by the pipeline itself (see BasePipeline.get_duration()).
+
+ >>> poller = get_position_poller()
+ >>> handle = poller.register(pipeline, callback, is_visible)
+ >>> poller.unregister(handle)
+
+When no registered monitor is visible the tick is slowed down.
+"""
+import itertools
+from gi.repository import GObject
+from .sslog import logger
+from .conf import get_configuration
+
+conf = get_configuration()
+
+
+class PositionPoller(GObject.GObject):
+    # milliseconds between the ticks when nothing is visible
+    HIDDEN_INTERVAL = 1000
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+
+        # handle -> (pipeline, callback, is_visible)
+        self._registrations = {}
+        self._handles = itertools.count()
+
+        self._timeout_id = None
+        self._interval = None
+
+    def register(self, pipeline, callback, is_visible=None):
+        """The callback will be called as callback(pipeline, position, duration)
+        only if is_visible() returns True (if passed). Return the handle
+        to use with unregister()."""
+        handle = next(self._handles)
+        self._registrations[handle] = (pipeline, callback, is_visible,)
+
+        self._schedule(conf.get_property('position-poll-interval'))
+
+        return handle
+
+    def unregister(self, handle):
+        self._registrations.pop(handle, None)
+
+        if not self._registrations:
+            self._schedule(None)
+
+    def _schedule(self, interval):
+        """Change the interval of the tick, with None the tick is stopped"""
+        if interval == self._interval:
+            return
+
+        if self._timeout_id is not None:
+            GObject.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+        self._interval = interval
+
+        if interval is not None:
+            logger.debug('polling positions every %d ms' % interval)
+            self._timeout_id = GObject.timeout_add(interval, self._tick)
+
+    def _tick(self):
+        visible = 0
+
+        for pipeline, callback, is_visible in self._registrations.values():
+            if is_visible is not None and not is_visible():
+                continue
+
+            visible += 1
+
+            if pipeline.is_live():
+                continue
+
+            duration = pipeline.get_duration()
+            if duration <= 0:
+                continue
+
+            callback(pipeline, pipeline.get_position(), duration)
+
+        interval = conf.get_property('position-poll-interval') if visible else self.HIDDEN_INTERVAL
+        if interval != self._interval:
+            # this timeout is removed returning False
+            self._timeout_id = None
+            self._schedule(interval)
+            return False
+
+        return True
+
+_position_poller = None
+def get_position_poller():
+    """Return the poller shared by all the monitors"""
+    global _position_poller
+    if _position_poller is None:
+        _position_poller = PositionPoller()
+
+    return _position_poller
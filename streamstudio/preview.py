@@ -0,0 +1,96 @@
+"""
+Framerate of the monitors of the sources, adapted to what is on screen.
+
+The monitors register their source with a function telling if they are
+visible; once a second the preview rate of each source is chosen
+
+ - the monitors not visible get 'preview-hidden-fps'
+ - the visible ones get 'preview-fps', divided among them when there are
+   more than 'preview-crowd' on screen
+
+ >>> governor = get_preview_governor()
+ >>> handle = governor.register(source, is_visible)
+ >>> governor.unregister(handle)
+
+Periodically the frames/s, the CPU and the busy time of the preview of
+each source are logged (see StreamStudioSource.get_preview_stats()).
+"""
+import itertools
+from gi.repository import GObject
+from .sslog import logger
+from .conf import get_configuration
+
+conf = get_configuration()
+
+
+class PreviewGovernor(GObject.GObject):
+    # seconds between the logs about the CPU and the time used by the previews
+    REPORT_INTERVAL = 10
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+
+        # handle -> (source, is_visible)
+        self._registrations = {}
+        self._handles = itertools.count()
+
+        self._timeout_id = None
+        self._ticks = 0
+
+    def register(self, source, is_visible):
+        handle = next(self._handles)
+        self._registrations[handle] = (source, is_visible,)
+
+        if self._timeout_id is None:
+            self._timeout_id = GObject.timeout_add_seconds(1, self._tick)
+
+        return handle
+
+    def unregister(self, handle):
+        self._registrations.pop(handle, None)
+
+        if not self._registrations and self._timeout_id is not None:
+            GObject.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+    def get_rate(self, visible, count):
+        """Return the preview rate for a monitor, given if it's visible and
+        how many monitors are visible"""
+        if not visible:
+            return conf.get_property('preview-hidden-fps')
+
+        fps = conf.get_property('preview-fps')
+        crowd = conf.get_property('preview-crowd')
+        if count <= crowd:
+            return fps
+
+        return max(conf.get_property('preview-hidden-fps'), fps * crowd / count)
+
+    def _tick(self):
+        visibility = [(source, is_visible(),) for source, is_visible in self._registrations.values()]
+        count = len([visible for source, visible in visibility if visible])
+
+        for source, visible in visibility:
+            source.set_preview_rate(self.get_rate(visible, count))
+
+        self._ticks += 1
+        if self._ticks % self.REPORT_INTERVAL == 0:
+            self._log_report()
+
+        return True
+
+    def _log_report(self):
+        for source, is_visible in self._registrations.values():
+            for stream_id, stats in source.get_preview_stats().items():
+                logger.info('preview %d of %s: %.1f fps (max %d), cpu %s, busy %.1f%%',
+                    stream_id, source, stats['fps'], stats['rate'],
+                    '%.1f%%' % (stats['cpu'] * 100) if stats['cpu'] is not None else 'unknown', stats['busy'] * 100)
+
+_preview_governor = None
+def get_preview_governor():
+    """Return the governor shared by all the monitors"""
+    global _preview_governor
+    if _preview_governor is None:
+        _preview_governor = PreviewGovernor()
+
+    return _preview_governor
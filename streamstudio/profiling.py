@@ -0,0 +1,341 @@
+"""
+Profiling of the pipelines with the GStreamer tracers.
+
+With the 'profile' option (--profile true or SS_PROFILE=1) the tracers
+
+ - latency (flags=pipeline+element), from the GStreamer core
+ - proctime, interlatency and queuelevel, from GstShark
+
+are enabled for all the pipelines of the process; their records go into
+the log 'tracers-<pid>.log' of the 'profile-dir' directory, that each
+'profile-interval' seconds is parsed to update a report with, for each
+source and each of its elements, the milliseconds spent per frame and the
+share of the wall time spent in it ('time-share', not CPU time: the waits
+inside the element are counted), the fill of the queues and the latencies.
+At the same time a dot graph of every pipeline is written, named with the
+time
+
+ >>> setup_tracers()# before Gst.init()
+ >>> start_profiling()
+ >>> ...
+ >>> stop_profiling()# writes report.json
+
+The sources running in the workers (see the 'source-workers' option) write
+their own log, not parsed.
+"""
+import os
+import re
+import json
+import time
+import tempfile
+import collections
+from gi.repository import GObject, Gst
+from .sslog import logger
+from .conf import get_configuration
+from .pipeline import get_pipelines
+from .diagnostics import add_gst_tracer
+
+conf = get_configuration()
+
+TRACERS = ('latency(flags=pipeline+element)', 'proctime', 'interlatency', 'queuelevel',)
+
+# the record is what follows the category in each line of the log
+_RECORD_RE = re.compile(r'GST_TRACER :\d+:: (.*)$')
+# the address of the C object, at the end of the repr() of a GObject
+_POINTER_RE = re.compile(r' at (0x[0-9a-f]+)\)>$')
+
+def get_profile_dir():
+    return conf.get_property('profile-dir') or os.path.join(tempfile.gettempdir(), 'streamstudio-profile')
+
+def setup_tracers():
+    """Enable the tracers and their log if profiling, before Gst.init()"""
+    if not conf.get_property('profile'):
+        return
+
+    path = get_profile_dir()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    for tracer in TRACERS:
+        add_gst_tracer(tracer)
+
+    os.environ['GST_DEBUG'] = ','.join([level for level in (os.environ.get('GST_DEBUG'), 'GST_TRACER:7',) if level])
+    os.environ['GST_DEBUG_NO_COLOR'] = '1'
+    # %p is the pid, so the workers don't write into the same file
+    os.environ['GST_DEBUG_FILE'] = os.path.join(path, 'tracers-%p.log')
+    os.environ['GST_DEBUG_DUMP_DOT_DIR'] = path
+
+def _parse_time(value):
+    """Return the nanoseconds of a time logged as integer or as string
+    (like '0:00:00.000123456', by the GstShark tracers)"""
+    if not isinstance(value, basestring):
+        return value
+
+    hours, minutes, seconds = value.split(':')
+    return int((int(hours) * 3600 + int(minutes) * 60 + float(seconds)) * Gst.SECOND)
+
+def _get_field(structure, *names):
+    """Return the value of the first field present, the tracers of different
+    versions use different names"""
+    for name in names:
+        if structure.has_field(name):
+            return structure.get_value(name)
+
+    return None
+
+def _get_pointer(obj):
+    """Return the address of the GStreamer object as logged by the tracers
+    (the 'element-id' fields), None if unknown"""
+    match = _POINTER_RE.search(repr(obj))
+    return match.group(1) if match else None
+
+
+class _Stat(object):
+    """Count, total and max of the times (in nanoseconds) of a record"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def get_mean_ms(self):
+        return self.total / float(self.count * Gst.MSECOND) if self.count else 0.0
+
+    def get_max_ms(self):
+        return self.max / float(Gst.MSECOND)
+
+class Profiler(object):
+    """Parse the records of the tracers and keep the report, see the
+    module's documentation"""
+    # elements logged at each interval, the ones with the largest time share
+    TOP_ELEMENTS = 10
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+
+        self._log_path = os.path.join(path, 'tracers-%d.log' % os.getpid())
+        self._offset = 0
+        self._start = time.time()
+        self._timeout_id = None
+
+        # element address -> name of its pipeline, remembered also after the
+        # removal (an address reused is overwritten by the next update)
+        self._owners = {}
+        # element name -> names of the pipelines alive having an element with
+        # that name, for the records without the address
+        self._names = {}
+
+        # by element name
+        self._proctime = collections.defaultdict(_Stat)
+        # by (element address, element name)
+        self._element_latency = collections.defaultdict(_Stat)
+        # by (address of the source element, path)
+        self._latency = collections.defaultdict(_Stat)
+        # by path
+        self._interlatency = collections.defaultdict(_Stat)
+        # queue name -> highest fill seen
+        self._queue_fill = collections.defaultdict(float)
+
+        self._handlers = {
+            'proctime': self._on_proctime,
+            'element-latency': self._on_element_latency,
+            'latency': self._on_latency,
+            'interlatency': self._on_interlatency,
+            'queuelevel': self._on_queue_level,
+            'queue-level': self._on_queue_level,
+        }
+
+    def start(self):
+        self._timeout_id = GObject.timeout_add_seconds(self.interval, self._tick)
+
+    def stop(self):
+        if self._timeout_id is not None:
+            GObject.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+        self.update()
+
+        with open(os.path.join(self.path, 'report.json'), 'w') as f:
+            json.dump(self.get_report(), f, indent=2, sort_keys=True)
+
+    def _tick(self):
+        self.update()
+        self.dump_graphs()
+        self._log_report()
+
+        return True
+
+    def _update_owners(self):
+        names = collections.defaultdict(set)
+        for pipeline in get_pipelines():
+            name = '%s %s' % (pipeline.__class__.__name__, pipeline.player.get_name(),)
+            for el in pipeline.player.iterate_recurse():
+                self._owners[_get_pointer(el)] = name
+                names[el.get_name()].add(name)
+
+        self._names = dict(names)
+
+    def update(self):
+        """Parse the records written since the last update"""
+        self._update_owners()
+
+        if not os.path.exists(self._log_path):
+            return
+
+        with open(self._log_path) as f:
+            f.seek(self._offset)
+            for line in f:
+                # the last line could be still incomplete
+                if not line.endswith('\n'):
+                    break
+
+                self._offset += len(line)
+                self._parse_line(line)
+
+    def _parse_line(self, line):
+        match = _RECORD_RE.search(line.rstrip())
+        if match is None:
+            return
+
+        structure = Gst.Structure.new_from_string(match.group(1))
+        if structure is None:
+            return
+
+        handler = self._handlers.get(structure.get_name())
+        if handler is not None:
+            handler(structure)
+
+    def _on_proctime(self, structure):
+        self._proctime[_get_field(structure, 'element')].add(_parse_time(_get_field(structure, 'time')))
+
+    def _on_element_latency(self, structure):
+        element = (_get_field(structure, 'element-id'), _get_field(structure, 'element'),)
+        self._element_latency[element].add(_parse_time(_get_field(structure, 'time')))
+
+    def _on_latency(self, structure):
+        path = '%s -> %s' % (_get_field(structure, 'src-element', 'src'), _get_field(structure, 'sink-element', 'sink'),)
+        self._latency[(_get_field(structure, 'src-element-id'), path,)].add(_parse_time(_get_field(structure, 'time')))
+
+    def _on_interlatency(self, structure):
+        path = '%s -> %s' % (_get_field(structure, 'from_pad', 'from-pad'), _get_field(structure, 'to_pad', 'to-pad'),)
+        self._interlatency[path].add(_parse_time(_get_field(structure, 'time')))
+
+    def _on_queue_level(self, structure):
+        queue = _get_field(structure, 'queue', 'element')
+        fills = [0.0]
+        for size, max_size in (('size_buffers', 'max_size_buffers'), ('size_time', 'max_size_time'), ('size_bytes', 'max_size_bytes')):
+            value, limit = _get_field(structure, size, size.replace('_', '-')), _get_field(structure, max_size, max_size.replace('_', '-'))
+            if value is not None and limit:
+                fills.append(float(value) / limit)
+
+        self._queue_fill[queue] = max(self._queue_fill[queue], max(fills))
+
+    def _get_owner(self, name, pointer=None):
+        """Return the pipeline of the element with the given address or, without
+        it, of the element or of the pad (named like 'element_pad' by the
+        interlatency tracer) with the given name: the pipelines having an
+        element with that name are joined by '|'"""
+        if pointer in self._owners:
+            return self._owners[pointer]
+
+        while name:
+            if name in self._names:
+                return '|'.join(sorted(self._names[name]))
+
+            name = name.rpartition('_')[0]
+
+        return 'unknown'
+
+    def get_report(self):
+        """Return a dict with as key the pipeline and as value a dict with
+        the stats of its elements, queues and latencies"""
+        elapsed = time.time() - self._start
+
+        report = collections.defaultdict(lambda: {'elements': {}, 'queues': {}, 'latency': {}, 'interlatency': {}})
+
+        def __element(owner, name):
+            return report[owner]['elements'].setdefault(name, {
+                'frames': 0,
+                'ms-per-frame': 0.0,
+                'time-share': 0.0,
+                'latency-ms': 0.0,
+            })
+
+        for name, proctime in self._proctime.items():
+            __element(self._get_owner(name), name).update({
+                'frames': proctime.count,
+                'ms-per-frame': proctime.get_mean_ms(),
+                'time-share': proctime.total / (elapsed * Gst.SECOND) if elapsed > 0 else 0.0,
+            })
+
+        for (pointer, name), stat in self._element_latency.items():
+            __element(self._get_owner(name, pointer), name)['latency-ms'] = stat.get_mean_ms()
+
+        for name, fill in self._queue_fill.items():
+            report[self._get_owner(name)]['queues'][name] = {'max-fill': fill}
+
+        def __path(stat):
+            return {
+                'mean-ms': stat.get_mean_ms(),
+                'max-ms': stat.get_max_ms(),
+            }
+
+        for (pointer, path), stat in self._latency.items():
+            report[self._get_owner(path.split(' -> ')[0], pointer)]['latency'][path] = __path(stat)
+
+        for path, stat in self._interlatency.items():
+            report[self._get_owner(path.split(' -> ')[0])]['interlatency'][path] = __path(stat)
+
+        return dict(report)
+
+    def _log_report(self):
+        elements = []
+        for pipeline, stats in self.get_report().items():
+            for name, element in stats['elements'].items():
+                elements.append((element['time-share'], pipeline, name, element['ms-per-frame'],))
+
+        for share, pipeline, name, ms in sorted(elements, reverse=True)[:self.TOP_ELEMENTS]:
+            logger.info('profile %s %s: %.2f ms/frame, time share %.1f%%', pipeline, name, ms, share * 100)
+
+    def dump_graphs(self):
+        """Write the dot graph of each pipeline, named with the time"""
+        timestamp = time.strftime('%Y%m%d-%H%M%S')
+        for pipeline in get_pipelines():
+            Gst.debug_bin_to_dot_file(pipeline.player, Gst.DebugGraphDetails.ALL, '%s-%s' % (
+                timestamp, pipeline.player.get_name(),
+            ))
+
+
+_profiler = None
+def start_profiling():
+    """Start the periodic parsing and dot snapshots if the 'profile' option
+    is set, return the Profiler or None"""
+    global _profiler
+    if _profiler is not None or not conf.get_property('profile'):
+        return _profiler
+
+    # without GstShark only the latencies are reported
+    for tracer in TRACERS:
+        name = tracer.partition('(')[0]
+        if Gst.Registry.get().lookup_feature(name) is None:
+            logger.warning('tracer \'%s\' not available, its stats are missing from the profile', name)
+
+    _profiler = Profiler(get_profile_dir(), conf.get_property('profile-interval'))
+    _profiler.start()
+
+    logger.info('profiling into %s', _profiler.path)
+
+    return _profiler
+
+def stop_profiling():
+    global _profiler
+    if _profiler is None:
+        return
+
+    _profiler.stop()
+    _profiler = None
@@ -11,7 +11,7 @@ def get_level():
     if environ.has_key('SS_LOG_LEVEL'):
         return getattr(logging, environ.get('SS_LOG_LEVEL'))
     else:
-        return logging.DEBUG
+        return logging.INFO
 logger.setLevel(get_level())
 logger.addHandler(stream)
 stream.setFormatter(formatter)
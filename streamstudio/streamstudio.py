@@ -4,12 +4,6 @@ build a studio for lots of video/audio
 input who generate a virtual webcam as output 
 
 More example in future.
-Appsink will internally use a queue to collect buffers from the streaming thread.
-If the application is not pulling samples fast enough, this queue will consume a
-lot of memory over time. The "max-buffers" property can be used to limit the queue
-size. The "drop" property controls whether the streaming thread blocks or if older
-buffers are dropped when the maximum queue size is reached. Note that blocking the
-streaming thread can negatively affect real-time performance and should be avoided.
 '''
 
 from . import inputs
@@ -19,9 +13,11 @@ from .gui import GuiMixin
 
 from gi.repository import Gtk, GObject, Gdk, Gst
 from . import pipeline
-# lock use inspired from this <https://github.com/kivy/kivy/blob/31ba89c6c7661dcc6fa6916b46be8a0381874e5c/kivy/core/video/video_gstreamer.py>
-from threading import Lock
-from .conf import Configuration
+from .conf import get_configuration
+from .controller import SourceController
+from .warmpool import WarmPool
+from . import diagnostics
+from . import profiling
 
 print 'Gtk %d.%d.%d' % (
     Gtk.get_major_version(),
@@ -29,164 +25,6 @@ print 'Gtk %d.%d.%d' % (
     Gtk.get_micro_version(),
 )
 
-conf = Configuration()
-
-class SourceController(GObject.GObject):
-    """Link together the trasmitting appsink with the output's appsrc.
-
-    To initialize it you must pass an instance of StreamStudioOutput pipeline
-    as argument in its constructor.
-
-     >>> op = StreamStudioOutput()
-     >>> sc = SourceController(sc)
-
-    This controller allows two states of trasmission: a state called 'carosello'
-    that is a test state, showing an alternating white/black screen and the real
-    trasmitting state where the output came from the appsink.
-
-    To switch between these two states you can use the switch_to_carosello() method
-
-     >>> sc.switch_to_carosello(True)
-
-    In order to enable/change the trasmitting StreamStudioSource you have to use
-    the swap_source() method, passing the pipeline's appsink you want to transmit.
-
-     >>> ip = StreamStudioSource('whatever.mp4')
-     >>> ip.play()
-     >>> sc.swap_source(ip.enable_video_src())
-    """
-    def __init__(self, output_pipeline):
-        GObject.GObject.__init__(self)
-
-        self._output = output_pipeline
-        self._actual_input = None
-        self._actual_pipeline = None
-
-        self._src_handler_id = None
-
-        self._check_data_id = None
-        self.timestamp = 0
-
-        self._is_carosello = True
-        self.isWhite = True
-
-        self._data = None
-        self._lock = Lock()
-
-        self._output.get_video_src().connect('need-data', self._on_need_data)
-        self._output.get_video_src().connect('enough-data', self._on_enough_data)
-
-        GObject.timeout_add_seconds(1, self._switch_color)
-
-    def _switch_color(self):
-        self.isWhite = not self.isWhite
-
-        return True
-
-    def _dump(self, width, height, depth, isWhite):
-        """Return a black/white buffer"""
-        # http://gstreamer.freedesktop.org/data/doc/gstreamer/head/manual/html/section-data-spoof.html#section-spoof-appsrc
-        size = width * height * depth
-        bffer = Gst.Buffer.new_allocate(None, size, None)
-
-        bffer.memset(0, 0x00 if isWhite else 0xff, size)
-
-        bffer.pts = self.timestamp
-        bffer.duration = Gst.util_uint64_scale_int(1, Gst.SECOND, 30)
-
-        # NOTE: if you remove this line below the stream after the first
-        # switch doesn't re-switch and the stream appears lagging
-        self.timestamp += bffer.duration
-
-        return bffer
-
-    def _on_need_data(self, appsrc, *args):
-        #logger.debug('need data')
-        if not self._check_data_id:
-            self._check_data_id = GObject.idle_add(self._push_data, appsrc)
-
-    def _on_enough_data(self, appsrc):
-        self._remove_push_data_cb()
-
-    def _on_new_sample(self, appsink):
-        with self._lock:
-            bffer = appsink.emit('pull-sample')
-            self._data = bffer
-
-
-    def _remove_push_data_cb(self):
-        if self._check_data_id:
-            GObject.source_remove(self._check_data_id)
-            self._check_data_id = None
-
-    def _copy_from_data(self):
-        with self._lock:
-            if not self._data:
-                return None
-
-            bffer = self._data.get_buffer().copy()
-
-            self._data = None
-
-        try:
-            bffer.pts = self.timestamp
-        except ValueError as e:
-            logger.error('%d' % self.timestamp)
-            Gtk.main_quit()
-
-        self.timestamp += bffer.duration
-
-        return bffer
-
-    def _push_data(self, source):
-        bff = self._copy_from_data() if not self._is_carosello else self._dump(conf.get_output_width(), conf.get_output_height(), 2, self.isWhite)
-
-        if bff is None:
-            return True
-
-        result  = source.emit('push-buffer', bff)
-
-        if result != Gst.FlowReturn.OK:
-            logger.debug('error on on_need_data: %s' % result)
-            Gtk.main_quit()
-
-        return True
-
-    def _stop_actual_video_source(self):
-        if self._src_handler_id is not None:
-            self._actual_input.disconnect(self._src_handler_id)
-            self._actual_input.set_property('emit-signals', False)
-
-            self._src_handler_id = None
-
-    def _remove_actual_video_source(self):
-        self._actual_input = None
-
-    def _set_actual_video_input(self, appsink):
-        self._actual_input = appsink
-    def _start_actual_video_input(self):
-        self._src_handler_id = self._actual_input.connect('new-sample', self._on_new_sample)
-        self._actual_input.set_property('emit-signals', True)
-    def swap_source(self, pipeline):
-        """Change the trasmitting appsink"""
-        logger.debug('swap source to pipeline %s' % pipeline)
-
-        if self._actual_input is not None:
-            self._actual_pipeline.disable_video_src()
-            self._stop_actual_video_source()
-
-        self._actual_pipeline = pipeline
-        self._actual_input = self._actual_pipeline.enable_video_src()
-
-        self._start_actual_video_input()
-
-    def switch_to_carosello(self, enable):
-        """Change from carosello to trasmitting state"""
-        self._is_carosello = enable
-
-    def is_carosello(self):
-        return self._is_carosello
-
 class StreamStudio(GuiMixin):
     main_class = 'ssWindow'
     def __init__(self):
@@ -197,9 +35,18 @@ class StreamStudio(GuiMixin):
         self._pipeline_sources = []
         self._gui_inputs = []
 
+        # the sources are started as soon as added, ready to be transmitted
+        self._warm_pool = WarmPool()
+
         self._pipeline_video_selected = None
         self._gui_video_selected = None
         self._gui_audio_selected = None
+        # the source whose audio is mixed into the output (see the 'audio-program' option)
+        self._pipeline_audio_on_air = None
+
+        # created when the window is shown
+        self._output_pipeline = None
+        self._switch_controller = None
 
         def __cb_on_show_event(w):
             self._configure_initial_pipeline()
@@ -255,10 +102,12 @@ class StreamStudio(GuiMixin):
             self._gui_video_selected = monitorinput
             self._pipeline_video_selected = p
 
-            # enable the video src that when ready will emit
-            # the 'sink-ready' signal
+            # the branch is already running, open it and transmit it
+            self._warm_pool.cue(p)
             self._switch_controller.swap_source(p)
 
+            self._switch_audio(p)
+
         w._get_main_class().connect('show', __cb_on_show)
         w.connect('video-stream-selected', __cb_on_video_stream_activated)
 
@@ -266,7 +115,8 @@ class StreamStudio(GuiMixin):
 
         self._gui_inputs.append(w)
 
-        p.play()
+        self._watch_audio_streams(p)
+        self._warm_pool.add(p)
 
     def _add_device_source_pipeline(self, filename):
         p = pipeline.V4L2StreamStudioSource(filename)
@@ -285,8 +135,12 @@ class StreamStudio(GuiMixin):
                 self._gui_video_selected.deselect_video()
 
             self._gui_video_selected = monitorinput
+            self._pipeline_video_selected = p
+
+            self._warm_pool.cue(p)
+            self._switch_controller.swap_source(p)
 
-            self._switch_controller.swap_source(p.get_video_src())
+            self._switch_audio(p)
 
         w.connect('initializated', __cb_on_activated)
         w.connect('video-stream-selected', __cb_on_video_stream_activated)
@@ -295,7 +149,35 @@ class StreamStudio(GuiMixin):
 
         self._gui_inputs.append(w)
 
-        p.play()
+        self._watch_audio_streams(p)
+        self._warm_pool.add(p)
+
+    def _watch_audio_streams(self, p):
+        """The audio can appear after the video has been selected"""
+        def __cb_on_stream_added(pipeline, stream_type, stream_id):
+            if stream_type == 'audio' and stream_id == 0:
+                GObject.idle_add(self._switch_audio, pipeline)
+
+        p.connect('stream-added', __cb_on_stream_added)
+
+    def _switch_audio(self, p):
+        """The audio follows the video: mix into the output the first audio
+        stream of the selected source, in place of the previous one"""
+        if not get_configuration().get_property('audio-program'):
+            return False
+
+        if p is not self._pipeline_video_selected or p is self._pipeline_audio_on_air:
+            return False
+
+        if self._pipeline_audio_on_air is not None:
+            self._output_pipeline.remove_audio_source(self._pipeline_audio_on_air)
+            self._pipeline_audio_on_air = None
+
+        if p.get_audio_stream_ids():
+            self._output_pipeline.add_audio_source(p)
+            self._pipeline_audio_on_air = p
+
+        return False
 
     def _on_action_add_new_video_source(self, action):
         self.add_video_source()
@@ -455,12 +337,39 @@ class StreamStudio(GuiMixin):
         ad.run()
 
     def quit(self):
-        self._output_pipeline.kill()
+        diagnostics.stop_diagnostics()
+        profiling.stop_profiling()
+
+        # the window could be closed before being shown
+        if self._switch_controller is not None:
+            self._switch_controller.stop()
+        if self._output_pipeline is not None:
+            self._output_pipeline.kill()
         Gtk.main_quit()
 
+    def _count_toplevel_windows(self):
+        """Probe of the diagnostics, called from their thread: GTK is used
+        only from the main loop, so the count returned is the one taken
+        after the previous sample"""
+        def __update():
+            self._toplevel_windows = len(Gtk.Window.list_toplevels())
+            return False
+
+        GObject.idle_add(__update)
+
+        return self._toplevel_windows
+
     def run(self):
         self.show_all()
 
+        # the widgets not freed are counted also among the python objects
+        self._toplevel_windows = None
+        diagnostics.start_diagnostics({
+            'gui-inputs': lambda: len(self._gui_inputs),
+            'toplevel-windows': self._count_toplevel_windows,
+        })
+        profiling.start_profiling()
+
         Gtk.main()
 
 def usage(progname):
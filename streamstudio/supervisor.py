@@ -0,0 +1,187 @@
+"""
+Recovery of the sources failing while running (like a remote stream
+when the network goes down).
+
+A source is supervised passing a function that creates it; when the source
+emits 'error' (also at the end of a live source, see
+StreamStudioSource._on_message_eos()) it's killed and, after a delay doubling at each consecutive
+failure (from 'restart-delay' up to 'restart-max-delay' milliseconds),
+a new one is created and notified with the 'source-restarted' signal
+
+ >>> supervisor = SourceSupervisor()
+ >>> source = supervisor.supervise(lambda: RemoteStreamStudioSource(url))
+ >>> supervisor.connect('source-restarted', callback)
+
+The sources created are not started, it's the duty of who receives them
+(usually with WarmPool.add()). The failures are counted as consecutive
+until the new source has its video stream again.
+
+For each supervised source the number of outages and their duration are
+returned by get_outage_stats().
+"""
+import time
+import itertools
+from gi.repository import GObject
+from .sslog import logger
+from .conf import get_configuration
+
+conf = get_configuration()
+
+
+class SourceSupervisor(GObject.GObject):
+    __gsignals__ = {
+        'source-failed': (
+            GObject.SIGNAL_RUN_LAST,
+            GObject.TYPE_NONE,
+            (GObject.TYPE_OBJECT, GObject.TYPE_STRING,)
+        ),
+        'source-restarted': (# the failed source and the new one
+            GObject.SIGNAL_RUN_LAST,
+            GObject.TYPE_NONE,
+            (GObject.TYPE_OBJECT, GObject.TYPE_OBJECT,)
+        ),
+        'source-recovered': (# the new source has its video stream, with the outage seconds
+            GObject.SIGNAL_RUN_LAST,
+            GObject.TYPE_NONE,
+            (GObject.TYPE_OBJECT, GObject.TYPE_FLOAT,)
+        ),
+    }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+
+        self._handles = itertools.count()
+        # handle -> dict with the factory, the actual source and the outages
+        self._entries = {}
+
+    def supervise(self, factory):
+        """Create the source calling factory() and recreate it each time it fails"""
+        handle = next(self._handles)
+        self._entries[handle] = {
+            'factory': factory,
+            'source': None,
+            'handler-ids': [],
+            'failures': 0,
+            'outage-start': None,
+            'outages': [],
+            'timeout-id': None,
+        }
+
+        return self._create(handle)
+
+    def unsupervise(self, source):
+        """Stop watching the source, that is not killed"""
+        handle = self._get_handle(source)
+        if handle is None:
+            return
+
+        entry = self._entries.pop(handle)
+        self._disconnect(entry)
+
+        if entry['timeout-id'] is not None:
+            GObject.source_remove(entry['timeout-id'])
+
+    def _get_handle(self, source):
+        for handle, entry in self._entries.items():
+            if entry['source'] is source:
+                return handle
+
+        return None
+
+    def _create(self, handle):
+        entry = self._entries[handle]
+
+        source = entry['factory']()
+        entry['source'] = source
+        entry['handler-ids'] = [
+            source.connect('error', self._on_error, handle),
+            source.connect('stream-added', self._on_stream_added, handle),
+        ]
+
+        return source
+
+    def _disconnect(self, entry):
+        for handler_id in entry['handler-ids']:
+            entry['source'].disconnect(handler_id)
+
+        entry['handler-ids'] = []
+
+    def get_delay(self, failures):
+        """Return the milliseconds to wait before the restart after the given
+        number of consecutive failures"""
+        return min(conf.get_property('restart-max-delay'), conf.get_property('restart-delay') * 2 ** (failures - 1))
+
+    def _on_error(self, source, message, handle):
+        entry = self._entries[handle]
+        # an error already handled, the source is going to be replaced
+        if entry['timeout-id'] is not None:
+            return
+
+        entry['failures'] += 1
+        if entry['outage-start'] is None:
+            entry['outage-start'] = time.time()
+
+        delay = self.get_delay(entry['failures'])
+        logger.warning('%s failed (%s), restarting in %d ms (failure %d)', source, message, delay, entry['failures'])
+
+        self.emit('source-failed', source, message)
+
+        entry['timeout-id'] = GObject.timeout_add(delay, self._restart, handle)
+
+    def _restart(self, handle):
+        entry = self._entries[handle]
+        entry['timeout-id'] = None
+
+        old = entry['source']
+        self._disconnect(entry)
+        old.kill()
+
+        new = self._create(handle)
+        logger.info('%s restarted as %s', old, new)
+
+        self.emit('source-restarted', old, new)
+
+        return False
+
+    def _on_stream_added(self, source, stream_type, stream_id, handle):
+        """Called from the streaming thread"""
+        if stream_type != 'video' or stream_id != 0:
+            return
+
+        GObject.idle_add(self._recovered, handle, source)
+
+    def _recovered(self, handle, source):
+        entry = self._entries.get(handle)
+        if entry is None or entry['source'] is not source or entry['outage-start'] is None:
+            return False
+
+        duration = time.time() - entry['outage-start']
+        entry['outages'].append(duration)
+        entry['outage-start'] = None
+        entry['failures'] = 0
+
+        logger.info('%s recovered after %.1f s', source, duration)
+
+        self.emit('source-recovered', source, duration)
+
+        return False
+
+    def get_outage_stats(self):
+        """Return a dict with as key the actual source and as value a dict with
+        the number of outages, their total and longest duration in seconds
+        and the duration of the ongoing outage (None if it's running)"""
+        now = time.time()
+
+        stats = {}
+        for entry in self._entries.values():
+            outages = entry['outages']
+            ongoing = now - entry['outage-start'] if entry['outage-start'] is not None else None
+
+            stats[entry['source']] = {
+                'outages': len(outages) + (1 if ongoing is not None else 0),
+                'total': sum(outages) + (ongoing or 0.0),
+                'longest': max(outages + [ongoing or 0.0]),
+                'ongoing': ongoing,
+            }
+
+        return stats
@@ -0,0 +1,114 @@
+"""
+Pre-rendered frames used when no real source is transmitting.
+
+Each test card is rendered only once for a given output resolution and
+format, using a one-shot pipeline, and then handed out as a new buffer that
+shares the same memory so that only the timestamps differ between frames.
+
+ >>> store = TestCardStore()
+ >>> store.add_slate('/path/to/slate.png')
+ >>> bffer = store.get_frame('smpte', 640, 480, 'RGB16', pts, duration)
+"""
+from threading import Lock
+from gi.repository import Gst
+from .sslog import logger
+from .pipeline import _quote_spaces
+
+
+class TestCardStore(object):
+    """Cache of the frames of the test cards, indexed by
+    (card, width, height, format).
+
+    The cards available by default are 'black', 'white' and 'smpte'
+    (the colour bars), others can be added with add_card() passing a
+    pipeline description that produces a video stream.
+    """
+    CARDS = {
+        'black': 'videotestsrc pattern=black',
+        'white': 'videotestsrc pattern=white',
+        'smpte': 'videotestsrc pattern=smpte',
+    }
+    # how much time to wait for the one-shot pipeline to produce the frame
+    RENDER_TIMEOUT = 5 * Gst.SECOND
+
+    def __init__(self):
+        self._cards = dict(self.CARDS)
+        self._frames = {}
+        self._lock = Lock()
+
+    def add_card(self, name, description):
+        """Add a new card, description is the first part of a pipeline
+        that will be used to render it."""
+        self._cards[name] = description
+        self.invalidate(name)
+
+    def add_slate(self, location, name='slate'):
+        """Add a card using the image at the given path"""
+        self.add_card(name, 'filesrc location=%s ! decodebin ! imagefreeze' % _quote_spaces(location))
+
+    def get_cards(self):
+        return self._cards.keys()
+
+    def invalidate(self, name=None):
+        """Remove the rendered frames of the given card, or of all the
+        cards if name is None."""
+        with self._lock:
+            for key in self._frames.keys():
+                if name is None or key[0] == name:
+                    del self._frames[key]
+
+    def _evict_other_sizes(self, width, height, fmt):
+        """The output size is changed, forget the frames for the older ones"""
+        for key in self._frames.keys():
+            if key[1:] != (width, height, fmt):
+                del self._frames[key]
+
+    def _render(self, name, width, height, fmt):
+        description = '%s ! videoconvert ! videoscale ! video/x-raw,format=(string)%s,width=(int)%d,height=(int)%d ! appsink name=sink' % (
+            self._cards[name], fmt, width, height,
+        )
+        logger.debug('rendering test card \'%s\' with %s' % (name, description,))
+
+        player = Gst.parse_launch(description)
+        player.set_state(Gst.State.PAUSED)
+
+        try:
+            result, state, pending = player.get_state(self.RENDER_TIMEOUT)
+            if result == Gst.StateChangeReturn.FAILURE:
+                raise ValueError('rendering of test card \'%s\' failed' % name)
+
+            sample = player.get_by_name('sink').emit('pull-preroll')
+        finally:
+            player.set_state(Gst.State.NULL)
+
+        if sample is None:
+            raise ValueError('no frame for test card \'%s\'' % name)
+
+        return sample.get_buffer()
+
+    def prerender(self, names, width, height, fmt):
+        """Render in advance the frames for the given cards"""
+        for name in names:
+            self._get_cached(name, width, height, fmt)
+
+    def _get_cached(self, name, width, height, fmt):
+        key = (name, width, height, fmt)
+
+        with self._lock:
+            if key not in self._frames:
+                self._evict_other_sizes(width, height, fmt)
+                self._frames[key] = self._render(name, width, height, fmt)
+
+            return self._frames[key]
+
+    def get_frame(self, name, width, height, fmt, pts, duration):
+        """Return a buffer with the frame of the given card, sharing the
+        memory with the cached one."""
+        cached = self._get_cached(name, width, height, fmt)
+
+        flags = Gst.BufferCopyFlags.METADATA | Gst.BufferCopyFlags.MEMORY
+        bffer = cached.copy_region(flags, 0, cached.get_size())
+        bffer.pts = pts
+        bffer.duration = duration
+
+        return bffer
@@ -1,5 +1,6 @@
 from gi.repository import Gst
 import sys
+import ctypes
 from .sslog import logger
 
 def _ctrl_c_handling(pipeline):
@@ -33,3 +34,28 @@ def _logme(f):
         logger.debug('   %s -->' % f.func_name)
 
     return __logme
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+# see clock_gettime(2), in the C library from glibc 2.17 and in librt before
+_CLOCK_THREAD_CPUTIME_ID = 3
+_clock_gettime = None
+for _library in (None, 'librt.so.1',):
+    try:
+        _clock_gettime = ctypes.CDLL(_library).clock_gettime
+        break
+    except (OSError, AttributeError):
+        pass
+
+def get_thread_cpu_time():
+    """Return the seconds of CPU used by the calling thread, None if the
+    system doesn't tell it"""
+    if _clock_gettime is None:
+        return None
+
+    ts = _timespec()
+    if _clock_gettime(_CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts)) != 0:
+        return None
+
+    return ts.tv_sec + ts.tv_nsec / 1e9
@@ -0,0 +1,164 @@
+"""
+Pool of sources kept running ahead of their use, so that going live with
+one of them doesn't wait for the decoders to be discovered and negotiated.
+
+A source added to the pool is started at once: when its video stream appears
+the branch to the appsink is built and running but its valve is closed
+(see StreamStudioSource.enable_video_src()), so the frames are decoded and
+dropped. Cueing the source opens the valve, then the appsink returned can be
+transmitted
+
+ >>> pool = WarmPool()
+ >>> pool.add(source)
+ >>> ...
+ >>> pool.cue(source)
+ >>> controller.swap_source(source)
+
+A source cued before being ready is opened as soon as its video stream is
+available. For each source the time needed to be ready (from add()) and
+the time to the first frame reaching the appsink (from cue()) are measured,
+see get_stats() and the signals 'source-ready' and 'first-frame'. Before
+GStreamer 1.20 the valve drops also the caps, so the first frame after the
+cue includes the negotiation of the output conversion.
+"""
+import time
+import threading
+from gi.repository import GObject, Gst
+from .sslog import logger
+
+
+class WarmPool(GObject.GObject):
+    __gsignals__ = {
+        'source-ready': (# the video stream of the source is decoded and waits at the valve
+            GObject.SIGNAL_RUN_LAST,
+            GObject.TYPE_NONE,
+            (GObject.TYPE_OBJECT, GObject.TYPE_FLOAT,)
+        ),
+        'first-frame': (# the first frame after the cue reached the appsink
+            GObject.SIGNAL_RUN_LAST,
+            GObject.TYPE_NONE,
+            (GObject.TYPE_OBJECT, GObject.TYPE_FLOAT,)
+        ),
+    }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+
+        # source -> dict with the handler id and the times of its life in the pool
+        self._sources = {}
+        # the video is opened from the main loop by cue() or from the streaming
+        # thread when it's ready: the check and the mark of the opening are
+        # done holding it, so that a source is opened once
+        self._lock = threading.Lock()
+
+    def add(self, source):
+        """Start the source keeping its video closed until cued"""
+        if source in self._sources:
+            return
+
+        self._sources[source] = {
+            'handler-id': source.connect('stream-added', self._on_stream_added),
+            'added': time.time(),
+            'ready': None,
+            'cued': None,
+            'opened': False,
+            'warm-up': None,
+            'first-frame': None,
+        }
+
+        source.play()
+
+    def remove(self, source):
+        """Forget the source, that is not stopped"""
+        entry = self._sources.pop(source, None)
+        if entry is not None:
+            source.disconnect(entry['handler-id'])
+
+    def get_sources(self):
+        return self._sources.keys()
+
+    def is_ready(self, source):
+        return self._sources[source]['ready'] is not None
+
+    def _on_stream_added(self, source, stream_type, stream_id):
+        """Called from the streaming thread when the branches of the stream are built"""
+        if stream_type != 'video' or stream_id != 0:
+            return
+
+        entry = self._sources[source]
+        with self._lock:
+            entry['ready'] = time.time()
+            entry['warm-up'] = entry['ready'] - entry['added']
+
+            to_open = entry['cued'] is not None and not entry['opened']
+            entry['opened'] = entry['opened'] or to_open
+
+        logger.debug('%s ready in %.1f ms', source, entry['warm-up'] * 1000)
+
+        GObject.idle_add(self.emit, 'source-ready', source, entry['warm-up'])
+
+        if to_open:
+            self._open(source)
+
+    def cue(self, source):
+        """Let the video of the source reach its appsink; if it's not ready
+        yet this happens as soon as it is.
+
+        Return the appsink or None if it's not ready yet.
+        """
+        if source not in self._sources:
+            self.add(source)
+
+        entry = self._sources[source]
+        with self._lock:
+            if entry['ready'] is None:
+                entry['cued'] = time.time()
+                entry['first-frame'] = None
+                return None
+
+            # already open, the first frame arrived or is going to
+            if entry['opened']:
+                return source.enable_video_src()
+
+            entry['cued'] = time.time()
+            entry['first-frame'] = None
+            entry['opened'] = True
+
+        return self._open(source)
+
+    def uncue(self, source):
+        """Close again the video of the source, keeping it decoded"""
+        entry = self._sources[source]
+        with self._lock:
+            entry['cued'] = None
+            entry['opened'] = False
+
+        if entry['ready'] is not None:
+            source.disable_video_src()
+
+    def _open(self, source):
+        entry = self._sources[source]
+
+        def __cb_first_buffer(pad, info, user_data):
+            entry['first-frame'] = time.time() - entry['cued']
+            logger.debug('first frame of %s after %.1f ms', source, entry['first-frame'] * 1000)
+
+            GObject.idle_add(self.emit, 'first-frame', source, entry['first-frame'])
+
+            return Gst.PadProbeReturn.REMOVE
+
+        # the frames released by the valve must still be converted, so
+        # the probe is in place before the first one reaches the appsink
+        appsink = source.enable_video_src()
+        appsink.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, __cb_first_buffer, None)
+
+        return appsink
+
+    def get_stats(self):
+        """Return a dict with as key the source and as value a dict with
+        the seconds needed to be ready ('warm-up') and to get the first
+        frame after the last cue ('first-frame'), None if not happened"""
+        return dict([(source, {
+            'warm-up': entry['warm-up'],
+            'first-frame': entry['first-frame'],
+        }) for source, entry in self._sources.items()])
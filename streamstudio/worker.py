@@ -0,0 +1,307 @@
+"""
+Sources running in their own process.
+
+A WorkerSource is used by the main process like any other source, but
+the decoding happens in a child process (python -m streamstudio.worker)
+with its own interpreter and main loop, so that a stalling or crashing
+source doesn't affect the others and the decoding scales on more cores
+
+ >>> source = WorkerSource('test:smpte')
+ >>> source.play()
+ >>> controller.swap_source(source)
+
+The raw frames, already in the output format, pass through shared memory
+(shmsink in the worker, shmsrc in the main process); the control uses a
+line based protocol with JSON messages over the standard input and output
+of the worker:
+
+ - commands to the worker: {"command": "enable"|"disable"|"stop"}
+ - events from the worker: {"event": "stream-added", "type": ..., "id": ...},
+   {"event": "no-more-streams"} and {"event": "error", "message": ...}
+
+The worker receives the configuration through the SS_* environment variables.
+"""
+import os
+import sys
+
+if __name__ == '__main__':
+    # the standard output of the worker is reserved to the protocol, what
+    # is printed by the modules (like .pipeline) goes to the standard error
+    _protocol = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+import json
+import time
+import tempfile
+import itertools
+import subprocess
+from gi.repository import GObject, Gst
+from .sslog import logger
+from .conf import get_configuration
+from .pipeline import BasePipeline
+
+conf = get_configuration()
+
+_socket_counter = itertools.count()
+
+def _get_socket_path():
+    return os.path.join(tempfile.gettempdir(), 'streamstudio-%d-%d.sock' % (os.getpid(), next(_socket_counter),))
+
+
+class WorkerSource(BasePipeline):
+    """Proxy of a source running in a worker process: exposes the same
+    enable_video_src()/disable_video_src() of StreamStudioSource and the
+    'stream-added' and 'no-more-streams' signals (only for the video, the
+    audio stays into the worker).
+
+    If the worker dies the 'error' signal is emitted.
+    """
+    # seconds given to the worker to exit after each request
+    EXIT_TIMEOUT = 0.5
+    # the frames are timestamped when they arrive from the worker, the time
+    # of the capture doesn't cross the shared memory
+    CAPTURE_TIMESTAMPS = False
+
+    __gsignals__ = {
+        'stream-added': (
+            GObject.SIGNAL_RUN_LAST,
+            GObject.TYPE_NONE,
+            (GObject.TYPE_STRING, GObject.TYPE_INT,)
+        ),
+        'no-more-streams': (
+            GObject.SIGNAL_RUN_LAST,
+            GObject.TYPE_NONE,
+            (),
+        ),
+    }
+
+    def __init__(self, location):
+        self._location = location
+        self._socket_path = _get_socket_path()
+
+        self._process = None
+        self._watch_id = None
+
+        super(WorkerSource, self).__init__(
+            'shmsrc socket-path=%s is-live=true do-timestamp=true ! %s ! appsink name=sink enable-last-sample=false max-buffers=%d drop=%s' % (
+                self._socket_path, conf.get_output_caps_string(),
+                conf.get_property('appsink-max-buffers'), str(conf.get_property('appsink-drop')).lower(),
+            )
+        )
+
+        self._video_app_sink = self.player.get_by_name('sink')
+
+    def __str__(self):
+        return '<WorkerSource %s (pid %s)>' % (self._location, self._process.pid if self._process else None,)
+
+    def _spawn(self):
+        env = dict(os.environ)
+        env.update(conf.to_environ())
+
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'streamstudio.worker', self._location, self._socket_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+        )
+        logger.info('started worker %d for %s', self._process.pid, self._location)
+
+        self._watch_id = GObject.io_add_watch(self._process.stdout, GObject.IO_IN | GObject.IO_HUP, self._on_worker_output)
+
+    def _send(self, command):
+        if self._process is None or self._process.poll() is not None:
+            return
+
+        try:
+            self._process.stdin.write(json.dumps({'command': command}) + '\n')
+            self._process.stdin.flush()
+        except IOError as e:
+            logger.error('sending \'%s\' to worker %d failed: %s', command, self._process.pid, e)
+
+    def _on_worker_output(self, stdout, condition):
+        line = stdout.readline()
+        if not line:
+            self._on_worker_exited()
+            return False
+
+        message = json.loads(line)
+        event = message['event']
+
+        if event == 'stream-added':
+            if message['type'] == 'video' and message['id'] == 0:
+                # the frames are available in the shared memory only now
+                super(WorkerSource, self).play()
+
+            self.emit('stream-added', message['type'], message['id'])
+        elif event == 'no-more-streams':
+            self.emit('no-more-streams')
+        elif event == 'error':
+            self.emit('error', message['message'])
+
+        return True
+
+    def _on_worker_exited(self):
+        self._watch_id = None
+
+        returncode = self._process.wait()
+        logger.error('worker %d for %s exited with code %d', self._process.pid, self._location, returncode)
+
+        self.player.set_state(Gst.State.NULL)
+        self.emit('error', 'worker exited with code %d' % returncode)
+
+    def _wait_process(self):
+        """Wait for the worker to exit after the 'stop', a stalled one is
+        terminated and then killed: the main loop must not be blocked"""
+        for stop in (None, self._process.terminate, self._process.kill,):
+            if stop is not None:
+                logger.warning('worker %d for %s doesn\'t exit, %s', self._process.pid, self._location, stop.__name__)
+                stop()
+
+            deadline = time.time() + self.EXIT_TIMEOUT
+            while time.time() < deadline:
+                if self._process.poll() is not None:
+                    return
+
+                time.sleep(0.01)
+
+    def get_pid(self):
+        return self._process.pid if self._process else None
+
+    def play(self):
+        """Start the worker, the frames are received when its video stream
+        is available"""
+        if self._process is None:
+            self._spawn()
+
+    def pause(self):
+        pass
+
+    def enable_video_src(self, stream_id=0):
+        # only the first video stream is transmitted by the worker
+        self._send('enable')
+
+        return self._video_app_sink
+
+    def disable_video_src(self, stream_id=0):
+        self._send('disable')
+
+    def kill(self):
+        if self._watch_id is not None:
+            GObject.source_remove(self._watch_id)
+            self._watch_id = None
+
+        self._send('stop')
+
+        super(WorkerSource, self).kill()
+
+        if self._process is not None and self._process.poll() is None:
+            self._process.stdin.close()
+            self._wait_process()
+
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+
+
+class _Worker(object):
+    """The side of the worker process: runs the source and copies the
+    frames of its output appsink into the shared memory"""
+    def __init__(self, location, socket_path, protocol):
+        # imported here to not create a circular import
+        from .headless import get_source_class
+
+        self._protocol = protocol
+        self._main_loop = GObject.MainLoop()
+
+        self._output = BasePipeline(
+            'appsrc name=src format=time is-live=true caps="%s" ! shmsink socket-path=%s wait-for-connection=false sync=false' % (
+                conf.get_output_caps_string(), socket_path,
+            )
+        )
+        self._src = self._output.player.get_by_name('src')
+
+        klass, location = get_source_class(location)
+        self._source = klass(location)
+        self._source.connect('stream-added', self._on_stream_added)
+        self._source.connect('no-more-streams', self._on_no_more_streams)
+        self._source.connect('error', self._on_error)
+
+        # the commands are read from the file descriptor, not from the buffered
+        # sys.stdin: a buffer holding more lines wouldn't wake up the watch
+        self._commands = ''
+        GObject.io_add_watch(sys.stdin.fileno(), GObject.IO_IN | GObject.IO_HUP, self._on_command)
+
+    def _send(self, event, values=None):
+        """Write the event to the main process, returns False so that can
+        be used with GObject.idle_add()"""
+        message = dict(values or {}, event=event)
+        self._protocol.write(json.dumps(message) + '\n')
+        self._protocol.flush()
+
+        return False
+
+    def _on_stream_added(self, source, stream_type, stream_id):
+        # the valve of the source is opened and closed by the main process
+        if stream_type == 'video' and stream_id == 0:
+            appsink = source._output_app_sinks[stream_id]
+            appsink.connect('new-sample', self._on_new_sample)
+            appsink.set_property('emit-signals', True)
+
+        # called from the streaming thread, the protocol is written from the main loop
+        GObject.idle_add(self._send, 'stream-added', {'type': stream_type, 'id': stream_id})
+
+    def _on_no_more_streams(self, source):
+        GObject.idle_add(self._send, 'no-more-streams')
+
+    def _on_error(self, source, message):
+        self._send('error', {'message': message})
+
+    def _on_new_sample(self, appsink):
+        sample = appsink.emit('pull-sample')
+        self._src.emit('push-buffer', sample.get_buffer())
+
+        return Gst.FlowReturn.OK
+
+    def _on_command(self, fd, condition):
+        data = os.read(fd, 4096)
+        # without the main process there is nobody to send the frames to
+        if not data:
+            self.stop()
+            return False
+
+        # all the complete lines arrived, the last one could be partial
+        lines = (self._commands + data).split('\n')
+        self._commands = lines.pop()
+
+        for line in lines:
+            command = json.loads(line)['command']
+            if command == 'enable':
+                self._source.enable_video_src()
+            elif command == 'disable':
+                self._source.disable_video_src()
+            elif command == 'stop':
+                self.stop()
+                return False
+
+        return True
+
+    def stop(self):
+        self._source.kill()
+        self._output.kill()
+        self._main_loop.quit()
+
+    def run(self):
+        self._output.play()
+        self._source.play()
+
+        self._main_loop.run()
+
+def main(argv, protocol):
+    location, socket_path = argv
+
+    conf.set_value('headless', True)
+
+    GObject.threads_init()
+    Gst.init(None)
+
+    _Worker(location, socket_path, protocol).run()
+
+if __name__ == '__main__':
+    main(sys.argv[1:], _protocol)
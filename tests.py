@@ -1,3 +1,4 @@
+import os
 import unittest
 import time
 
@@ -63,3 +64,507 @@ class PipelineTests(unittest.TestCase):
 
     def tearDown(self):
         self.p.kill()
+
+class ConfigurationTests(unittest.TestCase):
+    def setUp(self):
+        from streamstudio.conf import Configuration
+
+        self.conf = Configuration()
+
+    def test_defaults(self):
+        self.assertEqual(self.conf.get_output_width(), 640)
+        self.assertEqual(self.conf.get_property('appsink-drop'), True)
+
+    def test_priority(self):
+        import tempfile
+        import os
+
+        fd, path = tempfile.mkstemp(suffix='.ini')
+        os.write(fd, '[streamstudio]\noutput_width = 800\nfps = 25\n')
+        os.close(fd)
+
+        try:
+            remaining = self.conf.load(
+                ['--config', path, '--fps', '30', 'video.mp4'],
+                environ={'SS_OUTPUT_WIDTH': '1024', 'SS_APPSINK_DROP': 'no'},
+            )
+        finally:
+            os.unlink(path)
+
+        self.assertEqual(remaining, ['video.mp4'])
+        self.assertEqual(self.conf.get_output_width(), 1024)
+        self.assertEqual(self.conf.get_fps(), 30)
+        self.assertEqual(self.conf.get_property('appsink-drop'), False)
+
+    def test_notify(self):
+        changed = []
+        self.conf.connect('notify::output-height', lambda conf, pspec: changed.append(pspec.name))
+
+        self.conf.set_value('output_height', '720')
+        self.conf.set_value('output-height', 720)
+
+        self.assertEqual(changed, ['output-height'])
+
+    def test_unknown_option(self):
+        self.assertRaises(AttributeError, self.conf.set_value, 'whatever', 1)
+
+class OutputSinkTests(unittest.TestCase):
+    def setUp(self):
+        from streamstudio.pipeline import parse_output_sink
+
+        self.parse = parse_output_sink
+
+    def test_defaults(self):
+        kind, options = self.parse('rtp')
+
+        self.assertEqual(kind, 'rtp')
+        self.assertEqual(options['host'], '127.0.0.1')
+        self.assertEqual(options['port'], '5000')
+
+    def test_options(self):
+        kind, options = self.parse('matroska-x264:location=/tmp/my show.mkv, preset=fast')
+
+        self.assertEqual(kind, 'matroska-x264')
+        self.assertEqual(options['location'], '/tmp/my\ show.mkv')
+        self.assertEqual(options['preset'], 'fast')
+
+    def test_unknown_kind(self):
+        self.assertRaises(AttributeError, self.parse, 'whatever:location=/tmp/out')
+
+    def test_missing_location(self):
+        self.assertRaises(AttributeError, self.parse, 'ogg-theora')
+
+class StreamIndexTests(unittest.TestCase):
+    def setUp(self):
+        from gi.repository import GObject, Gst
+        from streamstudio.pipeline import PadPipeline
+
+        GObject.threads_init()
+
+        self.GObject = GObject
+        self.Gst = Gst
+        self.p = PadPipeline('/dev/null')
+
+    def tearDown(self):
+        self.p.kill()
+
+    def test_index(self):
+        Gst = self.Gst
+
+        bin = Gst.Bin.new('video_sink')
+        sink = Gst.ElementFactory.make('fakesink', None)
+        bin.add(sink)
+        other = Gst.ElementFactory.make('fakesink', None)
+
+        self.p._index_stream_elements('video', 1, [bin, 'not an element'])
+        self.p._index_stream_elements('audio', 1, [other])
+
+        self.assertEqual(self.p._get_stream_id_from_element(bin), ('video', 1,))
+        # the actual sink inside a bin belongs to the stream of the bin
+        self.assertEqual(self.p._get_stream_id_from_element(sink), ('video', 1,))
+
+        self.p._unindex_stream_elements('video', 1)
+
+        self.assertEqual(self.p._get_stream_id_from_element(sink), (None, None,))
+        self.assertEqual(self.p._get_stream_id_from_element(other), ('audio', 1,))
+
+    def test_message_counters(self):
+        Gst = self.Gst
+
+        for n in range(3):
+            self.p.player.get_bus().post(Gst.Message.new_element(self.p.player, Gst.Structure.new_empty('test')))
+
+        context = self.GObject.MainContext.default()
+        deadline = time.time() + 1
+        while self.p.get_message_counters().get('element', 0) < 3 and time.time() < deadline:
+            context.iteration(False)
+
+        self.assertEqual(self.p.get_message_counters(), {'element': 3})
+
+class PositionPollerTests(unittest.TestCase):
+    def setUp(self):
+        from streamstudio.conf import get_configuration
+        from streamstudio.poller import PositionPoller
+
+        class FakePipeline(object):
+            position = 0
+            def is_live(self):
+                return False
+            def get_duration(self):
+                return 100
+            def get_position(self):
+                self.position += 1
+                return self.position
+
+        self.interval = get_configuration().get_property('position-poll-interval')
+        self.poller = PositionPoller()
+        self.pipeline = FakePipeline()
+        self.visible = [True]
+        self.positions = []
+        self.handle = self.poller.register(
+            self.pipeline,
+            lambda pipeline, position, duration: self.positions.append(position),
+            lambda: self.visible[0],
+        )
+
+    def tearDown(self):
+        self.poller.unregister(self.handle)
+
+    def test_interval(self):
+        self.assertEqual(self.poller._interval, self.interval)
+
+        self.assertTrue(self.poller._tick())
+        self.assertEqual(self.positions, [1])
+
+    def test_backoff(self):
+        self.visible[0] = False
+
+        # the tick is rescheduled slower and nothing is queried
+        self.assertFalse(self.poller._tick())
+        self.assertEqual(self.poller._interval, self.poller.HIDDEN_INTERVAL)
+        self.assertEqual(self.positions, [])
+
+        self.visible[0] = True
+
+        self.assertFalse(self.poller._tick())
+        self.assertEqual(self.poller._interval, self.interval)
+        self.assertEqual(self.positions, [1])
+
+    def test_unregister(self):
+        self.poller.unregister(self.handle)
+
+        self.assertEqual(self.poller._interval, None)
+        self.assertEqual(self.poller._timeout_id, None)
+
+class SupervisorTests(unittest.TestCase):
+    def setUp(self):
+        from gi.repository import GObject
+        from streamstudio.conf import get_configuration
+        from streamstudio.supervisor import SourceSupervisor
+
+        class FakeSource(GObject.GObject):
+            __gsignals__ = {
+                'error': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE, (GObject.TYPE_STRING,)),
+                'stream-added': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE, (GObject.TYPE_STRING, GObject.TYPE_INT,)),
+            }
+            killed = False
+            def kill(self):
+                self.killed = True
+
+        self.conf = get_configuration()
+        self.delays = [(name, self.conf.get_property(name)) for name in ('restart-delay', 'restart-max-delay',)]
+        self.conf.set_value('restart-delay', 10)
+        self.conf.set_value('restart-max-delay', 40)
+
+        self.GObject = GObject
+        self.supervisor = SourceSupervisor()
+        self.source = self.supervisor.supervise(FakeSource)
+
+    def tearDown(self):
+        for name, value in self.delays:
+            self.conf.set_value(name, value)
+
+    def _run(self, seconds):
+        loop = self.GObject.MainLoop()
+        self.GObject.timeout_add(int(seconds * 1000), loop.quit)
+        loop.run()
+
+    def test_backoff(self):
+        self.assertEqual([self.supervisor.get_delay(n) for n in range(1, 6)], [10, 20, 40, 40, 40])
+
+    def test_restart(self):
+        restarted = []
+        self.supervisor.connect('source-restarted', lambda s, old, new: restarted.append(new))
+
+        self.source.emit('error', 'connection lost')
+        self._run(0.1)
+
+        self.assertTrue(self.source.killed)
+        self.assertEqual(len(restarted), 1)
+        self.assertEqual(self.supervisor.get_outage_stats()[restarted[0]]['outages'], 1)
+
+        restarted[0].emit('stream-added', 'video', 0)
+        self._run(0.1)
+
+        stats = self.supervisor.get_outage_stats()[restarted[0]]
+        self.assertEqual(stats['ongoing'], None)
+        self.assertTrue(stats['total'] > 0)
+
+@unittest.skipUnless(os.environ.get('SS_SLOW_TESTS'), 'slow test, set SS_SLOW_TESTS=1 to run it')
+class RemoteRecoveryTests(unittest.TestCase):
+    """A remote source reading from extras/flaky_http_server.py is restarted
+    when the connection is dropped and has the video again when the server
+    is back"""
+    def setUp(self):
+        import sys
+        import tempfile
+        from gi.repository import GObject, Gst
+        from streamstudio.conf import get_configuration
+
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extras'))
+        import flaky_http_server
+
+        GObject.threads_init()
+        Gst.init(None)
+
+        self.conf = get_configuration()
+        self.delays = [(name, self.conf.get_property(name)) for name in ('restart-delay', 'restart-max-delay',)]
+        self.conf.set_value('restart-delay', 100)
+        self.conf.set_value('restart-max-delay', 400)
+
+        # a short video to serve
+        fd, self.path = tempfile.mkstemp(suffix='.ogg')
+        os.close(fd)
+        encoder = Gst.parse_launch('videotestsrc num-buffers=100 ! video/x-raw,width=320,height=240 ! theoraenc ! oggmux ! filesink location=%s' % self.path)
+        encoder.set_state(Gst.State.PLAYING)
+        encoder.get_bus().timed_pop_filtered(10 * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        encoder.set_state(Gst.State.NULL)
+
+        self.server = flaky_http_server.start_in_thread(self.path, up=2, down=1)
+
+        self.GObject = GObject
+
+    def _run(self, seconds):
+        loop = self.GObject.MainLoop()
+        self.GObject.timeout_add(int(seconds * 1000), loop.quit)
+        loop.run()
+
+    def test_restart(self):
+        from streamstudio.pipeline import RemoteStreamStudioSource
+        from streamstudio.supervisor import SourceSupervisor
+
+        url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+        supervisor = SourceSupervisor()
+        restarted, recovered = [], []
+
+        def __cb_restarted(supervisor, old, new):
+            restarted.append(new)
+            new.play()
+
+        supervisor.connect('source-restarted', __cb_restarted)
+        supervisor.connect('source-recovered', lambda supervisor, source, duration: recovered.append(source))
+
+        supervisor.supervise(lambda: RemoteStreamStudioSource(url)).play()
+        self._run(6)
+
+        self.assertTrue(restarted)
+        self.assertTrue(recovered)
+        self.assertTrue(recovered[0] in restarted)
+
+        for source in supervisor.get_outage_stats().keys():
+            supervisor.unsupervise(source)
+            source.kill()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.path)
+
+        for name, value in self.delays:
+            self.conf.set_value(name, value)
+
+@unittest.skipUnless(os.environ.get('SS_SLOW_TESTS'), 'slow test, set SS_SLOW_TESTS=1 to run it')
+class SourceRemovalTests(unittest.TestCase):
+    """Add and remove many sources while the output runs: the memory and the
+    threads used must not grow"""
+    ITERATIONS = 1000
+    # after these iterations the allocators and the thread pools are warmed up
+    WARM_UP = 100
+    # each these iterations the source is transmitted before being removed
+    ON_AIR_EVERY = 100
+
+    def setUp(self):
+        from gi.repository import GObject, Gst
+        from streamstudio.conf import get_configuration
+        from streamstudio.headless import HeadlessStudio
+
+        self.conf = get_configuration()
+        self.headless = self.conf.get_property('headless')
+        self.conf.set_value('headless', True)
+
+        GObject.threads_init()
+        Gst.init(None)
+
+        self.GObject = GObject
+        self.studio = HeadlessStudio()
+        self.studio.start()
+
+    def _run(self, seconds):
+        loop = self.GObject.MainLoop()
+        self.GObject.timeout_add(int(seconds * 1000), loop.quit)
+        loop.run()
+
+    def test_soak(self):
+        from streamstudio.diagnostics import get_process_status
+
+        for idx in range(self.ITERATIONS):
+            if idx == self.WARM_UP:
+                rss, threads = get_process_status()
+
+            source = self.studio.add_source('test:smpte')
+            self._run(0.05)
+
+            on_air = idx % self.ON_AIR_EVERY == self.ON_AIR_EVERY / 2
+            if on_air:
+                self._switch_to(source)
+
+            self.studio.remove_source(source)
+            if on_air:
+                self.assertTrue(self.studio._switch_controller.is_carosello())
+            self._run(0.01)
+
+        end_rss, end_threads = get_process_status()
+
+        self.assertEqual(self.studio.get_sources(), [])
+        self.assertTrue(end_rss - rss < 10 * 1024, 'RSS grew from %d kB to %d kB' % (rss, end_rss,))
+        # the idle threads of the GStreamer's pool are not joined at once
+        self.assertTrue(end_threads - threads <= 4, 'threads grew from %d to %d' % (threads, end_threads,))
+
+    def _switch_to(self, source):
+        """Transmit the source as soon as its video is available, so that
+        its removal takes it off air"""
+        pool = self.studio._warm_pool
+        for attempt in range(100):
+            if pool.is_ready(source):
+                break
+            self._run(0.05)
+
+        self.assertTrue(pool.is_ready(source))
+
+        self.studio.switch_to(source)
+        self._run(0.2)
+
+        self.assertFalse(self.studio._switch_controller.is_carosello())
+
+    def tearDown(self):
+        self.studio.quit()
+        self.conf.set_value('headless', self.headless)
+
+class AudioTapTests(unittest.TestCase):
+    """A tap slower than the audio drops the oldest buffers instead of
+    accumulating them, and its branch goes away with it"""
+    def setUp(self):
+        from gi.repository import GObject, Gst
+        from streamstudio.conf import get_configuration
+        from streamstudio.pipeline import StreamStudioSource
+
+        self.conf = get_configuration()
+        self.headless = self.conf.get_property('headless')
+        self.conf.set_value('headless', True)
+
+        GObject.threads_init()
+        Gst.init(None)
+
+        class AudioTestSource(StreamStudioSource):
+            LIVE = True
+
+            def _build_pipeline_string(self):
+                return 'audiotestsrc is-live=true ! decodebin name=demux'
+
+        self.GObject = GObject
+        self.source = AudioTestSource('tap')
+        self.source.play()
+        self._run(1)
+
+    def _run(self, seconds):
+        loop = self.GObject.MainLoop()
+        self.GObject.timeout_add(int(seconds * 1000), loop.quit)
+        loop.run()
+
+    def test_slow_tap(self):
+        handle = self.source.add_audio_tap(lambda sample: time.sleep(0.1))
+        queue, appsink = self.source._audio_taps[handle][2]
+
+        self._run(1.5)
+        overruns = self.source.get_audio_tap_stats()[handle]['overruns']
+        self._run(1)
+        stats = self.source.get_audio_tap_stats()[handle]
+
+        self.assertTrue(overruns > 0)
+        self.assertTrue(stats['overruns'] > overruns)
+        self.assertTrue(stats['queued-bytes'] <= stats['max-bytes'])
+
+        self.source.remove_audio_tap(handle)
+        self._run(0.5)
+
+        self.assertEqual(self.source.get_audio_tap_stats(), {})
+        self.assertTrue(queue.get_parent() is None)
+        self.assertTrue(appsink.get_parent() is None)
+
+    def tearDown(self):
+        self.source.kill()
+        self.conf.set_value('headless', self.headless)
+
+class DiagnosticsTests(unittest.TestCase):
+    def test_sample(self):
+        from gi.repository import Gst
+        from streamstudio.pipeline import BasePipeline
+        from streamstudio.diagnostics import Diagnostics
+
+        Gst.init(None)
+
+        p = BasePipeline('fakesrc ! queue name=q ! fakesink')
+        p.connect('error', lambda *args: None)
+
+        sample = Diagnostics(1).sample()
+        stats = sample['pipelines']['BasePipeline %s' % p.player.get_name()]
+
+        self.assertEqual(stats['handlers']['error'], 1)
+        self.assertEqual(stats['queues']['q']['buffers'], 0)
+        self.assertTrue(sample['rss'] > 0)
+
+        def __cb_error(*args):
+            pass
+
+        p.connect_after('error', __cb_error)
+        self.assertEqual(p.get_handler_counts()['error'], 2)
+        p.disconnect_by_func(__cb_error)
+        self.assertEqual(p.get_handler_counts()['error'], 1)
+
+        p.kill()
+
+class ProfilingTests(unittest.TestCase):
+    def test_parse(self):
+        import tempfile
+        from gi.repository import Gst
+        from streamstudio.profiling import Profiler
+
+        Gst.init(None)
+
+        profiler = Profiler(tempfile.gettempdir(), 1)
+        profiler._names = {'videoconvert0': set(['source']), 'queue0': set(['source']), 'sink': set(['source', 'output'])}
+        profiler._owners = {'0x10': 'output'}
+
+        for line in (
+            '0:00:01.0 1 0x1 TRACE GST_TRACER :0:: proctime, element=(string)videoconvert0, time=(string)0:00:00.002000000;',
+            '0:00:01.1 1 0x1 TRACE GST_TRACER :0:: proctime, element=(string)videoconvert0, time=(string)0:00:00.004000000;',
+            '0:00:01.2 1 0x1 TRACE GST_TRACER :0:: queuelevel, queue=(string)queue0, size_buffers=(uint)5, max_size_buffers=(uint)10;',
+            '0:00:01.3 1 0x1 TRACE GST_TRACER :0:: interlatency, from_pad=(string)videoconvert0_src, to_pad=(string)sink_sink, time=(guint64)1000000;',
+            '0:00:01.4 1 0x1 TRACE GST_TRACER :0:: element-latency, element-id=(string)0x10, element=(string)sink, src=(string)sink, time=(guint64)2000000, ts=(guint64)1;',
+            '0:00:01.5 1 0x1 TRACE GST_TRACER :0:: proctime, element=(string)sink, time=(string)0:00:00.001000000;',
+        ):
+            profiler._parse_line(line)
+
+        full_report = profiler.get_report()
+        report = full_report['source']
+
+        self.assertEqual(report['elements']['videoconvert0']['frames'], 2)
+        self.assertAlmostEqual(report['elements']['videoconvert0']['ms-per-frame'], 3.0)
+        self.assertAlmostEqual(report['queues']['queue0']['max-fill'], 0.5)
+        self.assertAlmostEqual(report['interlatency']['videoconvert0_src -> sink_sink']['mean-ms'], 1.0)
+
+        # the address identifies the pipeline, the name shared doesn't
+        self.assertAlmostEqual(full_report['output']['elements']['sink']['latency-ms'], 2.0)
+        self.assertEqual(full_report['output|source']['elements']['sink']['frames'], 1)
+
+class LayoutTests(unittest.TestCase):
+    def test_pip_inside_output(self):
+        from streamstudio.pipeline import compute_layout
+
+        rects = compute_layout('pip', 12, 1280, 720)
+
+        self.assertEqual(len(rects), 12)
+        for x, y, w, h in rects:
+            self.assertTrue(0 <= x and x + w <= 1280)
+            self.assertTrue(0 <= y and y + h <= 720)